@@ -23,8 +23,65 @@ slack = Slacker(app.config.get('SLACK_TOKEN'))
 
 
 # Configure storage
-from redis import Redis
-r = Redis(app.config.get('REDIS'))
+redis_options = dict(max_connections=app.config.get('REDIS_MAX_CONNECTIONS'),
+                     socket_timeout=app.config.get('REDIS_SOCKET_TIMEOUT'),
+                     socket_connect_timeout=app.config.get('REDIS_CONNECT_TIMEOUT'),
+                     socket_keepalive=app.config.get('REDIS_KEEPALIVE'))
+
+if app.config.get('STORAGE') == 'memory':
+    from .memory import Memory
+    r = Memory()
+elif app.config.get('REDIS_CLUSTER'):
+    from redis.cluster import RedisCluster
+    r = RedisCluster(host=app.config.get('REDIS'), **redis_options)
+elif app.config.get('REDIS_SOCKET'):
+    from redis import Redis
+    r = Redis(unix_socket_path=app.config.get('REDIS_SOCKET'), **redis_options)
+else:
+    from redis import Redis
+    r = Redis(app.config.get('REDIS'), **redis_options)
+
+# Client for reads outside sessions
+replica = r
+if app.config.get('STORAGE') != 'memory' and app.config.get('REDIS_REPLICA'):
+    if app.config.get('REDIS_CLUSTER'):
+        replica = RedisCluster(host=app.config.get('REDIS'), read_from_replicas=True, **redis_options)
+    else:
+        replica = Redis(app.config.get('REDIS_REPLICA'), **redis_options)
+
+# Send the slack messages of the handlers from a pool of threads
+from .outbound import SlackSender
+sender = SlackSender(app.config.get('SLACK_TOKEN'), r,
+                     url=app.config.get('SLACK_API_URL'),
+                     workers=app.config.get('SLACK_WORKERS'),
+                     rate=app.config.get('SLACK_CHANNEL_RATE'),
+                     burst=app.config.get('SLACK_CHANNEL_BURST'),
+                     size=app.config.get('SLACK_QUEUE_SIZE'),
+                     retries=app.config.get('SLACK_RETRIES'),
+                     timeout=app.config.get('SLACK_TIMEOUT'))
+
+# Merge bursts of messages into digests
+from .outbound import Coalescer
+digests = Coalescer(app, sender,
+                    windows=app.config.get('DIGEST_WINDOWS'),
+                    channels=app.config.get('DIGEST_CHANNEL_WINDOWS'),
+                    items=app.config.get('DIGEST_ITEMS'))
+
+# Skip the webhook deliveries received before
+if app.config.get('WEBHOOK_DEDUP_TTL'):
+    from .deliveries import Deliveries
+    webhooks.deliveries = Deliveries(r, ttl=app.config.get('WEBHOOK_DEDUP_TTL'),
+                                     size=app.config.get('WEBHOOK_DEDUP_SIZE'))
+
+# Queue the webhook events to be handled by the workers
+if app.config.get('WEBHOOK_QUEUE'):
+    from .ingest import EventQueue, WorkerPool
+    webhooks.queue = EventQueue(r, app.config.get('WEBHOOK_STREAM'), app.config.get('WEBHOOK_GROUP'),
+                                maxlen=app.config.get('WEBHOOK_STREAM_MAXLEN'))
+    workers = WorkerPool(app, webhooks, webhooks.queue,
+                         workers=app.config.get('WEBHOOK_WORKERS'),
+                         retries=app.config.get('WEBHOOK_RETRIES'),
+                         timeout=app.config.get('WEBHOOK_RETRY_TIMEOUT'))
 
 # Configure logging
 import logging
@@ -41,6 +98,27 @@ if app.config.get('APPLICATION_LOG', None):
     ))
     app.logger.addHandler(application_log_handler)
 
+# Trace the redis commands sent by each request
+if app.config.get('REDIS_TRACE'):
+    from flask import g
+    from app import redis as storage
+
+    @app.before_request
+    def start_redis_trace():
+        g.redis_trace = storage.tracing().start()
+
+    @app.after_request
+    def log_redis_trace(response):
+        trace = g.redis_trace.stop()
+        app.logger.info('%s %s: %s (%s)' % (request.method, request.path, trace, trace.details()))
+        response.headers['X-Redis-Trace'] = str(trace)
+        return response
+
+    @app.teardown_request
+    def stop_redis_trace(exception=None):
+        if 'redis_trace' in g:
+            g.redis_trace.stop()
+
 # Sample HTTP error handling
 @app.errorhandler(404)
 def not_found(error):
@@ -55,3 +133,7 @@ from app.models import load_data_from_slack
 
 # Store some slack data locally
 load_data_from_slack()
+
+# Start the workers handling the queued events in this process
+if app.config.get('WEBHOOK_QUEUE') and app.config.get('WEBHOOK_WORKERS'):
+    workers.start()
@@ -0,0 +1,220 @@
+"""Asyncio flavour of the model and index API (python 3 only)
+
+The coroutines use the same schema and key layout as the blocking API, and
+models are returned with their snapshot loaded, so reading their keys
+afterwards does not block. They are also available as methods of the
+models and indexes, e.g.
+
+```
+user = await User.afindBy('email', email)
+await user.aload()
+
+async for user in User.aall():
+    ...
+```
+
+Coroutines do not take part in sessions, writes buffered in a session are
+not seen until the session is flushed. Reads go to the replica if one is
+configured.
+"""
+from app import app, r, redis_options
+from app.memory import Memory
+from app.redis import SCAN_COUNT
+
+
+class AsyncEngine(object):
+    """Asyncio client for the in-process engine
+
+    The engine does not perform I/O, so commands are run directly
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+
+        async def command(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return command
+
+    def pipeline(self, transaction=True):
+        return AsyncPipeline(self.engine.pipeline(transaction))
+
+    def register_script(self, script):
+        script = self.engine.register_script(script)
+
+        async def run(keys=[], args=[], client=None):
+            return script(keys=keys, args=args)
+
+        return run
+
+    async def sscan_iter(self, name, match=None, count=None):
+        for value in self.engine.sscan_iter(name, match=match, count=count):
+            yield value
+
+
+class AsyncPipeline(object):
+    """Pipeline of the in-process engine, executed with await"""
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def __getattr__(self, name):
+        method = getattr(self.pipeline, name)
+
+        def command(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+
+        return command
+
+    async def execute(self):
+        return self.pipeline.execute()
+
+
+if isinstance(r, Memory):
+    redis = replica = AsyncEngine(r)
+elif app.config.get('REDIS_CLUSTER'):
+    from redis.asyncio.cluster import RedisCluster
+    redis = replica = RedisCluster(host=app.config.get('REDIS'), **redis_options)
+    if app.config.get('REDIS_REPLICA'):
+        replica = RedisCluster(host=app.config.get('REDIS'), read_from_replicas=True, **redis_options)
+else:
+    from redis.asyncio import Redis
+    if app.config.get('REDIS_SOCKET'):
+        redis = replica = Redis(unix_socket_path=app.config.get('REDIS_SOCKET'), **redis_options)
+    else:
+        redis = replica = Redis(app.config.get('REDIS'), **redis_options)
+
+    if app.config.get('REDIS_REPLICA'):
+        replica = Redis(app.config.get('REDIS_REPLICA'), **redis_options)
+
+# Scripts registered in the asyncio client, by the script of the blocking client
+_scripts = {}
+
+
+def _id(cls, id):
+    if not hasattr(cls, '__prefix__'):
+        raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
+
+    return cls.__id__(id)
+
+
+async def refresh(model):
+    """Read all the values of the model, replacing the snapshot"""
+    return model.__hydrate__(await replica.hgetall(model.id))
+
+
+async def load(model):
+    """Load all the values of the model if no valid snapshot is loaded"""
+    if model.__snapshot__() is None:
+        await refresh(model)
+
+    return model
+
+
+async def exists(cls, id):
+    return await replica.exists(_id(cls, id))
+
+
+async def get_many(cls, ids):
+    """Return a list with the loaded models for the given ids, with None
+    in place of the models that do not exist"""
+    ids = [_id(cls, id) for id in ids]
+    if len(ids) == 0:
+        return []
+
+    pipeline = replica.pipeline(transaction=False)
+    for id in ids:
+        pipeline.hgetall(id)
+
+    return [cls.__lazy__(id).__hydrate__(data) if data else None
+            for id, data in zip(ids, await pipeline.execute())]
+
+
+async def get(index, key):
+    """Return the value of the index for the key
+
+    For indexes with a relationship, the models are returned loaded
+    """
+    if index.__type__ == 'sorted':
+        return await range(index, key, key)
+
+    if index.__type__ == 'set':
+        ids = [id.decode('utf-8') for id in await replica.smembers(index.__keytransform__(key))]
+        return await get_many(index.__relationship__, ids) if index.__relationship__ else ids
+
+    value = await replica.get(index.__keytransform__(key))
+    if value and index.__relationship__:
+        return (await get_many(index.__relationship__, [value.decode('utf-8')]))[0]
+
+    return value
+
+
+async def range(index, min='-inf', max='+inf', start=None, num=None):
+    """Return the values of the sorted index between min and max (inclusive)"""
+    ids = [id.decode('utf-8') for id in await replica.zrangebyscore(index.__prefix__, min, max, start=start, num=num)]
+    if index.__relationship__:
+        return [model for model in await get_many(index.__relationship__, ids) if model is not None]
+
+    return ids
+
+
+async def find_by(cls, key, value):
+    """Return the model (or list of models for set and sorted indexes)
+    with the value for the key"""
+    if key == cls.__primary__:
+        return (await get_many(cls, [value]))[0]
+
+    if key not in cls.__indexes__:
+        raise AttributeError("No index has been defined for key '%s' in model %s" % (key, cls.__name__))
+
+    return await get(cls.__indexes__[key], value)
+
+
+async def count(cls):
+    """Return the number of models stored in the database"""
+    return await replica.scard(cls.__members__)
+
+
+async def all(cls, batch=100):
+    """Iterate the loaded models, reading them in batches of 'batch' models
+
+    Models that no longer exist are removed from the members set
+    """
+    if not hasattr(cls, '__prefix__'):
+        raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
+
+    ids = []
+    async for key in replica.sscan_iter(cls.__members__, count=SCAN_COUNT):
+        ids.append(key.decode('utf-8'))
+        if len(ids) >= batch:
+            for model in await _load_batch(cls, ids):
+                yield model
+            ids = []
+
+    for model in await _load_batch(cls, ids):
+        yield model
+
+
+async def _load_batch(cls, ids):
+    models = await get_many(cls, ids)
+    missing = [id for id, model in zip(ids, models) if model is None]
+    if len(missing) > 0:
+        await redis.srem(cls.__members__, *missing)
+
+    return [model for model in models if model is not None]
+
+
+async def execute_script(script, keys=[], args=[], models=[]):
+    """Run a script registered with redis.register_script()
+
+    The snapshots of the given models are discarded
+    """
+    if script not in _scripts:
+        _scripts[script] = redis.register_script(script.script)
+
+    for model in models:
+        model.__invalidate__()
+
+    return await _scripts[script](keys=keys, args=args)
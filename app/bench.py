@@ -0,0 +1,388 @@
+"""Throughput benchmark of the gitlab hooks
+
+Posts a corpus of push, tag push, issue, note and merge request events to
+the hook from several threads, either through the flask test client or
+through a local WSGI server, and reports the latency percentiles, the
+throughput and the redis commands sent for each event. Only the events
+answered with a 2xx status are measured, the others are reported as errors.
+Slack is replaced by a stub, so no messages are sent.
+
+Run it with the storage to measure, e.g. `STORAGE=memory python manage.py
+bench -n 5000 -c 8`, and compare the JSON results of different runs.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+import logging
+import math
+import threading
+import time
+
+from six.moves import queue
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from app import app, slack, sender, redis
+from app.models import User
+
+# Users that author the events, created before the run and deleted after it
+USERS = 20
+
+# Slack APIs replaced by the recorder, the messages queued in the sender
+# are recorded as chat.post_message
+SLACK_APIS = ('chat', 'channels', 'users')
+
+
+def author(i):
+    name = 'gitbot-bench-%d' % (i % USERS)
+    return {'name': name, 'email': '%s@niclabs.cl' % name}
+
+
+def repository(i):
+    return {
+        'name': 'bench-project-%d' % (i % 5),
+        'url': 'git@git.niclabs.cl:bench/bench-project-%d.git' % (i % 5),
+        'description': 'Benchmark project',
+        'homepage': 'http://git.niclabs.cl/bench/bench-project-%d' % (i % 5)
+    }
+
+
+def push_event(i):
+    commits = [{
+        'id': '%040x' % (i * 10 + n),
+        'message': 'Benchmark commit %d' % n,
+        'timestamp': '2015-09-02T15:10:47-03:00',
+        'url': 'http://git.niclabs.cl/bench/commit/%040x' % (i * 10 + n),
+        'author': author(i + n)
+    } for n in range(3)]
+
+    return {
+        'object_kind': 'push',
+        'before': '%040x' % i,
+        'after': '%040x' % (i + 1),
+        'ref': 'refs/heads/master',
+        'user_name': author(i)['name'],
+        'user_email': author(i)['email'],
+        'project_id': i % 5,
+        'repository': repository(i),
+        'commits': commits,
+        'total_commits_count': len(commits)
+    }
+
+
+def tag_push_event(i):
+    return {
+        'object_kind': 'tag_push',
+        'ref': 'refs/tags/0.0.%d' % i,
+        'before': '0' * 40,
+        'after': '%040x' % i,
+        'message': 'Release 0.0.%d' % i,
+        'user_name': author(i)['name'],
+        'user_email': author(i)['email'],
+        'project_id': i % 5,
+        'repository': repository(i),
+        'commits': [],
+        'total_commits_count': 0
+    }
+
+
+def issue_event(i):
+    return {
+        'object_kind': 'issue',
+        'user': {'name': author(i)['name'], 'username': author(i)['name']},
+        'object_attributes': {
+            'id': i,
+            'iid': i,
+            'title': 'Benchmark issue %d' % i,
+            'description': 'Issue created by the benchmark',
+            'state': 'opened',
+            'action': 'open',
+            'url': '%s/issues/%d' % (repository(i)['homepage'], i)
+        }
+    }
+
+
+def note_event(i):
+    return {
+        'object_kind': 'note',
+        'user': {'name': author(i)['name'], 'username': author(i)['name']},
+        'object_attributes': {
+            'id': i,
+            'note': 'Benchmark comment %d' % i,
+            'noteable_type': 'Issue',
+            'url': '%s/issues/%d#note_%d' % (repository(i)['homepage'], i, i)
+        },
+        'issue': {'id': i, 'iid': i, 'title': 'Benchmark issue %d' % i}
+    }
+
+
+def merge_request_event(i):
+    return {
+        'object_kind': 'merge_request',
+        'user': {'name': author(i)['name'], 'username': author(i)['name']},
+        'object_attributes': {
+            'id': i,
+            'iid': i,
+            'title': 'Benchmark merge request %d' % i,
+            'source_branch': 'bench-%d' % i,
+            'target_branch': 'master',
+            'state': 'opened',
+            'action': 'open',
+            'url': '%s/merge_requests/%d' % (repository(i)['homepage'], i)
+        }
+    }
+
+
+# Events posted in turn, by the value of the X-Gitlab-Event header
+CORPUS = [
+    ('Push Hook', push_event),
+    ('Tag Push Hook', tag_push_event),
+    ('Issue Hook', issue_event),
+    ('Note Hook', note_event),
+    ('Merge Request Hook', merge_request_event)
+]
+
+
+class SlackApi(object):
+    """Slack API that records the methods called instead of sending them"""
+    def __init__(self, api, calls):
+        self.api = api
+        self.calls = calls
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            self.calls.append('%s.%s' % (self.api, name))
+
+        return method
+
+
+class SlackRecorder(object):
+    """Replaces slack and the sender while active, recording the methods
+    called (e.g. 'chat.post_message') in 'calls'
+
+    Example:
+
+    ```
+    with SlackRecorder() as recorder:
+        self.app.post('/hooks/gitlab', ...)
+
+    assert recorder.calls == ['chat.post_message']
+    ```
+    """
+    def __init__(self):
+        self.calls = []
+        self.apis = {}
+
+    def start(self):
+        for name in SLACK_APIS:
+            self.apis[name] = getattr(slack, name)
+            setattr(slack, name, SlackApi(name, self.calls))
+        sender.post_message = SlackApi('chat', self.calls).post_message
+        return self
+
+    def stop(self):
+        if self.apis:
+            for name, api in self.apis.items():
+                setattr(slack, name, api)
+            self.apis = {}
+            del sender.post_message
+
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class Stats(object):
+    """Latencies and redis usage of each event, shared by the threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.round_trips = {}
+        self.commands = {}
+        self.slack_calls = 0
+
+    def request(self, event, latency, status):
+        with self.lock:
+            statuses = self.statuses.setdefault(event, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+            # Failed requests are not measured
+            latencies = self.latencies.setdefault(event, [])
+            if 200 <= status < 300:
+                latencies.append(latency)
+
+    def trace(self, event, trace):
+        with self.lock:
+            self.round_trips[event] = self.round_trips.get(event, 0) + trace.round_trips
+            self.commands[event] = self.commands.get(event, 0) + trace.commands
+
+    def results(self, elapsed):
+        events = {}
+        for event, latencies in self.latencies.items():
+            count = len(latencies)
+            requests = sum(self.statuses[event].values())
+            events[event] = dict(summary(latencies),
+                                 count=count,
+                                 errors=requests - count,
+                                 statuses=dict((str(status), n) for status, n in self.statuses[event].items()),
+                                 round_trips=self.round_trips.get(event, 0) / requests,
+                                 commands=self.commands.get(event, 0) / requests)
+
+        latencies = [latency for values in self.latencies.values() for latency in values]
+        requests = sum(n for statuses in self.statuses.values() for n in statuses.values())
+        total = dict(summary(latencies),
+                     count=len(latencies),
+                     errors=requests - len(latencies),
+                     seconds=elapsed,
+                     throughput=len(latencies) / elapsed if elapsed > 0 else 0.0,
+                     round_trips=sum(self.round_trips.values()) / max(requests, 1),
+                     commands=sum(self.commands.values()) / max(requests, 1),
+                     slack_calls=self.slack_calls)
+
+        return {'events': events, 'total': total}
+
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of the sorted values"""
+    if len(values) == 0:
+        return 0.0
+
+    rank = int(math.ceil(p / 100 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summary(latencies):
+    """Return the percentiles of the latencies in milliseconds"""
+    values = sorted(latencies)
+    return dict(('p%d' % p, percentile(values, p) * 1000) for p in (50, 95, 99))
+
+
+class Traced(object):
+    """WSGI middleware adding the redis commands of each request to the stats"""
+    def __init__(self, wsgi_app, stats):
+        self.wsgi_app = wsgi_app
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        with redis.tracing() as trace:
+            try:
+                return self.wsgi_app(environ, start_response)
+            finally:
+                self.stats.trace(environ.get('HTTP_X_GITLAB_EVENT'), trace)
+
+
+def create_users():
+    """Create the authors of the events that do not exist, returning them"""
+    users = []
+    with redis.session():
+        for i in range(USERS):
+            if User.exists(author(i)['name']):
+                continue
+
+            user = User(author(i)['name'])
+            user.email = author(i)['email']
+            user.gitlab_name = author(i)['name']
+            users.append(user)
+
+    return users
+
+
+def run(events=1000, concurrency=4, server=False):
+    """Post the events from 'concurrency' threads and return the results
+
+    With server, the events are sent to a WSGI server listening on a local
+    port instead of using the test client
+    """
+    stats = Stats()
+    hook = app.config.get('GITLAB_HOOK', '/hooks/gitlab')
+    requests = queue.Queue()
+    for i in range(events):
+        requests.put(i)
+
+    def client():
+        test_client = app.test_client()
+
+        def post(event, data):
+            if not server:
+                return test_client.post(hook, data=data, content_type='application/json',
+                                        headers={'X-Gitlab-Event': event}).status_code
+
+            request = Request('http://%s:%d%s' % (httpd.server_address[0], httpd.server_address[1], hook),
+                              data=data, headers={'Content-Type': 'application/json',
+                                                  'X-Gitlab-Event': event})
+            try:
+                response = urlopen(request)
+                response.read()
+                return response.getcode()
+            except HTTPError as e:
+                return e.code
+
+        while True:
+            try:
+                i = requests.get_nowait()
+            except queue.Empty:
+                return
+
+            event, payload = CORPUS[i % len(CORPUS)]
+            data = json.dumps(payload(i)).encode('utf-8')
+
+            start = time.time()
+            status = post(event, data)
+            stats.request(event, time.time() - start, status)
+
+    # Send slack messages and skip the test responses, as in production
+    config = dict((key, app.config.get(key)) for key in ('TESTING', 'DEBUG'))
+    app.config.update(TESTING=False, DEBUG=False)
+
+    # Failed requests are reported in the errors and statuses of the results
+    level = app.logger.level
+    app.logger.setLevel(logging.CRITICAL)
+    recorder = SlackRecorder().start()
+    wsgi_app = app.wsgi_app
+    app.wsgi_app = Traced(wsgi_app, stats)
+
+    httpd = None
+    if server:
+        from werkzeug.serving import make_server
+        httpd = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=httpd.serve_forever).start()
+
+    users = create_users()
+    try:
+        threads = [threading.Thread(target=client) for n in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+
+        for user in users:
+            user.delete()
+
+        app.wsgi_app = wsgi_app
+        recorder.stop()
+        app.logger.setLevel(level)
+        app.config.update(config)
+
+    stats.slack_calls = len(recorder.calls)
+    results = stats.results(elapsed)
+    results['options'] = {
+        'events': events,
+        'concurrency': concurrency,
+        'server': server,
+        'storage': app.config.get('STORAGE')
+    }
+
+    return results
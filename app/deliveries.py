@@ -0,0 +1,83 @@
+"""Deduplication of webhook deliveries
+
+Gitlab sends a hook again when it does not get an answer in time, so a slow
+handler may receive the same event twice. Before dispatching an event, the
+hooks claim a key for the delivery, taken from a delivery header (e.g.
+Idempotency-Key) or from a hash of the body. The key is set in redis with
+SET NX EX, and a delivery whose key is already set is skipped.
+
+The keys claimed by the process are also kept in a bounded LRU cache, which
+skips the duplicates without a round trip and is used alone while redis is
+unavailable.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Deliveries(object):
+    """Keys of the deliveries received in the last 'ttl' seconds
+
+    Up to 'size' keys are also kept in memory
+    """
+    def __init__(self, client, prefix='webhook:delivery:', ttl=3600, size=10000):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.size = size
+
+        # Expiration time of the keys, least recently claimed first
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seen(self, key):
+        """Return True if the key was claimed by this process and has not
+        expired"""
+        with self.lock:
+            expires = self.recent.get(key)
+            if expires is not None and expires <= time.time():
+                del self.recent[key]
+                expires = None
+
+            return expires is not None
+
+    def remember(self, key):
+        with self.lock:
+            self.recent.pop(key, None)
+            self.recent[key] = time.time() + self.ttl
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def claim(self, key):
+        """Return True if the delivery is new, False for a duplicate"""
+        if self.seen(key):
+            return False
+
+        try:
+            claimed = bool(self.client.set(self.prefix + key, 1, ex=self.ttl, nx=True))
+        except RedisError as e:
+            logger.warning('Error claiming delivery %s, checking only this process: %s' % (key, e))
+            claimed = True
+
+        if claimed:
+            self.remember(key)
+
+        return claimed
+
+    def release(self, key):
+        """Forget the key, so the delivery is handled if it is sent again"""
+        with self.lock:
+            self.recent.pop(key, None)
+
+        try:
+            self.client.delete(self.prefix + key)
+        except RedisError as e:
+            logger.warning('Error releasing delivery %s: %s' % (key, e))
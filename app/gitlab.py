@@ -13,6 +13,9 @@ EVENTS = {
 }
 
 class GitlabWebHook(WebHook):
+    # Sent by gitlab with the same value on the retries of a hook
+    delivery_header = 'Idempotency-Key'
+
     def event(self, request):
         gitlab_header = request.headers.get('X-Gitlab-Event', None)
 
@@ -24,13 +27,14 @@ class GitlabWebHook(WebHook):
             raise NotImplemented('Header not understood %s' % gitlab_header)
 
         if event == 'note':
-            if 'commit' in request.json:
+            data = self.payload.json or {}
+            if 'commit' in data:
                 event = 'commit_comment'
-            elif 'merge_request' in request.json:
+            elif 'merge_request' in data:
                 event = 'merge_request_comment'
-            elif 'issue' in request.json:
+            elif 'issue' in data:
                 event = 'issue_comment'
-            elif 'snippet' in request.json:
+            elif 'snippet' in data:
                 event = 'snippet_comment'
 
         return event
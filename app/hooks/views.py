@@ -1,11 +1,13 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-from app import app, webhooks, slack
+from app import app, webhooks, digests, redis
 from app.models import User, Channel
 from app.util import parse_project_name_from_repo_url
+from app.webhooks import Payload
 from flask import json, make_response, render_template
 from functools import partial
+from collections import Counter
 
 default_response = partial(make_response, '', 200)
 
@@ -13,7 +15,9 @@ default_response = partial(make_response, '', 200)
 @app.template_filter('render_slack_user')
 def render_slack_user(slack_user):
     if isinstance(slack_user, User):
-        return '<%s>' % slack_user.id
+        # The mention is the id without the hash tag of the model, if any,
+        # e.g. '<@flalanne>'
+        return '<%s>' % slack_user.id[len(slack_user.__tag__):]
 
     return slack_user['full_name']
 
@@ -22,6 +26,12 @@ def render_slack_user(slack_user):
     app.config.get('GITLAB_HOOK', '/hooks/gitlab'),
     handler='gitlab')
 class Gitlab:
+    def handle(self, event, data):
+        # Buffer the storage writes of the handlers and send them
+        # in a single transaction
+        with redis.session():
+            return super(Gitlab, self).handle(event, data)
+
     def check_object_kind(self, obj, expected):
         object_kind = obj.get('object_kind', None)
         if object_kind != expected:
@@ -75,8 +85,9 @@ class Gitlab:
         message = render_template('issue.txt', user=user, project=project, issue=issue)
 
         if not app.config.get('TESTING', False):
-            # Send message to slack
-            slack.chat.post_message(channel, message)
+            # Queue the message to slack, merged with other issue
+            # messages to the channel if they come in a burst
+            digests.post_message(channel, 'issue', message)
         else:
             # Return message to check in testing
             return message
@@ -84,11 +95,39 @@ class Gitlab:
         return default_response()
 
     def push(self, data):
+        # Count the commits of each author. Assume that the same email
+        # is used for Gitlab and slack
+        authors = Counter()
+        if app.config.get('GITLAB_STREAM_PUSH') and isinstance(data, Payload):
+            # Count the commits while the body is read, keeping the rest
+            # of the members
+            members = {}
+            for key, value in data.stream(streamed=('commits',)):
+                if key == 'commits':
+                    authors.update(commit.get('author', {}).get('email') for commit in value)
+                else:
+                    members[key] = value
+
+            data = members
+        else:
+            authors.update(commit.get('author', {}).get('email') for commit in data.get('commits', []))
+
         # Read commit list to update commit count for user
-        if not self.check_object_kind(data, 'tag_push'):
+        if not self.check_object_kind(data, 'push'):
             # This should not happen
             return default_response()
 
+        commits = {}
+        for email, count in authors.items():
+            slack_user = User.findBy('email', email) if email else None
+            if slack_user:
+                commits[slack_user] = commits.get(slack_user, 0) + count
+
+        # Update all the users in a single round trip
+        User.update_many_commits(commits)
+
+        return default_response()
+
     def tag_push(self, data):
         # Publish news of the new version of the repo in general
         if not self.check_object_kind(data, 'tag_push'):
@@ -129,8 +168,9 @@ class Gitlab:
         response = render_template('tag.txt', user=user, project=project, message=message, team=team, tag=tag)
 
         if not app.config.get('TESTING', False):
-            # Send message to slack
-            slack.chat.post_message(channel, response)
+            # Queue the message to slack, merged with other tags
+            # published to the channel if they come in a burst
+            digests.post_message(channel, 'tag_push', response)
         else:
             # slack.chat.post_message('#slack-test', response)
             # Return message to check in testing
@@ -140,20 +180,20 @@ class Gitlab:
 
     def merge_request(self, data):
         # Notify in the channel
-        pass
+        return default_response()
 
     def commit_comment(self, data):
         # Notify comment and receiver in the channel
-        pass
+        return default_response()
 
     def issue_comment(self, data):
         # Notify comment and receiver in the channel
-        pass
+        return default_response()
 
     def merge_request_comment(self, data):
         # Notify comment and receiver in the channel
-        pass
+        return default_response()
 
     def snippet_comment(self, data):
         # Do nothing for now
-        pass
+        return default_response()
@@ -0,0 +1,158 @@
+"""Queue of webhook events handled by a pool of workers
+
+With WEBHOOK_QUEUE enabled, the hooks validate each event, append it to a
+redis stream and answer 202, without waiting for the storage or for slack.
+The events are handled by the workers of a consumer group, started with
+`python manage.py worker` or with the application (WEBHOOK_WORKERS).
+
+An event is acknowledged once its handler returns. Events of workers that
+fail or die stay pending, and are claimed again by any worker after
+WEBHOOK_RETRY_TIMEOUT seconds, until they have been delivered
+WEBHOOK_RETRIES times.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from redis.exceptions import ResponseError
+
+import json
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Event(object):
+    """Event read from the queue"""
+    def __init__(self, id, hook, event, data, deliveries=1):
+        self.id = id
+        self.hook = hook
+        self.event = event
+        self.data = data
+        self.deliveries = deliveries
+
+    @classmethod
+    def parse(cls, id, fields, deliveries=1):
+        fields = dict((key.decode('utf-8'), value.decode('utf-8')) for key, value in fields.items())
+        return cls(id, fields['hook'], fields['event'], json.loads(fields['data']), deliveries)
+
+
+class EventQueue(object):
+    """Events stored in a redis stream, read by the consumers of a group"""
+    def __init__(self, client, stream='webhooks', group='workers', maxlen=None):
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.maxlen = maxlen
+
+    def push(self, hook, event, data):
+        """Append the event for the hook, returning its id"""
+        fields = {'hook': hook, 'event': event, 'data': json.dumps(data)}
+        return self.client.xadd(self.stream, fields, maxlen=self.maxlen)
+
+    def create_group(self):
+        """Create the stream and the consumer group if they do not exist"""
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    def read(self, consumer, count=10, block=None):
+        """Return the next events delivered to the consumer, waiting up to
+        'block' milliseconds for them"""
+        reply = self.client.xreadgroup(self.group, consumer, {self.stream: '>'}, count=count, block=block)
+        return [Event.parse(id, fields) for stream, entries in reply or [] for id, fields in entries]
+
+    def claim(self, consumer, timeout, count=10):
+        """Deliver to the consumer the events pending for more than 'timeout'
+        seconds, returning them"""
+        idle = int(timeout * 1000)
+        pending = self.client.xpending_range(self.stream, self.group, '-', '+', count, idle=idle)
+        if len(pending) == 0:
+            return []
+
+        deliveries = dict((entry['message_id'], entry['times_delivered'] + 1) for entry in pending)
+        entries = self.client.xclaim(self.stream, self.group, consumer, idle, list(deliveries))
+        return [Event.parse(id, fields, deliveries[id]) for id, fields in entries if fields is not None]
+
+    def ack(self, event):
+        return self.client.xack(self.stream, self.group, event.id)
+
+    def __len__(self):
+        return self.client.xlen(self.stream)
+
+
+class WorkerPool(object):
+    """Threads handling the events of the queue with the hooks of the app
+
+    Each thread is a consumer of the group. Events are acknowledged after
+    their handler returns. Failed events are retried after 'timeout'
+    seconds, and dropped after 'retries' deliveries.
+    """
+    def __init__(self, app, webhooks, queue, workers=4, retries=5, timeout=60, block=1000):
+        self.app = app
+        self.webhooks = webhooks
+        self.queue = queue
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.block = block
+
+        self.threads = []
+        self.stopped = threading.Event()
+
+    def consumer(self, n):
+        return '%s-%d-%d' % (socket.gethostname(), os.getpid(), n)
+
+    def start(self):
+        self.queue.create_group()
+        self.stopped.clear()
+        for n in range(self.workers):
+            thread = threading.Thread(target=self.run, args=(self.consumer(n),), name='webhook-worker-%d' % n)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def run(self, consumer):
+        while not self.stopped.is_set():
+            try:
+                self.poll(consumer, block=self.block)
+            except Exception:
+                logger.exception('Error reading the webhook queue')
+                self.stopped.wait(self.block / 1000.0)
+
+    def poll(self, consumer, block=None):
+        """Handle the events pending for retry and the next events of the
+        queue, returning the number of events handled"""
+        events = self.queue.claim(consumer, self.timeout) or self.queue.read(consumer, block=block)
+        for event in events:
+            self.process(event)
+
+        return len(events)
+
+    def process(self, event):
+        """Run the handler of the event, acknowledging it unless it fails"""
+        try:
+            with self.app.app_context():
+                self.webhooks.hooks[event.hook]().handle(event.event, event.data)
+        except Exception:
+            if event.deliveries < self.retries:
+                logger.exception('Error handling %s event %s (delivery %d), it will be retried' %
+                                 (event.event, event.id, event.deliveries))
+                return False
+
+            logger.exception('Error handling %s event %s, dropped after %d deliveries' %
+                             (event.event, event.id, event.deliveries))
+
+        self.queue.ack(event)
+        return True
@@ -0,0 +1,135 @@
+"""Incremental decoding of large json documents
+
+Reads a json object from a file-like object (e.g. the body of a request) in
+chunks, returning its members one at a time. The arrays of the members
+given as 'streamed' are returned as iterators over their items, so only one
+item is kept in memory at a time, e.g. for the commits of a push:
+
+```
+for key, value in JSONStream(request.stream).members(streamed=('commits',)):
+    if key == 'commits':
+        for commit in value:
+            ...
+```
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import codecs
+import json
+import re
+
+# Bytes read from the stream at a time
+CHUNK = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONStream(object):
+    def __init__(self, stream, chunk=CHUNK):
+        self.stream = stream
+        self.chunk = chunk
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+
+        # Text read and not decoded yet, from 'pos'
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=0):
+        """Read at least a chunk (or 'size' bytes) more, dropping the text
+        already decoded. Returns False at the end of the stream"""
+        if self.eof:
+            return False
+
+        data = self.stream.read(max(size, self.chunk))
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.pos:] + self.text.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Returns the next character that is not whitespace, or '' at the
+        end of the stream"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expecting %r at %d' % (char, self.pos))
+
+        self.pos += 1
+
+    def value(self):
+        """Decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may be incomplete, read as much again
+                if self.fill(len(self.buffer) - self.pos):
+                    continue
+
+                raise
+
+            # A number may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def items(self):
+        """Decode the items of the next array one at a time"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+
+            if self.peek() != ',':
+                self.expect(']')
+                return
+
+            self.pos += 1
+
+    def members(self, streamed=()):
+        """Decode the members of the object one at a time, as (key, value)
+
+        The values of the keys in 'streamed' that are arrays are returned as
+        an iterator over their items, which must be used before reading the
+        next member (the items not read are skipped)
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(':')
+
+            if key in streamed and self.peek() == '[':
+                items = self.items()
+                yield key, items
+
+                # Skip the items not read
+                for item in items:
+                    pass
+            else:
+                yield key, self.value()
+
+            if self.peek() != ',':
+                self.expect('}')
+                return
+
+            self.pos += 1
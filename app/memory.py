@@ -0,0 +1,1090 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from redis.exceptions import ResponseError
+from six import integer_types, iteritems
+
+import bisect
+import fnmatch
+import hashlib
+import threading
+import time
+
+# Scripts are written for the lua version embedded in redis (5.1), use the
+# first 5.1 compatible runtime bundled with lupa. Older versions of lupa
+# provide a single runtime, checked when the engine is created
+LuaRuntime = None
+for module in ('lupa.lua51', 'lupa.luajit21', 'lupa.luajit20', 'lupa'):
+    try:
+        runtime = __import__(module, fromlist=['LuaRuntime', 'lua_type'])
+        LuaRuntime, lua_type = runtime.LuaRuntime, runtime.lua_type
+        break
+    except ImportError:
+        continue
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class Status(bytes):
+    """Status reply of a command (e.g. OK)"""
+    pass
+
+
+OK = Status(b'OK')
+
+
+def encode(value):
+    """Encode an argument as the redis client does"""
+    if isinstance(value, bytes):
+        return value
+
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+
+    if isinstance(value, integer_types):
+        return ('%d' % value).encode('utf-8')
+
+    return ('%s' % value).encode('utf-8')
+
+
+def format_score(score):
+    """Format a score as redis does in replies"""
+    if abs(score) != float('inf') and score == int(score):
+        return ('%d' % score).encode('utf-8')
+
+    return ('%.17g' % score).encode('utf-8')
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ResponseError("value is not an integer or out of range")
+
+
+def parse_score(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ResponseError("value is not a valid float")
+
+
+def parse_bound(value):
+    """Parse a range bound of a sorted set, returning (score, exclusive)"""
+    if value.startswith(b'('):
+        return parse_score(value[1:]), True
+
+    return parse_score(value), False
+
+
+class SortedSet(dict):
+    """Members of a sorted set with their scores"""
+    def ordered(self):
+        return sorted(iteritems(self), key=lambda item: (item[1], item[0]))
+
+
+def parse_id(value, sequence=0):
+    """Parse the id of a stream entry, returning (milliseconds, sequence)"""
+    try:
+        if b'-' in value:
+            milliseconds, sequence = value.split(b'-', 1)
+            return int(milliseconds), int(sequence)
+
+        return int(value), sequence
+    except ValueError:
+        raise ResponseError("Invalid stream ID specified as stream command argument")
+
+
+def format_id(id):
+    return ('%d-%d' % id).encode('utf-8')
+
+
+def milliseconds():
+    return int(time.time() * 1000)
+
+
+class Stream(object):
+    """Entries of a stream, ordered by id, and its consumer groups"""
+    def __init__(self):
+        self.entries = []
+        self.last = (0, 0)
+        self.groups = {}
+
+    def next_id(self, value):
+        """Return the id for a new entry, generated if the value is '*'"""
+        if value == b'*':
+            now = milliseconds()
+            id = (now, 0) if now > self.last[0] else (self.last[0], self.last[1] + 1)
+        else:
+            id = parse_id(value)
+
+        if id <= self.last:
+            raise ResponseError("The ID specified in XADD is equal or smaller than the target stream top item")
+
+        self.last = id
+        return id
+
+    def get(self, id):
+        """Return the fields of the entry, or None if it has been deleted"""
+        index = bisect.bisect_left(self.entries, (id,))
+        if index < len(self.entries) and self.entries[index][0] == id:
+            return self.entries[index][1]
+
+        return None
+
+
+class Group(object):
+    """Consumer group of a stream
+
+    Pending entries are kept as {id: [consumer, delivery time, deliveries]}
+    """
+    def __init__(self, last):
+        self.last = last
+        self.pending = {}
+
+
+class Keyspace(object):
+    """Data of the in-process engine, with a method for each supported
+    redis command
+
+    Commands receive the arguments as bytes and return the reply as redis
+    does: bytes, integers, lists, None for nil replies or OK. Strings are
+    kept as bytes, lists as lists, hashes as dicts, sets as sets, sorted sets
+    as SortedSet and streams as Stream.
+    Expired keys are removed when they are accessed.
+    """
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def lookup(self, key, kind=None):
+        """Return the value of the key, checking that it has the given type"""
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            del self.expires[key]
+
+        value = self.data.get(key)
+        if value is not None and kind is not None and type(value) is not kind:
+            raise ResponseError(WRONGTYPE)
+
+        return value
+
+    def create(self, key, kind):
+        """Return the value of the key, creating an empty one if needed"""
+        value = self.lookup(key, kind)
+        if value is None:
+            value = self.data[key] = kind()
+
+        return value
+
+    def discard(self, key):
+        """Delete the key if it holds an empty collection"""
+        if not self.data[key]:
+            del self.data[key]
+            self.expires.pop(key, None)
+
+    # Keys
+    def DEL(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.lookup(key) is not None:
+                del self.data[key]
+                self.expires.pop(key, None)
+                deleted += 1
+
+        return deleted
+
+    def EXISTS(self, *keys):
+        return len([key for key in keys if self.lookup(key) is not None])
+
+    def EXPIRE(self, key, seconds):
+        if self.lookup(key) is None:
+            return 0
+
+        self.expires[key] = time.time() + parse_int(seconds)
+        return 1
+
+    def TTL(self, key):
+        if self.lookup(key) is None:
+            return -2
+
+        if key not in self.expires:
+            return -1
+
+        return int(round(self.expires[key] - time.time()))
+
+    def RENAME(self, key, new):
+        value = self.lookup(key)
+        if value is None:
+            raise ResponseError("no such key")
+
+        self.DEL(new)
+        self.data[new] = self.data.pop(key)
+        if key in self.expires:
+            self.expires[new] = self.expires.pop(key)
+
+        return OK
+
+    def KEYS(self, pattern):
+        return [key for key in list(self.data)
+                if fnmatch.fnmatchcase(key, pattern) and self.lookup(key) is not None]
+
+    def FLUSHDB(self):
+        self.data.clear()
+        self.expires.clear()
+        return OK
+
+    # Strings
+    def GET(self, key):
+        return self.lookup(key, bytes)
+
+    def SET(self, key, value, *options):
+        expires = None
+        exists = None
+        options = list(options)
+        while len(options) > 0:
+            option = options.pop(0).upper()
+            if option in (b'EX', b'PX') and len(options) > 0:
+                expires = parse_int(options.pop(0)) / (1.0 if option == b'EX' else 1000.0)
+            elif option in (b'NX', b'XX'):
+                exists = option == b'XX'
+            else:
+                raise ResponseError("syntax error")
+
+        if exists is not None and (self.lookup(key) is not None) != exists:
+            return None
+
+        self.lookup(key)
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if expires is not None:
+            self.expires[key] = time.time() + expires
+
+        return OK
+
+    # Hashes
+    def HGET(self, key, field):
+        return (self.lookup(key, dict) or {}).get(field)
+
+    def HMGET(self, key, *fields):
+        hash = self.lookup(key, dict) or {}
+        return [hash.get(field) for field in fields]
+
+    def HGETALL(self, key):
+        reply = []
+        for field, value in iteritems(self.lookup(key, dict) or {}):
+            reply += [field, value]
+
+        return reply
+
+    def HKEYS(self, key):
+        return list(self.lookup(key, dict) or {})
+
+    def HLEN(self, key):
+        return len(self.lookup(key, dict) or {})
+
+    def HEXISTS(self, key, field):
+        return 1 if field in (self.lookup(key, dict) or {}) else 0
+
+    def HSET(self, key, *pairs):
+        if len(pairs) == 0 or len(pairs) % 2 != 0:
+            raise ResponseError("wrong number of arguments for 'hset' command")
+
+        hash = self.create(key, dict)
+        added = 0
+        for i in range(0, len(pairs), 2):
+            added += 0 if pairs[i] in hash else 1
+            hash[pairs[i]] = pairs[i + 1]
+
+        return added
+
+    def HINCRBY(self, key, field, amount):
+        hash = self.lookup(key, dict) or {}
+        try:
+            value = int(hash.get(field, b'0'))
+        except ValueError:
+            raise ResponseError("hash value is not an integer")
+
+        value += parse_int(amount)
+        self.create(key, dict)[field] = encode(value)
+        return value
+
+    def HDEL(self, key, *fields):
+        hash = self.lookup(key, dict)
+        if hash is None:
+            return 0
+
+        deleted = len([hash.pop(field) for field in fields if field in hash])
+        self.discard(key)
+        return deleted
+
+    # Sets
+    def SADD(self, key, *members):
+        members = set(members)
+        values = self.create(key, set)
+        added = len(members - values)
+        values.update(members)
+        return added
+
+    def SREM(self, key, *members):
+        values = self.lookup(key, set)
+        if values is None:
+            return 0
+
+        removed = len(values & set(members))
+        values.difference_update(members)
+        self.discard(key)
+        return removed
+
+    def SMEMBERS(self, key):
+        return list(self.lookup(key, set) or ())
+
+    def SCARD(self, key):
+        return len(self.lookup(key, set) or ())
+
+    def SISMEMBER(self, key, member):
+        return 1 if member in (self.lookup(key, set) or ()) else 0
+
+    def SUNIONSTORE(self, dest, *keys):
+        union = set()
+        for key in keys:
+            union.update(self.lookup(key, set) or ())
+
+        self.DEL(dest)
+        if union:
+            self.data[dest] = union
+
+        return len(union)
+
+    # Lists
+    def RPUSH(self, key, *values):
+        items = self.create(key, list)
+        items.extend(values)
+        return len(items)
+
+    def LPUSH(self, key, *values):
+        items = self.create(key, list)
+        items[:0] = reversed(values)
+        return len(items)
+
+    def LPOP(self, key):
+        items = self.lookup(key, list)
+        if not items:
+            return None
+
+        value = items.pop(0)
+        self.discard(key)
+        return value
+
+    def LLEN(self, key):
+        return len(self.lookup(key, list) or [])
+
+    # Sorted sets
+    def ZADD(self, key, *pairs):
+        if len(pairs) == 0 or len(pairs) % 2 != 0:
+            raise ResponseError("syntax error")
+
+        scores = [(parse_score(pairs[i]), pairs[i + 1]) for i in range(0, len(pairs), 2)]
+        zset = self.create(key, SortedSet)
+        added = 0
+        for score, member in scores:
+            added += 0 if member in zset else 1
+            zset[member] = score
+
+        return added
+
+    def ZREM(self, key, *members):
+        zset = self.lookup(key, SortedSet)
+        if zset is None:
+            return 0
+
+        removed = len([zset.pop(member) for member in set(members) if member in zset])
+        self.discard(key)
+        return removed
+
+    def ZCARD(self, key):
+        return len(self.lookup(key, SortedSet) or {})
+
+    def ZSCORE(self, key, member):
+        score = (self.lookup(key, SortedSet) or {}).get(member)
+        return format_score(score) if score is not None else None
+
+    def ZINCRBY(self, key, amount, member):
+        zset = self.create(key, SortedSet)
+        zset[member] = zset.get(member, 0.0) + parse_score(amount)
+        return format_score(zset[member])
+
+    def __inrange__(self, score, min, max):
+        (low, low_exclusive), (high, high_exclusive) = parse_bound(min), parse_bound(max)
+        return (score > low if low_exclusive else score >= low) and \
+            (score < high if high_exclusive else score <= high)
+
+    def ZCOUNT(self, key, min, max):
+        zset = self.lookup(key, SortedSet) or SortedSet()
+        return len([score for score in zset.values() if self.__inrange__(score, min, max)])
+
+    def ZRANGEBYSCORE(self, key, min, max, *options):
+        options = [option.upper() for option in options]
+        items = [(member, score) for member, score in (self.lookup(key, SortedSet) or SortedSet()).ordered()
+                 if self.__inrange__(score, min, max)]
+
+        if b'LIMIT' in options:
+            i = options.index(b'LIMIT')
+            start, num = parse_int(options[i + 1]), parse_int(options[i + 2])
+            items = items[start:] if num < 0 else items[start:start + num]
+
+        return self.__reply__(items, b'WITHSCORES' in options)
+
+    def ZREVRANGE(self, key, start, stop, *options):
+        items = list(reversed((self.lookup(key, SortedSet) or SortedSet()).ordered()))
+        start, stop = parse_int(start), parse_int(stop)
+        start = max(start + len(items), 0) if start < 0 else start
+        stop = stop + len(items) if stop < 0 else stop
+
+        return self.__reply__(items[start:stop + 1], b'WITHSCORES' in [option.upper() for option in options])
+
+    def ZREVRANK(self, key, member):
+        zset = self.lookup(key, SortedSet) or SortedSet()
+        if member not in zset:
+            return None
+
+        return [item[0] for item in reversed(zset.ordered())].index(member)
+
+    def ZUNIONSTORE(self, dest, count, *keys):
+        if len(keys) != parse_int(count):
+            raise ResponseError("syntax error")
+
+        union = SortedSet()
+        for key in keys:
+            value = self.lookup(key)
+            if value is None:
+                continue
+
+            if type(value) is set:
+                value = SortedSet((member, 1.0) for member in value)
+            elif type(value) is not SortedSet:
+                raise ResponseError(WRONGTYPE)
+
+            for member, score in iteritems(value):
+                union[member] = union.get(member, 0.0) + score
+
+        self.DEL(dest)
+        if union:
+            self.data[dest] = union
+
+        return len(union)
+
+    # Streams
+    def group(self, key, name, command):
+        """Return the stream and the consumer group"""
+        stream = self.lookup(key, Stream)
+        if stream is None or name not in stream.groups:
+            raise ResponseError("NOGROUP No such key '%s' or consumer group '%s' in %s with GROUP option" %
+                                (key.decode('utf-8'), name.decode('utf-8'), command))
+
+        return stream, stream.groups[name]
+
+    def XADD(self, key, *args):
+        args = list(args)
+        maxlen = None
+        if len(args) > 0 and args[0].upper() == b'MAXLEN':
+            args.pop(0)
+            if len(args) > 0 and args[0] in (b'~', b'='):
+                args.pop(0)
+            maxlen = parse_int(args.pop(0)) if len(args) > 0 else None
+
+        if len(args) < 3 or len(args) % 2 == 0:
+            raise ResponseError("wrong number of arguments for 'xadd' command")
+
+        stream = self.create(key, Stream)
+        id = stream.next_id(args[0])
+        stream.entries.append((id, args[1:]))
+        if maxlen is not None:
+            del stream.entries[:max(len(stream.entries) - maxlen, 0)]
+
+        return format_id(id)
+
+    def XLEN(self, key):
+        return len((self.lookup(key, Stream) or Stream()).entries)
+
+    def XGROUP(self, subcommand, key, name, id, *options):
+        if subcommand.upper() != b'CREATE':
+            raise ResponseError("unknown subcommand '%s'" % subcommand.decode('utf-8'))
+
+        stream = self.lookup(key, Stream)
+        if stream is None:
+            if b'MKSTREAM' not in [option.upper() for option in options]:
+                raise ResponseError("The XGROUP subcommand requires the key to exist")
+            stream = self.create(key, Stream)
+
+        if name in stream.groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+
+        stream.groups[name] = Group(stream.last if id == b'$' else parse_id(id))
+        return OK
+
+    def XREADGROUP(self, *args):
+        if len(args) < 6 or args[0].upper() != b'GROUP':
+            raise ResponseError("syntax error")
+
+        name, consumer = args[1], args[2]
+        count, noack = None, False
+        i = 3
+        while i < len(args) and args[i].upper() != b'STREAMS':
+            option = args[i].upper()
+            if option == b'COUNT':
+                count = parse_int(args[i + 1])
+                i += 2
+            elif option == b'BLOCK':
+                # Commands never block in the engine, see Memory.xreadgroup()
+                i += 2
+            elif option == b'NOACK':
+                noack = True
+                i += 1
+            else:
+                raise ResponseError("syntax error")
+
+        streams = args[i + 1:]
+        if len(streams) == 0 or len(streams) % 2 != 0:
+            raise ResponseError("Unbalanced XREADGROUP list of streams")
+
+        reply = []
+        for key, id in zip(streams[:len(streams) // 2], streams[len(streams) // 2:]):
+            stream, group = self.group(key, name, 'XREADGROUP')
+            if id == b'>':
+                # New entries are delivered to the consumer
+                entries = [entry for entry in stream.entries if entry[0] > group.last][:count]
+                if len(entries) > 0:
+                    group.last = entries[-1][0]
+                if not noack:
+                    for entry in entries:
+                        group.pending[entry[0]] = [consumer, milliseconds(), 1]
+                if len(entries) > 0:
+                    reply.append([key, [[format_id(entry[0]), entry[1]] for entry in entries]])
+            else:
+                # Otherwise the entries pending for the consumer are delivered again
+                start = parse_id(id)
+                ids = sorted(pending for pending, state in iteritems(group.pending)
+                             if state[0] == consumer and pending > start)[:count]
+                for pending in ids:
+                    group.pending[pending][1:] = [milliseconds(), group.pending[pending][2] + 1]
+                reply.append([key, [[format_id(pending), stream.get(pending)] for pending in ids]])
+
+        return reply or None
+
+    def XACK(self, key, name, *ids):
+        stream = self.lookup(key, Stream)
+        if stream is None or name not in stream.groups:
+            return 0
+
+        pending = stream.groups[name].pending
+        return len([id for id in set(parse_id(id) for id in ids) if pending.pop(id, None) is not None])
+
+    def XPENDING(self, key, name, *args):
+        stream, group = self.group(key, name, 'XPENDING')
+        now = milliseconds()
+        if len(args) == 0:
+            ids = sorted(group.pending)
+            if len(ids) == 0:
+                return [0, None, None, None]
+
+            consumers = {}
+            for state in group.pending.values():
+                consumers[state[0]] = consumers.get(state[0], 0) + 1
+
+            return [len(ids), format_id(ids[0]), format_id(ids[-1]),
+                    [[consumer, encode(count)] for consumer, count in sorted(iteritems(consumers))]]
+
+        args = list(args)
+        idle = 0
+        if args[0].upper() == b'IDLE':
+            idle = parse_int(args[1])
+            args = args[2:]
+
+        if len(args) not in (3, 4):
+            raise ResponseError("syntax error")
+
+        start = (0, 0) if args[0] == b'-' else parse_id(args[0])
+        end = (float('inf'), 0) if args[1] == b'+' else parse_id(args[1], float('inf'))
+        consumer = args[3] if len(args) == 4 else None
+
+        reply = []
+        for id in sorted(group.pending):
+            owner, delivered, deliveries = group.pending[id]
+            if start <= id <= end and now - delivered >= idle and consumer in (None, owner):
+                reply.append([format_id(id), owner, now - delivered, deliveries])
+
+        return reply[:parse_int(args[2])]
+
+    def XCLAIM(self, key, name, consumer, idle, *ids):
+        stream, group = self.group(key, name, 'XCLAIM')
+        now = milliseconds()
+
+        reply = []
+        for id in [parse_id(id) for id in ids]:
+            state = group.pending.get(id)
+            if state is None or now - state[1] < parse_int(idle):
+                continue
+
+            fields = stream.get(id)
+            if fields is None:
+                # Entries deleted from the stream are removed
+                del group.pending[id]
+                continue
+
+            group.pending[id] = [consumer, now, state[2] + 1]
+            reply.append([format_id(id), fields])
+
+        return reply
+
+    def __reply__(self, items, withscores):
+        if not withscores:
+            return [member for member, score in items]
+
+        reply = []
+        for member, score in items:
+            reply += [member, format_score(score)]
+
+        return reply
+
+
+def pairs(reply):
+    return dict(zip(reply[::2], reply[1::2]))
+
+
+def scores(reply):
+    return [(reply[i], float(reply[i + 1])) for i in range(0, len(reply), 2)]
+
+
+def stream_entries(reply):
+    return [(id, pairs(fields) if fields is not None else None) for id, fields in reply]
+
+
+def stream_replies(reply):
+    return [[key, stream_entries(items)] for key, items in reply] if reply is not None else []
+
+
+def pending_entries(reply):
+    return [{'message_id': id, 'consumer': consumer, 'time_since_delivered': idle, 'times_delivered': deliveries}
+            for id, consumer, idle, deliveries in reply]
+
+
+class Commands(object):
+    """Client API of the in-process engine
+
+    The methods follow the signatures and return values of redis.Redis,
+    for the commands used by the models
+    """
+    def execute_command(self, name, *args, **options):
+        raise NotImplementedError()
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def exists(self, *names):
+        return self.execute_command('EXISTS', *names)
+
+    def expire(self, name, time):
+        return self.execute_command('EXPIRE', name, time, callback=bool)
+
+    def ttl(self, name):
+        return self.execute_command('TTL', name)
+
+    def rename(self, src, dst):
+        return self.execute_command('RENAME', src, dst, callback=bool)
+
+    def keys(self, pattern='*'):
+        return self.execute_command('KEYS', pattern)
+
+    def flushdb(self):
+        return self.execute_command('FLUSHDB', callback=bool)
+
+    def get(self, name):
+        return self.execute_command('GET', name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        args = []
+        if ex is not None:
+            args += ['EX', ex]
+        if px is not None:
+            args += ['PX', px]
+        if nx:
+            args.append('NX')
+        if xx:
+            args.append('XX')
+
+        return self.execute_command('SET', name, value, *args, callback=lambda reply: True if reply else None)
+
+    def hget(self, name, key):
+        return self.execute_command('HGET', name, key)
+
+    def hmget(self, name, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        return self.execute_command('HMGET', name, *(keys + list(args)))
+
+    def hgetall(self, name):
+        return self.execute_command('HGETALL', name, callback=pairs)
+
+    def hkeys(self, name):
+        return self.execute_command('HKEYS', name)
+
+    def hlen(self, name):
+        return self.execute_command('HLEN', name)
+
+    def hexists(self, name, key):
+        return self.execute_command('HEXISTS', name, key, callback=bool)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = [key, value] if key is not None else []
+        for item in iteritems(mapping or {}):
+            items += item
+
+        return self.execute_command('HSET', name, *items)
+
+    def hincrby(self, name, key, amount=1):
+        return self.execute_command('HINCRBY', name, key, amount)
+
+    def hdel(self, name, *keys):
+        return self.execute_command('HDEL', name, *keys)
+
+    def sadd(self, name, *values):
+        return self.execute_command('SADD', name, *values)
+
+    def srem(self, name, *values):
+        return self.execute_command('SREM', name, *values)
+
+    def smembers(self, name):
+        return self.execute_command('SMEMBERS', name, callback=set)
+
+    def scard(self, name):
+        return self.execute_command('SCARD', name)
+
+    def sismember(self, name, value):
+        return self.execute_command('SISMEMBER', name, value, callback=bool)
+
+    def sunionstore(self, dest, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        return self.execute_command('SUNIONSTORE', dest, *(keys + list(args)))
+
+    def rpush(self, name, *values):
+        return self.execute_command('RPUSH', name, *values)
+
+    def lpush(self, name, *values):
+        return self.execute_command('LPUSH', name, *values)
+
+    def lpop(self, name):
+        return self.execute_command('LPOP', name)
+
+    def llen(self, name):
+        return self.execute_command('LLEN', name)
+
+    def zadd(self, name, mapping):
+        items = []
+        for member, score in iteritems(mapping):
+            items += [score, member]
+
+        return self.execute_command('ZADD', name, *items)
+
+    def zrem(self, name, *values):
+        return self.execute_command('ZREM', name, *values)
+
+    def zcard(self, name):
+        return self.execute_command('ZCARD', name)
+
+    def zscore(self, name, value):
+        return self.execute_command('ZSCORE', name, value,
+                                    callback=lambda score: float(score) if score is not None else None)
+
+    def zincrby(self, name, amount, value):
+        return self.execute_command('ZINCRBY', name, amount, value, callback=float)
+
+    def zcount(self, name, min, max):
+        return self.execute_command('ZCOUNT', name, min, max)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False):
+        args = ['LIMIT', start, num] if start is not None and num is not None else []
+        if withscores:
+            return self.execute_command('ZRANGEBYSCORE', name, min, max, 'WITHSCORES', *args, callback=scores)
+
+        return self.execute_command('ZRANGEBYSCORE', name, min, max, *args)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        if withscores:
+            return self.execute_command('ZREVRANGE', name, start, end, 'WITHSCORES', callback=scores)
+
+        return self.execute_command('ZREVRANGE', name, start, end)
+
+    def zrevrank(self, name, value):
+        return self.execute_command('ZREVRANK', name, value)
+
+    def zunionstore(self, dest, keys):
+        return self.execute_command('ZUNIONSTORE', dest, len(keys), *keys)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return self.execute_command('EVALSHA', sha, numkeys, *keys_and_args)
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        args = []
+        if maxlen is not None:
+            args = ['MAXLEN', '~', maxlen] if approximate else ['MAXLEN', maxlen]
+
+        args.append(id)
+        for item in iteritems(fields):
+            args += item
+
+        return self.execute_command('XADD', name, *args)
+
+    def xlen(self, name):
+        return self.execute_command('XLEN', name)
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        return self.execute_command('XGROUP', 'CREATE', name, groupname, id, *(['MKSTREAM'] if mkstream else []),
+                                    callback=bool)
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        args = ['GROUP', groupname, consumername]
+        if count is not None:
+            args += ['COUNT', count]
+        if block is not None:
+            args += ['BLOCK', block]
+        if noack:
+            args.append('NOACK')
+
+        args += ['STREAMS'] + list(streams) + [streams[key] for key in streams]
+        return self.execute_command('XREADGROUP', *args, callback=stream_replies)
+
+    def xack(self, name, groupname, *ids):
+        return self.execute_command('XACK', name, groupname, *ids)
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None, idle=None):
+        args = ['IDLE', idle] if idle is not None else []
+        args += [min, max, count] + ([consumername] if consumername is not None else [])
+        return self.execute_command('XPENDING', name, groupname, *args, callback=pending_entries)
+
+    def xclaim(self, name, groupname, consumername, min_idle_time, message_ids):
+        return self.execute_command('XCLAIM', name, groupname, consumername, min_idle_time, *message_ids,
+                                    callback=stream_entries)
+
+
+class Memory(Commands):
+    """In-process storage engine with the semantics of a redis server
+
+    It can be used in place of the redis client by models and indexes, for
+    single process deployments and for running the tests without a redis
+    server. Commands are executed under a lock, so pipelines and scripts
+    are atomic as in redis. Scripts are run with lupa, which must provide a
+    lua 5.1 compatible runtime.
+    """
+    def __init__(self):
+        self.keyspace = Keyspace()
+        self.lock = threading.RLock()
+        self.scripts = {}
+
+        if LuaRuntime is None:
+            raise RuntimeError("lupa must be installed to use the memory engine (pip install lupa)")
+
+        self.lua = LuaRuntime(encoding=None)
+        if self.lua.eval(b'unpack') is None:
+            raise RuntimeError("The memory engine requires a lua 5.1 compatible runtime (LuaJIT or lua 5.1), "
+                               "lupa provides %s" % self.lua.eval(b'_VERSION').decode('utf-8'))
+
+        self.lua.execute(b"""
+        redis = {}
+        redis.status_reply = function(status) return {ok=status} end
+        redis.error_reply = function(error) return {err=error} end
+        """)
+        self.lua.globals().redis.call = self.__lua_call__
+        self.lua.globals().redis.pcall = self.__lua_pcall__
+
+    def execute_command(self, name, *args, **options):
+        with self.lock:
+            reply = self.__execute__(name, [encode(arg) for arg in args])
+
+        callback = options.get('callback')
+        return callback(reply) if callback else reply
+
+    def __execute__(self, name, args):
+        """Run a command with encoded arguments, returning the raw reply"""
+        if name.upper() == 'EVALSHA':
+            script = self.scripts.get(args[0].decode('utf-8'))
+            if script is None:
+                raise ResponseError("NOSCRIPT No matching script. Please use EVAL.")
+
+            keys = parse_int(args[1]) + 2
+            return self.__eval__(script, args[2:keys], args[keys:])
+
+        command = getattr(self.keyspace, name.upper(), None)
+        if command is None:
+            raise ResponseError("unknown command '%s'" % name)
+
+        return command(*args)
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def register_script(self, script):
+        script = Script(self, script)
+        self.scripts[script.sha] = script
+        return script
+
+    def script_load(self, script):
+        return self.register_script(script).sha
+
+    def scan_iter(self, match=None, count=None):
+        return iter(self.keys(match or '*'))
+
+    def sscan_iter(self, name, match=None, count=None):
+        members = self.execute_command('SMEMBERS', name)
+        if match is not None:
+            members = [member for member in members if fnmatch.fnmatchcase(member, encode(match))]
+
+        return iter(members)
+
+    def zscan_iter(self, name, match=None, count=None):
+        items = self.execute_command('ZRANGEBYSCORE', name, '-inf', '+inf', 'WITHSCORES', callback=scores)
+        if match is not None:
+            items = [item for item in items if fnmatch.fnmatchcase(item[0], encode(match))]
+
+        return iter(items)
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        """Read the streams as a consumer of the group
+
+        Commands do not block in the engine, with block the streams are
+        polled until new entries are read or the timeout (in milliseconds,
+        0 to wait forever) expires
+        """
+        deadline = time.time() + block / 1000.0 if block else None
+        while True:
+            reply = super(Memory, self).xreadgroup(groupname, consumername, streams, count=count, noack=noack)
+            if reply or block is None or (deadline is not None and time.time() >= deadline):
+                return reply
+
+            time.sleep(0.01)
+
+    def __eval__(self, script, keys, args):
+        """Run the script with encoded keys and arguments"""
+        with self.lock:
+            function = script.compile(self.lua)
+            return self.__from_lua__(function(self.lua.table_from(keys), self.lua.table_from(args)))
+
+    def __lua_call__(self, name, *args):
+        args = [arg if isinstance(arg, bytes) else self.__format_number__(arg) for arg in args]
+        return self.__to_lua__(self.__execute__(name.decode('utf-8'), args))
+
+    def __lua_pcall__(self, name, *args):
+        try:
+            return self.__lua_call__(name, *args)
+        except ResponseError as e:
+            return self.lua.globals().redis.error_reply(('%s' % e).encode('utf-8'))
+
+    def __format_number__(self, value):
+        """Format a lua number passed as argument to a command"""
+        if isinstance(value, float) and value == int(value):
+            value = int(value)
+
+        return encode(value) if isinstance(value, integer_types) else ('%.17g' % value).encode('utf-8')
+
+    def __to_lua__(self, reply):
+        """Convert a command reply to a lua value"""
+        if reply is None:
+            return False
+
+        if isinstance(reply, Status):
+            return self.lua.globals().redis.status_reply(bytes(reply))
+
+        if isinstance(reply, list):
+            return self.lua.table_from([self.__to_lua__(item) for item in reply])
+
+        return reply
+
+    def __from_lua__(self, value):
+        """Convert the value returned by a script to a reply"""
+        if value is None or value is False:
+            return None
+
+        if value is True:
+            return 1
+
+        if isinstance(value, (integer_types, float)):
+            return int(value)
+
+        if lua_type(value) == 'table':
+            if value[b'err'] is not None:
+                raise ResponseError(value[b'err'].decode('utf-8'))
+
+            if value[b'ok'] is not None:
+                return value[b'ok']
+
+            reply = []
+            while value[len(reply) + 1] is not None:
+                reply.append(self.__from_lua__(value[len(reply) + 1]))
+
+            return reply
+
+        return value
+
+
+class Pipeline(Commands):
+    """Buffer of commands executed in a single step by the engine
+
+    As with redis pipelines, the commands return the pipeline and the
+    replies are returned by execute(), which raises the first error if any
+    command fails
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.commands = []
+
+    def execute_command(self, name, *args, **options):
+        self.commands.append((name, [encode(arg) for arg in args], options.get('callback')))
+        return self
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self):
+        replies = []
+        with self.engine.lock:
+            for name, args, callback in self.commands:
+                try:
+                    reply = self.engine.__execute__(name, args)
+                    replies.append(callback(reply) if callback else reply)
+                except ResponseError as e:
+                    replies.append(e)
+
+        self.reset()
+        for reply in replies:
+            if isinstance(reply, ResponseError):
+                raise reply
+
+        return replies
+
+
+class Script(object):
+    """Lua script registered in the engine, called as redis.client.Script"""
+    def __init__(self, engine, script):
+        self.engine = engine
+        self.script = script.encode('utf-8') if not isinstance(script, bytes) else script
+        self.sha = hashlib.sha1(self.script).hexdigest()
+        self.function = None
+
+    def compile(self, lua):
+        if self.function is None:
+            self.function = lua.execute(b'return function(KEYS, ARGV)\n' + self.script + b'\nend')
+
+        return self.function
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client if client is not None else self.engine
+        return client.evalsha(self.sha, len(keys), *(list(keys) + list(args)))
@@ -0,0 +1,215 @@
+"""Micro-benchmarks of the model layer
+
+Measures the latency, memory and redis round trips of the basic model
+operations (creating a model, reading and writing keys, incrby, findBy,
+iterating all the models and renaming an index value) with 1k, 10k and
+100k models stored. Run it with the storage to measure:
+
+```
+python manage.py microbench -s 1000,10000
+```
+
+Revisions can be compared running this same module against a checkout of
+each one, e.g. `python manage.py microbench -r master,HEAD`. Revisions must
+have sessions and tracing in app/redis.py.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import six
+
+from app import redis
+
+# Operations measured for each benchmark and size
+OPS = 1000
+
+# Models written in each session while storing the population
+BATCH = 1000
+
+
+class BenchEntity(redis.Model):
+    name = redis.Key(primary=True, prefix='bench:')
+    email = redis.Key(index=True)
+    team = redis.Key(index='set')
+    score = redis.Int()
+
+
+def ident(i):
+    return 'entity-%d' % i
+
+
+def email(i):
+    return 'entity-%d@bench' % i
+
+
+def populate(start, end):
+    """Store the models start..end - 1"""
+    for first in range(start, end, BATCH):
+        with redis.session():
+            for i in range(first, min(first + BATCH, end)):
+                entity = BenchEntity(ident(i))
+                entity.email = email(i)
+                entity.team = 'team-%d' % (i % 10)
+                entity.score = i
+
+
+def rename(value):
+    BenchEntity.__indexes__['email'].rename(value, value + '.renamed')
+
+
+def restore(value):
+    BenchEntity.__indexes__['email'].rename(value + '.renamed', value)
+
+
+def iterate(repeat):
+    for entity in BenchEntity.all(load=True):
+        pass
+
+
+# Name, function building the arguments of the operations for the sampled
+# models, operation and the operation undoing it (if any), run after each
+# measurement
+BENCHMARKS = [
+    ('init', lambda sample: [ident(i) for i in sample], BenchEntity, None),
+    ('get', lambda sample: [BenchEntity(ident(i)) for i in sample], lambda entity: entity.email, None),
+    ('set', lambda sample: [BenchEntity(ident(i)) for i in sample], lambda entity: setattr(entity, 'score', 1), None),
+    ('incrby', lambda sample: [BenchEntity(ident(i)) for i in sample], lambda entity: entity.incrby('score', 1), None),
+    ('findBy', lambda sample: [email(i) for i in sample], lambda value: BenchEntity.findBy('email', value), None),
+    ('all', lambda sample: [0, 1, 2], iterate, None),
+    ('rename', lambda sample: [email(i) for i in sample], rename, restore)
+]
+
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of the sorted values"""
+    rank = int(math.ceil(p / 100 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def measure(build, sample, op, undo):
+    """Run the operation for the arguments built for the sample, returning
+    its statistics"""
+    args = build(sample)
+    latencies = []
+    with redis.tracing() as trace:
+        for arg in args:
+            start = timeit.default_timer()
+            op(arg)
+            latencies.append(timeit.default_timer() - start)
+
+    if undo is not None:
+        for arg in args:
+            undo(arg)
+
+    latencies.sort()
+    results = {
+        'ops': len(args),
+        'mean': sum(latencies) / len(args) * 1e6,
+        'p50': percentile(latencies, 50) * 1e6,
+        'p99': percentile(latencies, 99) * 1e6,
+        'round_trips': trace.round_trips / len(args),
+        'commands': trace.commands / len(args)
+    }
+
+    # Memory is measured in a separate run, since tracing the
+    # allocations slows down the operations
+    if six.PY3:
+        import tracemalloc
+        args = build(sample)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for arg in args:
+                op(arg)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        if undo is not None:
+            for arg in args:
+                undo(arg)
+
+        results['memory'] = (after - before) / len(args)
+        results['peak'] = peak - before
+
+    return results
+
+
+def run(sizes=(1000, 10000, 100000), ops=OPS):
+    """Run the benchmarks with each number of models stored
+
+    Returns {size: {benchmark: statistics}}, latencies are given in
+    microseconds and memory in bytes
+    """
+    results = {}
+    stored = 0
+    try:
+        for size in sorted(sizes):
+            populate(stored, size)
+            stored = size
+
+            sample = [i * size // min(ops, size) for i in range(min(ops, size))]
+            results[str(size)] = dict((name, measure(build, sample, op, undo))
+                                      for name, build, op, undo in BENCHMARKS)
+    finally:
+        BenchEntity.deleteall()
+
+    return results
+
+
+def compare(base, results):
+    """Return the lines of a table comparing the mean latency and round
+    trips of two runs"""
+    lines = []
+    for size in sorted(set(base) & set(results), key=int):
+        for name, build, op, undo in BENCHMARKS:
+            if name not in base[size] or name not in results[size]:
+                continue
+
+            old, new = base[size][name], results[size][name]
+            lines.append('%-8s %7s: %9.1fus -> %9.1fus (%+6.1f%%), %.2f -> %.2f round trips' %
+                         (name, size, old['mean'], new['mean'], (new['mean'] / old['mean'] - 1) * 100,
+                          old['round_trips'], new['round_trips']))
+
+    return lines
+
+
+def run_revision(revision, sizes=(1000, 10000, 100000), ops=OPS):
+    """Run the benchmarks of this module against a checkout of the revision"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    checkout = tempfile.mkdtemp(prefix='microbench-')
+    output = os.path.join(checkout, 'microbench.json')
+    try:
+        subprocess.check_call(['git', 'worktree', 'add', '--detach', checkout, revision], cwd=root)
+        subprocess.check_call([sys.executable, '-c',
+                               'import runpy; runpy.run_path(%r, run_name="__main__")' % os.path.abspath(__file__),
+                               '-s', ','.join(str(size) for size in sizes), '-n', str(ops), '-o', output],
+                              cwd=checkout)
+
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        subprocess.call(['git', 'worktree', 'remove', '--force', checkout], cwd=root)
+        shutil.rmtree(checkout, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the model layer')
+    parser.add_argument('-s', '--sizes', default='1000,10000,100000')
+    parser.add_argument('-n', '--ops', type=int, default=OPS)
+    parser.add_argument('-o', '--output', default='microbench.json')
+    options = parser.parse_args()
+
+    with open(options.output, 'w') as f:
+        json.dump(run([int(size) for size in options.sizes.split(',')], options.ops), f, indent=2, sort_keys=True)
@@ -1,10 +1,22 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from app import slack, redis, app
 
+# Format used to store the date of the last commit update in older versions
+COMMITS_UPDATED_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Days in each of the commit windows, all of them are ranked
+COMMIT_WINDOWS = {
+    'commits_in_last_day': 1,
+    'commits_in_last_week': 7,
+    'commits_in_last_month': 30,
+    'commits_in_last_year': 365
+}
+
 
 class Channel(redis.Model):
     name = redis.Key(primary=True, prefix='#')
+    slack_id = redis.Key()
 
     @staticmethod
     def load_from_slack():
@@ -15,12 +27,14 @@ class Channel(redis.Model):
             app.logger.error('Error loading channel list. Server returned %s' % slack_response.error)
             return False
 
-        # Add channel to list and save
-        for channel in slack_response.body.get('channels', []):
-            name = channel.get('name')
+        # Add channel to list and save. Writes are sent in a single
+        # transaction at the end of the session
+        with redis.session():
+            for channel in slack_response.body.get('channels', []):
+                name = channel.get('name')
 
-            entity = Channel(channel.get('name'))
-            entity.slack_id = channel.get('id')
+                entity = Channel(channel.get('name'))
+                entity.slack_id = channel.get('id')
 
         return True
 
@@ -29,17 +43,29 @@ class User(redis.Model):
     name = redis.Key(primary=True, prefix='@')
     email = redis.Key(index=True)
     gitlab_name = redis.Key(index=True)
+    slack_id = redis.Key()
+    first_name = redis.Key()
+    full_name = redis.Key()
+    commits = redis.Counter(retention=366, windows=sorted(COMMIT_WINDOWS.values()))
+    commits_total = redis.Int(index='sorted')
+    commits_updated = redis.DateTime(index='sorted', format=COMMITS_UPDATED_FORMAT)
+    days = redis.Int()
+
+    @property
+    def commits_in_last_day(self):
+        return self.commits.last(1)
 
     @property
-    def commits_updated(self):
-        if 'commits_updated' in self:
-            return datetime.strptime(self['commits_updated'], "%Y-%m-%dT%H:%M:%S.%fZ")
+    def commits_in_last_week(self):
+        return self.commits.last(7)
 
-        return None
+    @property
+    def commits_in_last_month(self):
+        return self.commits.last(30)
 
-    @commits_updated.setter
-    def commits_updated(self, value):
-        self['commits_updated'] = datetime.strftime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    @property
+    def commits_in_last_year(self):
+        return self.commits.last(365)
 
     @property
     def commits_average(self):
@@ -57,84 +83,123 @@ class User(redis.Model):
             app.logger.error('Error loading user list. Server returned %s' % slack_response.error)
             return False
 
-        # Add channel to list and save
-        for user in slack_response.body.get('members', []):
-            if user.get('is_bot') and not include_bots:
-                continue
+        # Add users to list and save. Writes are sent in a single
+        # transaction at the end of the session
+        with redis.session():
+            for user in slack_response.body.get('members', []):
+                if user.get('is_bot') and not include_bots:
+                    continue
 
-            if user.get('deleted') and not include_deleted:
-                continue
+                if user.get('deleted') and not include_deleted:
+                    continue
 
-            entity = User(user.get('name'))
-            entity.slack_id = user.get('id')
+                entity = User(user.get('name'))
+                entity.slack_id = user.get('id')
 
-            # For now assume that the user has the same username in
-            # gitlab and slack
-            entity.gitlab_name = user.get("name")
+                # For now assume that the user has the same username in
+                # gitlab and slack
+                entity.gitlab_name = user.get("name")
 
-            profile = user.get('profile')
-            if profile:
-                if profile.get('email'):
-                    entity.email = profile.get('email')
+                profile = user.get('profile')
+                if profile:
+                    if profile.get('email'):
+                        entity.email = profile.get('email')
 
-                if profile.get('first_name'):
-                    entity.first_name = profile.get('first_name')
+                    if profile.get('first_name'):
+                        entity.first_name = profile.get('first_name')
 
-                if profile.get('real_name'):
-                    entity.full_name = profile.get('real_name')
+                    if profile.get('real_name'):
+                        entity.full_name = profile.get('real_name')
 
         return True
 
-    def update_commits(self, commits=1):
+    def update_commits(self, commits=1, now=None):
         """Update the number of commits"""
-        if 'commits_updated' not in self:
-            # Start from 0
-            self.commits_updated = datetime.now()
-            self.commits_in_last_day = 0
-            self.commits_in_last_week = 0
-            self.commits_in_last_month = 0
-            self.commits_in_last_year = 0
-            self.commits_total = 0
-            self.days = 1
-
-        # We will check the dates
-        now = datetime.now()
-        updated = self.commits_updated
-
-        # Save the difference
-        delta = now - updated
-
-        # If more than one day has passed since last commit, reset daily commit count
-        if delta.days > 0:
-            self.commits_in_last_day = 0
-
-            # And increase the number of days counting
-            self.incrby('days', 1)
-
-        # If the week has changed between commits, reset weekly commit count
-        if abs(now.isocalendar()[1] - updated.isocalendar()[1]) > 0:
-            # Week changed
-            self.commits_in_last_week = 0
-
-        # If the month changed, reset monthly commit count
-        if abs(now.month - updated.month) > 0:
-            self.commits_in_last_month = 0
-
-        # If the year changed, reset yearly commit count
-        if now.year - updated.year > 0:
-            self.commits_in_last_week = 0  # In case there has been no activity in an exact year
-            self.commits_in_last_month = 0
-            self.commits_in_last_year = 0
-
-        # Increase count. Use incrby for efficiency
-        self.incrby('commits_in_last_day', commits)
-        self.incrby('commits_in_last_week', commits)
-        self.incrby('commits_in_last_month', commits)
-        self.incrby('commits_in_last_year', commits)
-        self.incrby('commits_total', commits)
-
-        # Change update date
-        self.commits_updated = now
+        User.update_many_commits({self: commits}, now=now)
+
+    @classmethod
+    def update_many_commits(cls, commits, now=None):
+        """Update the number of commits for many users in a single round trip
+
+        Receives a dictionary with users (or user names) as keys and the number
+        of commits to add as values. The commits are added to the bucket for the
+        current day of the commits counter, and to the total count. The days count
+        is increased when the first commit of the day is added.
+        """
+        users = [user if isinstance(user, User) else User(user) for user in commits]
+        if len(users) == 0:
+            return
+
+        now = now if now else datetime.now()
+        counters = [User.commits.key(user) for user in users]
+        redis.execute_script(update_commits_script,
+                             keys=[User.__members__] + [user.id for user in users] + counters,
+                             args=[User.__encode__('commits_updated', now)] + User.commits.args(0, now) +
+                             User.__index_args__('commits_total') + User.__index_args__('commits_updated') +
+                             list(commits.values()),
+                             models=users)
+
+    @classmethod
+    def top(cls, name, n=10, now=None):
+        """Return a list of (user, commits) with the 'n' users with most commits
+        for the window, where name is one of the keys of COMMIT_WINDOWS"""
+        if name not in COMMIT_WINDOWS:
+            raise AttributeError("No ranking has been defined for '%s'" % name)
+
+        ranking = User.commits.top(COMMIT_WINDOWS[name], n=n, now=now)
+        users = User.get_many([id for id, commits in ranking])
+        return [(user, commits) for user, (id, commits) in zip(users, ranking) if user is not None]
+
+    @classmethod
+    def inactive(cls, days=30, now=None):
+        """Return the users that have commits, but not in the last 'days' days"""
+        now = now if now else datetime.now()
+        return User.range('commits_updated', max='(' + User.__encode__('commits_updated', now - timedelta(days=days)))
+
+    def rank(self, name, now=None):
+        """Return the position of the user in the ranking for the window,
+        where name is one of the keys of COMMIT_WINDOWS"""
+        if name not in COMMIT_WINDOWS:
+            raise AttributeError("No ranking has been defined for '%s'" % name)
+
+        return self.commits.rank(COMMIT_WINDOWS[name], now=now)
+
+
+# Add commits to users.
+#
+# The commits are added to each user commit counter and to the total count.
+# The days count is increased when the first commit of the day is added.
+#
+# KEYS: users members set, the user ids, then the user commit counters
+# ARGV: current timestamp, the values returned by Counter.args() for 0 commits,
+# the index arguments for commits_total and commits_updated, then the number
+# of commits for each user
+update_commits_script = redis.register_script(redis.COUNTER_LUA + redis.INDEX_LUA + """
+local users = (#KEYS - 1) / 2
+for i = 1, users do
+    local key = KEYS[i + 1]
+    local commits = tonumber(ARGV[i + 13])
+
+    local value = incr_counter(KEYS[i + 1 + users], key, ARGV[2], commits,
+                               ARGV[4], ARGV[5], ARGV[6], ARGV[7])
+    if commits > 0 and value == commits then
+        -- First commits of the day, the bucket was empty
+        redis.call('HINCRBY', key, 'days', 1)
+    end
+
+    local old = redis.call('HGET', key, 'commits_total')
+    local total = redis.call('HINCRBY', key, 'commits_total', commits)
+    update_index(key, ARGV[8], ARGV[9], ARGV[10], old, tostring(total))
+
+    old = redis.call('HGET', key, 'commits_updated')
+    redis.call('HSET', key, 'commits_updated', ARGV[1])
+    update_index(key, ARGV[11], ARGV[12], ARGV[13], old, ARGV[1])
+
+    redis.call('SADD', KEYS[1], key)
+end
+
+return users
+""")
 
 
 def load_data_from_slack():
@@ -0,0 +1,359 @@
+"""Delivery of the messages posted to slack
+
+Handlers queue their messages with `sender.post_message(channel, text)`,
+which returns right away. A pool of threads sends them through a
+keep-alive HTTP session, each channel limited by a token bucket to the rate
+allowed by slack. Messages of different channels are sent concurrently,
+and the messages of a channel in order. The buckets are kept by each
+process, so N processes sending to a channel send up to N times the rate.
+
+When slack answers 429, the channel is paused for the time given in the
+Retry-After header and the message is sent again. Rate limited attempts,
+errors of the network and of the slack servers are retried a few times.
+
+Up to 'size' messages are queued in memory. Further messages are appended
+to a redis list, and moved back to memory as the queue empties, so bursts
+are delayed instead of dropped. Messages still in memory when the sender
+is stopped are also moved to redis, to be sent by the next process.
+
+Bursts of messages of an event type to a channel can be merged into
+digests with a Coalescer.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import deque, OrderedDict
+from flask import render_template
+from requests.adapters import HTTPAdapter
+
+import json
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker waits for new messages before checking redis
+IDLE = 1.0
+
+
+class TokenBucket(object):
+    """Allows 'rate' messages per second, with bursts of 'burst' messages"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused = 0.0
+
+    def delay(self):
+        """Return the seconds until a message can be sent"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if now < self.paused:
+            return self.paused - now
+
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Do not allow messages for the given seconds"""
+        self.paused = max(self.paused, time.time() + seconds)
+
+
+class Message(object):
+    def __init__(self, channel, data, attempts=0):
+        self.channel = channel
+        self.data = data
+        self.attempts = attempts
+
+    def dumps(self):
+        return json.dumps({'data': self.data, 'attempts': self.attempts})
+
+    @classmethod
+    def loads(cls, value):
+        value = json.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+        return cls(value['data']['channel'], value['data'], value['attempts'])
+
+
+class SlackSender(object):
+    """Queue of messages sent to slack by a pool of threads
+
+    'client' is the redis client used to keep the messages that do not fit
+    in memory, in the list 'key'. Failed messages are sent again after
+    'backoff' seconds times the number of attempts
+    """
+    def __init__(self, token, client, url='https://slack.com/api/', key='slack:outbound', workers=4,
+                 rate=1.0, burst=1, size=1000, retries=3, backoff=1.0, timeout=10):
+        self.token = token
+        self.client = client
+        self.url = url
+        self.key = key
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst
+        self.limit = size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_maxsize=max(workers, 1)))
+
+        # Messages in memory by channel, and channels being sent
+        self.channels = OrderedDict()
+        self.buckets = {}
+        self.busy = set()
+        self.size = 0
+
+        # True while there are messages in redis
+        self.spilling = False
+
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopped = False
+
+    def post_message(self, channel, text, **kwargs):
+        """Queue the message for the channel, with the arguments of
+        chat.postMessage"""
+        self.start()
+
+        message = Message(channel, dict(kwargs, channel=channel, text=text))
+        with self.condition:
+            if self.spilling or self.size >= self.limit:
+                self.client.rpush(self.key, message.dumps())
+                self.spilling = True
+            else:
+                self.push(message)
+
+            self.condition.notify()
+
+        return True
+
+    def start(self):
+        with self.condition:
+            if len(self.threads) > 0 or self.workers == 0:
+                return
+
+            self.stopped = False
+            self.spilling = self.client.llen(self.key) > 0
+            for n in range(self.workers):
+                thread = threading.Thread(target=self.run, name='slack-sender-%d' % n)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Stop the threads, moving the messages not sent to redis"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        with self.condition:
+            messages = [message.dumps() for messages in self.channels.values() for message in messages]
+            if len(messages) > 0:
+                self.client.lpush(self.key, *reversed(messages))
+
+            self.channels.clear()
+            self.size = 0
+            self.threads = []
+
+    def flush(self, timeout=None):
+        """Wait until all the messages have been sent, returning False if
+        the timeout expires first"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.size > 0 or len(self.busy) > 0 or self.spilling:
+                wait = deadline - time.time() if deadline is not None else IDLE
+                if wait <= 0:
+                    return False
+
+                self.condition.wait(min(wait, IDLE))
+
+        return True
+
+    def push(self, message, first=False):
+        messages = self.channels.setdefault(message.channel, deque())
+        if first:
+            messages.appendleft(message)
+        else:
+            messages.append(message)
+
+        self.size += 1
+
+    def refill(self):
+        """Move messages from redis to memory while there is room"""
+        while self.spilling and self.size < self.limit:
+            value = self.client.lpop(self.key)
+            if value is None:
+                self.spilling = False
+                self.condition.notify_all()
+                break
+
+            self.push(Message.loads(value))
+
+    def bucket(self, channel):
+        if channel not in self.buckets:
+            self.buckets[channel] = TokenBucket(self.rate, self.burst)
+
+        return self.buckets[channel]
+
+    def next(self):
+        """Wait for a message that can be sent, returning None once the
+        sender is stopped"""
+        with self.condition:
+            while not self.stopped:
+                self.refill()
+
+                wait = IDLE
+                for channel in list(self.channels):
+                    messages = self.channels[channel]
+                    if len(messages) == 0 and channel not in self.busy:
+                        del self.channels[channel]
+                        continue
+
+                    if len(messages) == 0 or channel in self.busy:
+                        continue
+
+                    delay = self.bucket(channel).delay()
+                    if delay > 0:
+                        wait = min(wait, delay)
+                        continue
+
+                    # Move the channel to the end, so channels take turns
+                    self.channels[channel] = self.channels.pop(channel)
+                    self.bucket(channel).take()
+                    self.busy.add(channel)
+                    self.size -= 1
+                    return messages.popleft()
+
+                self.condition.wait(wait)
+
+        return None
+
+    def done(self, message, retry):
+        with self.condition:
+            self.busy.discard(message.channel)
+            if retry:
+                self.push(message, first=True)
+
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            message = self.next()
+            if message is None:
+                return
+
+            retry = False
+            try:
+                retry = self.send(message)
+            except Exception:
+                logger.exception('Error sending message to %s' % message.channel)
+            finally:
+                self.done(message, retry)
+
+    def send(self, message):
+        """Post the message, returning True if it must be sent again"""
+        try:
+            response = self.session.post(self.url + 'chat.postMessage', data=message.data, timeout=self.timeout,
+                                         headers={'Authorization': 'Bearer %s' % self.token})
+        except requests.RequestException as e:
+            return self.retry(message, e)
+
+        if response.status_code == 429:
+            # Rate limited, wait the time requested by slack. It counts as
+            # an attempt, so the message is dropped if slack keeps refusing it
+            self.bucket(message.channel).pause(float(response.headers.get('Retry-After', 1)))
+            return self.retry(message, 'HTTP 429')
+
+        if response.status_code >= 500:
+            return self.retry(message, 'HTTP %d' % response.status_code)
+
+        body = response.json()
+        if not body.get('ok'):
+            logger.error('Error sending message to %s: %s' % (message.channel, body.get('error')))
+
+        return False
+
+    def retry(self, message, error):
+        """Back off the channel and return True if the message has attempts
+        left"""
+        message.attempts += 1
+        if message.attempts > self.retries:
+            logger.error('Error sending message to %s: %s, dropped after %d attempts' %
+                         (message.channel, error, message.attempts))
+            return False
+
+        logger.warning('Error sending message to %s: %s, it will be retried' % (message.channel, error))
+        self.bucket(message.channel).pause(self.backoff * message.attempts)
+        return True
+
+
+class Coalescer(object):
+    """Merges bursts of messages into digests
+
+    The first message of an event type sent to a channel is sent right away,
+    and opens a window of the seconds configured for the event (in
+    'windows', or in 'channels' for the channel). The messages posted during
+    the window are sent when it closes, as a single digest rendered with
+    the template, showing the first line of up to 'items' messages.
+    """
+    def __init__(self, app, sender, windows=None, channels=None, items=10, template='digest.txt'):
+        self.app = app
+        self.sender = sender
+        self.windows = windows or {}
+        self.channels = channels or {}
+        self.items = items
+        self.template = template
+
+        # Messages posted in the open windows, by (channel, event)
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def window(self, channel, event):
+        return self.channels.get(channel, {}).get(event, self.windows.get(event, 0))
+
+    def post_message(self, channel, event, text):
+        """Send the message, or add it to the digest of the channel if a
+        window is open for the event"""
+        window = self.window(channel, event)
+        if not window:
+            return self.sender.post_message(channel, text)
+
+        with self.lock:
+            batch = self.batches.get((channel, event))
+            if batch is not None:
+                batch.append(text)
+                return True
+
+            self.batches[(channel, event)] = []
+            timer = threading.Timer(window, self.flush, args=(channel, event))
+            timer.daemon = True
+            timer.start()
+
+        return self.sender.post_message(channel, text)
+
+    def flush(self, channel, event):
+        """Close the window, sending the messages posted during it"""
+        with self.lock:
+            messages = self.batches.pop((channel, event), [])
+
+        if len(messages) == 1:
+            self.sender.post_message(channel, messages[0])
+        elif len(messages) > 1:
+            with self.app.app_context():
+                text = render_template(self.template, event=event, channel=channel, count=len(messages),
+                                       window=self.window(channel, event),
+                                       items=[message.split('\n')[0] for message in messages[:self.items]],
+                                       more=max(len(messages) - self.items, 0))
+
+            self.sender.post_message(channel, text)
@@ -2,58 +2,1043 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from abc import ABCMeta
-from six import with_metaclass
+from six import string_types, with_metaclass
 
-from app import r as redis
+from app import app, r as redis, replica
 from app.util import camel_to_underscore
+from redis.exceptions import NoScriptError
 
 import collections
+import copy
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
 
 # String converter
 String = lambda bytes: bytes.decode('utf-8')
 
+# Patterns of numeric values, used to parse fields without a declared key
+INTEGER = re.compile(br'^[-+]?\d+$')
+FLOAT = re.compile(br'^[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?$')
+
+# Values already serialized (e.g. read from redis) are stored as given
+SERIALIZED = string_types + (bytes,)
+
+# Use redis cluster, and keep the keys of each model in a single slot
+# using hash tags (which can also be enabled without cluster, to migrate
+# the keys before moving to a cluster)
+CLUSTER = bool(app.config.get('REDIS_CLUSTER'))
+HASH_TAGS = CLUSTER or bool(app.config.get('REDIS_HASH_TAGS'))
+
+# Marker for fields deleted inside a session
+DELETED = object()
+
+# Prefix for the sets keeping the members of models and indexes
+MEMBERS_PREFIX = '__members__:'
+
+# Number of elements requested on each SCAN/SSCAN call
+SCAN_COUNT = 500
+
+# Per-thread storage for the active session
+_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+def to_bytes(value):
+    """Return the value as it is stored in redis, bytes are kept as given"""
+    if isinstance(value, bytes):
+        return value
+
+    return ('%s' % value).encode('utf-8')
+
+
+class Script(object):
+    """Lua script run with EVALSHA, called as redis.client.Script
+
+    redis-py only loads the scripts buffered in a redis.client.Pipeline, a
+    cluster pipeline sends EVALSHA without loading them and fails with
+    NOSCRIPT on a new cluster. With a cluster, the script is loaded in all
+    the primaries (SCRIPT LOAD is sent to all of them) the first time it is
+    called, and EVALSHA is sent as a plain command, so it can be buffered
+    in any pipeline.
+    """
+    def __init__(self, source):
+        self.script = source
+        self.registered = redis.register_script(source)
+        self.sha = self.registered.sha
+
+        # Cluster client where the script has been loaded
+        self.loaded = None
+
+    def __call__(self, keys=[], args=[], client=None):
+        if not CLUSTER:
+            return self.registered(keys=keys, args=args, client=client)
+
+        client = client if client is not None else redis
+        if self.loaded is not redis:
+            redis.script_load(self.script)
+            self.loaded = redis
+
+        try:
+            return client.execute_command('EVALSHA', self.sha, len(keys), *(list(keys) + list(args)))
+        except NoScriptError:
+            # The scripts of a node are lost when it restarts, load them
+            # again for the next calls
+            self.loaded = None
+            raise
+
+
+def register_script(source):
+    """Register a lua script, returning a callable that runs it with EVALSHA"""
+    return Script(source)
+
+# Lua function updating the index entries of a model field when its value
+# changes from 'old' to 'new' (false if the value has been deleted).
+#
+# Arguments: model id, index type ('unique', 'set' or 'sorted'), index prefix,
+# index members set, old value, new value
+INDEX_LUA = """
+local function update_index(id, kind, prefix, members, old, new)
+    if kind == 'sorted' then
+        if new then
+            redis.call('ZADD', prefix, new, id)
+        else
+            redis.call('ZREM', prefix, id)
+        end
+        return
+    end
+
+    if old and old ~= new then
+        if kind == 'unique' then
+            if redis.call('GET', prefix .. old) == id then
+                redis.call('DEL', prefix .. old)
+                redis.call('SREM', members, old)
+            end
+        else
+            redis.call('SREM', prefix .. old, id)
+            if redis.call('EXISTS', prefix .. old) == 0 then
+                redis.call('SREM', members, old)
+            end
+        end
+    end
+
+    if new then
+        if kind == 'unique' then
+            redis.call('SET', prefix .. new, id)
+        else
+            redis.call('SADD', prefix .. new, id)
+        end
+        redis.call('SADD', members, new)
+    end
+end
+"""
+
+# Set a field of a model hash, updating the indexes for the field
+# and the members set of the model in a single atomic operation.
+#
+# KEYS: model id, model members set
+# ARGV: field, value, then (index type, index prefix, index members set)
+# for each index
+hset_script = register_script(INDEX_LUA + """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+for i = 3, #ARGV, 3 do
+    update_index(KEYS[1], ARGV[i], ARGV[i + 1], ARGV[i + 2], old, ARGV[2])
+end
+redis.call('SADD', KEYS[2], KEYS[1])
+return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+""")
+
+# Increment a field of a model hash, updating the indexes for the field
+# and the members set of the model in a single atomic operation.
+#
+# KEYS: model id, model members set
+# ARGV: field, amount, then (index type, index prefix, index members set)
+# for each index
+hincrby_script = register_script(INDEX_LUA + """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+local value = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+for i = 3, #ARGV, 3 do
+    update_index(KEYS[1], ARGV[i], ARGV[i + 1], ARGV[i + 2], old, tostring(value))
+end
+redis.call('SADD', KEYS[2], KEYS[1])
+return value
+""")
+
+# Delete a field of a model hash, removing the index entries pointing
+# to the model and removing the model from the members set if the hash
+# no longer exists.
+#
+# KEYS: model id, model members set
+# ARGV: field, then (index type, index prefix, index members set) for each index
+hdel_script = register_script(INDEX_LUA + """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+if old then
+    for i = 2, #ARGV, 3 do
+        update_index(KEYS[1], ARGV[i], ARGV[i + 1], ARGV[i + 2], old, false)
+    end
+end
+local deleted = redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], KEYS[1])
+end
+return deleted
+""")
+
+# Delete a model hash, its index entries, its entry in the members set
+# and its counters, removing the model from the counter rankings.
+#
+# KEYS: model id, model members set, then the keys of the model counters
+# ARGV: number of indexes, (field, index type, index prefix, index members set)
+# for each index, then (ranking prefix, windows) for each counter
+delete_script = register_script(INDEX_LUA + """
+local indexes = tonumber(ARGV[1])
+for i = 2, indexes * 4 + 1, 4 do
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        update_index(KEYS[1], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], old, false)
+    end
+end
+for i = 3, #KEYS do
+    local rank = ARGV[indexes * 4 + 2 * i - 4]
+    if rank ~= '' then
+        for _, day in ipairs(redis.call('HKEYS', KEYS[i])) do
+            redis.call('ZREM', rank .. 'day:' .. day, KEYS[1])
+        end
+        for window in string.gmatch(ARGV[indexes * 4 + 2 * i - 3], '%d+') do
+            redis.call('ZREM', rank .. 'last:' .. window, KEYS[1])
+        end
+    end
+    redis.call('DEL', KEYS[i])
+end
+redis.call('SREM', KEYS[2], KEYS[1])
+return redis.call('DEL', KEYS[1])
+""")
+
+# Move the ids of a set index value to another value, adding them to the
+# ids that already have the new value, and update the members set of the
+# index. It returns the number of ids with the new value.
+#
+# KEYS: old value set, new value set, index members set
+# ARGV: old value, new value
+rename_set_script = register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return redis.call('SCARD', KEYS[2])
+end
+local count = redis.call('SUNIONSTORE', KEYS[2], KEYS[2], KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2])
+return count
+""")
+
+# Lua function adding an amount to the bucket for a day in a counter hash.
+# The hash expires if it is not written during the retention period, and
+# buckets older than the retention period are removed when a new bucket is
+# created. If the counter keeps rankings, the member score is increased in
+# the ranking of the day and in the ranking of each window that is up to date
+# for the day. It returns the new value of the bucket.
+#
+# Arguments: counter hash, member, then the values returned by Counter.args()
+COUNTER_LUA = """
+local function incr_counter(key, member, day, amount, first, expire, rank, windows)
+    amount = tonumber(amount)
+    local value = redis.call('HINCRBY', key, day, amount)
+    if value == amount then
+        for _, bucket in ipairs(redis.call('HKEYS', key)) do
+            if bucket < first then
+                redis.call('HDEL', key, bucket)
+            end
+        end
+    end
+    redis.call('EXPIRE', key, expire)
+
+    if rank ~= '' then
+        local daily = rank .. 'day:' .. day
+        redis.call('ZINCRBY', daily, amount, member)
+        redis.call('EXPIRE', daily, expire)
+
+        for window in string.gmatch(windows, '%d+') do
+            window = rank .. 'last:' .. window
+            if redis.call('GET', window .. ':day') == day then
+                redis.call('ZINCRBY', window, amount, member)
+            end
+        end
+    end
+
+    return value
+end
+"""
+
+# Increment a counter
+#
+# KEYS: counter hash
+# ARGV: member, then the values returned by Counter.args()
+counter_script = register_script(COUNTER_LUA + """
+return incr_counter(KEYS[1], unpack(ARGV))
+""")
+
+# Query the ranking of a counter for a window of days.
+#
+# The ranking of the window is rebuilt from the rankings of the days in
+# the window once a day, the first time it is queried. If it is out of
+# date and the days are not given, {0} is returned so the query can be
+# repeated with the list of days.
+#
+# KEYS: window ranking, window day marker
+# ARGV: day, 'top' or 'rank', number of results or member, then the
+# rankings of the days in the window if the ranking must be rebuilt
+ranking_script = register_script("""
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    if #ARGV == 3 then
+        return {0}
+    end
+
+    redis.call('ZUNIONSTORE', KEYS[1], #ARGV - 3, unpack(ARGV, 4))
+    redis.call('SET', KEYS[2], ARGV[1])
+end
+
+if ARGV[2] == 'top' then
+    return {1, redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[3]) - 1, 'WITHSCORES')}
+end
+
+return {1, redis.call('ZREVRANK', KEYS[1], ARGV[3]), redis.call('ZSCORE', KEYS[1], ARGV[3])}
+""")
+
+
+class Session(object):
+    """Unit of work for model and index writes
+
+    While a session is active, writes performed through Model and Index
+    objects are buffered in memory instead of being sent to redis one command
+    at a time. When the outermost session exits, all the buffered commands are
+    sent to redis as a single MULTI/EXEC pipeline. If the block raises an
+    exception, the buffered commands are discarded.
+
+    Indexed fields are written with the same scripts used outside a session,
+    so the whole transaction is still a single round trip.
+
+    Buffered values are kept in a local overlay so reads of fields written
+    inside the session return the new value. Reads that the overlay cannot
+    answer (incremented fields, iteration, index lookups on modified indexes)
+    flush the buffered commands first, so the mapping semantics of models
+    stay the same as outside a session.
+
+    Example:
+
+    ```
+    with redis.session():
+        for name in names:
+            user = User(name)
+            user.email = emails[name]
+    ```
+    """
+    def __init__(self):
+        self.depth = 0
+        self.reset()
+
+        # Keys (or (key, field) pairs) written since the session started,
+        # including the commands already flushed. Their reads go to the
+        # primary, the rest to the replica (see reader())
+        self.written = set()
+
+    def reset(self):
+        """Discard all the buffered commands"""
+        # A cluster cannot run a transaction over several slots, there
+        # the commands are pipelined but each script is still atomic
+        self.pipeline = redis.pipeline(transaction=not CLUSTER)
+
+        # Values of hash fields written in the session
+        self.fields = {}
+
+        # Keys (or (key, field) pairs) with buffered commands
+        self.touched = set()
+
+        # Keys (or (key, field) pairs) whose value cannot be known
+        # without flushing the session
+        self.unknown = set()
+
+    def __enter__(self):
+        if self.depth == 0:
+            _local.session = self
+
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth > 0:
+            return False
+
+        _local.session = None
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                self.pipeline.reset()
+                self.reset()
+        finally:
+            self.written = set()
+
+        return False
+
+    def field(self, id, key):
+        """Return the value of the field from the overlay
+
+        It returns DELETED if the field has been deleted in the session. If
+        the value is not known, the session is flushed if needed and KeyError
+        is raised, so the caller should read the value from redis
+        """
+        fields = self.fields.get(id, {})
+        if key in fields:
+            return fields[key]
+
+        if id in self.unknown or (id, key) in self.unknown:
+            self.flush()
+
+        raise KeyError(key)
+
+    def sync(self, *keys):
+        """Flush the session if any of the keys has buffered commands"""
+        if any(key in self.touched for key in keys):
+            self.flush()
+
+    def dirty(self, *keys):
+        """Return True if any of the keys has been written in the session"""
+        return any(key in self.touched or key in self.written for key in keys)
+
+    def hset(self, model, key, value):
+        if key in model.__indexes__:
+            # Indexed fields are updated with the script, the index
+            # cannot be read until the session is flushed
+            model.__hset__(self.pipeline, key, value)
+            self.touched.add(model.__indexes__[key].__prefix__)
+        else:
+            if model.id not in self.touched:
+                self.pipeline.sadd(model.__members__, model.id)
+
+            self.pipeline.hset(model.id, key, value)
+
+        self.fields.setdefault(model.id, {})[key] = value
+        self.touched.update([model.id, model.__prefix__])
+
+    def hdel(self, model, key):
+        model.__hdel__(self.pipeline, key)
+        self.fields.setdefault(model.id, {})[key] = DELETED
+        self.touched.update([model.id, model.__prefix__])
+
+        if key in model.__indexes__:
+            self.touched.add(model.__indexes__[key].__prefix__)
+
+    def hincrby(self, model, key, amount):
+        if key in model.__indexes__:
+            model.__hincrby__(self.pipeline, key, amount)
+            self.touched.add(model.__indexes__[key].__prefix__)
+        else:
+            if model.id not in self.touched:
+                self.pipeline.sadd(model.__members__, model.id)
+
+            self.pipeline.hincrby(model.id, key, amount)
+        self.fields.get(model.id, {}).pop(key, None)
+        self.touched.update([model.id, model.__prefix__])
+        self.unknown.add((model.id, key))
+
+    def delete(self, model):
+        model.__remove__(self.pipeline)
+        self.fields.pop(model.id, None)
+        self.touched.update([model.id, model.__prefix__])
+        self.touched.update(counter.key(model) for counter in model.__counters__.values())
+        self.touched.update(index.__prefix__ for index in model.__indexes__.values())
+        self.unknown.add(model.id)
+
+    def script(self, script, keys, args, models):
+        """Buffer a call to a script modifying the given keys and models"""
+        script(keys=keys, args=args, client=self.pipeline)
+        self.touched.update(keys)
+        for model in models:
+            self.fields.pop(model.id, None)
+            self.touched.update([model.id, model.__prefix__])
+            self.unknown.add(model.id)
+
+    def writer(self, index):
+        """Return the pipeline to buffer operations on the index"""
+        self.touched.add(index.__prefix__)
+        return self.pipeline
+
+    def flush(self):
+        """Send the buffered commands to redis as a single transaction"""
+        try:
+            if len(self.pipeline) > 0:
+                return self.pipeline.execute()
+            return []
+        finally:
+            self.written.update(self.touched)
+            self.reset()
+
+
+def session():
+    """Return the active session or create a new one
+
+    Sessions are reentrant, nested 'with redis.session()' blocks share
+    the outermost session, which is the only one flushing on exit
+    """
+    current = current_session()
+    return current if current is not None else Session()
+
+
+def current_session():
+    """Return the session active in the current thread, if any"""
+    return getattr(_local, 'session', None)
+
+
+def reader(*keys):
+    """Return the client for reads of the given keys
+
+    Reads go to the replica if one is configured, so they may not see the
+    latest writes. Inside a session, reads of keys written in the session
+    go to the primary, so they see the writes of the session
+    """
+    session = current_session()
+    return redis if session is not None and session.dirty(*keys) else replica
+
+
+class Trace(object):
+    """Commands sent to redis by a thread and time spent waiting for them
+
+    Totals are kept for the whole trace and for each operation, which is the
+    outermost method of a model, index, counter or query in the stack when
+    the commands are sent (e.g. 'User.findBy'). A pipeline counts as a
+    single round trip with all its commands.
+
+    Example:
+
+    ```
+    with redis.tracing() as trace:
+        User.findBy('email', email)
+
+    trace.round_trips
+    ```
+
+    Nested traces also add their totals to the enclosing trace when they stop.
+    """
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+        self.time = 0.0
+
+        # [round trips, commands, time] for each operation
+        self.operations = {}
+
+        # Number of times each command was sent
+        self.calls = {}
+        self.previous = None
+        self.active = False
+
+    def start(self):
+        self.previous = current_trace()
+        self.active = True
+        _local.trace = self
+        return self
+
+    def stop(self):
+        if self.active:
+            self.active = False
+            _local.trace = self.previous
+            if self.previous is not None:
+                self.previous.merge(self)
+
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def record(self, names, elapsed):
+        """Add a round trip with the names of its commands and the time it took"""
+        self.round_trips += 1
+        self.commands += len(names)
+        self.time += elapsed
+
+        stats = self.operations.setdefault(operation(), [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += len(names)
+        stats[2] += elapsed
+
+        for name in names:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def merge(self, other):
+        self.round_trips += other.round_trips
+        self.commands += other.commands
+        self.time += other.time
+        for name, (round_trips, commands, elapsed) in other.operations.items():
+            stats = self.operations.setdefault(name, [0, 0, 0.0])
+            stats[0] += round_trips
+            stats[1] += commands
+            stats[2] += elapsed
+
+        for name, count in other.calls.items():
+            self.calls[name] = self.calls.get(name, 0) + count
+
+    def details(self):
+        """Return the totals of each operation, most expensive first"""
+        return ', '.join('%s: %d/%d/%.1fms' % (name, stats[0], stats[1], stats[2] * 1000)
+                         for name, stats in sorted(self.operations.items(), key=lambda item: -item[1][2]))
+
+    def breakdown(self):
+        """Return the number of times each command was sent, most sent first"""
+        return ', '.join('%s: %d' % (name, count)
+                         for name, count in sorted(self.calls.items(), key=lambda item: (-item[1], item[0])))
+
+    def __str__(self):
+        return '%d round trips, %d commands, %.1fms' % (self.round_trips, self.commands, self.time * 1000)
+
+
+def tracing():
+    """Return a trace recording the commands sent by the current thread"""
+    return Trace()
+
+
+def current_trace():
+    """Return the trace active in the current thread, if any"""
+    return getattr(_local, 'trace', None)
+
+
+def operation():
+    """Return the name of the outermost model, index, counter or query method
+    in the stack of the current thread"""
+    name = 'other'
+    frame = sys._getframe(2)
+    while frame is not None:
+        owner = frame.f_locals.get('self', frame.f_locals.get('cls'))
+        if isinstance(owner, type) and issubclass(owner, Model):
+            name = '%s.%s' % (owner.__name__, frame.f_code.co_name)
+        elif isinstance(owner, (Model, Index, SortedIndex, Counter, BoundCounter, Query)):
+            name = '%s.%s' % (type(owner).__name__, frame.f_code.co_name)
+
+        frame = frame.f_back
+
+    return name
+
+
+def instrument(client):
+    """Record the commands sent by the client in the active trace
+
+    Commands are sent through execute_command(), or by executing a
+    pipeline, both are wrapped in the client object
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def traced_execute_command(*args, **options):
+        trace = current_trace()
+        if trace is None:
+            return execute_command(*args, **options)
+
+        start = time.time()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            trace.record([command_name(args[0])], time.time() - start)
+
+    def traced_pipeline(*args, **kwargs):
+        instance = pipeline(*args, **kwargs)
+        execute = instance.execute
+        buffer = instance.execute_command
+
+        # Names of the commands buffered since the last execution
+        names = []
+
+        def traced_buffer(*args, **options):
+            names.append(command_name(args[0]))
+            return buffer(*args, **options)
+
+        def traced_execute(*args, **kwargs):
+            trace = current_trace()
+            commands = len(instance)
+            sent = names[len(names) - commands:] if commands > 0 else []
+            del names[:]
+            if trace is None or commands == 0:
+                return execute(*args, **kwargs)
+
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                trace.record(sent, time.time() - start)
+
+        instance.execute_command = traced_buffer
+        instance.execute = traced_execute
+        return instance
+
+    client.execute_command = traced_execute_command
+    client.pipeline = traced_pipeline
+
+
+def command_name(name):
+    """Return the command name as sent in the first argument of execute_command()"""
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+
+    return name.upper()
+
+
+instrument(redis)
+if replica is not redis:
+    instrument(replica)
+
+
+def execute_script(script, keys=[], args=[], models=[]):
+    """Run a registered script, or buffer it if a session is active
+
+    The script must only modify the given keys and the hashes of the given
+    models. The snapshots of the models are discarded, and inside a session
+    reads of those models and keys flush the session first. Inside a session
+    the result is not available and None is returned.
+    """
+    for model in models:
+        model.__invalidate__()
+
+    session = current_session()
+    if session:
+        return session.script(script, keys, args, models)
+
+    return script(keys=keys, args=args)
+
+
+class Counter(object):
+    """Counter defines a rolling counter for a model
+
+    Counts are stored in daily buckets, as fields of a hash per model. Reading
+    the count for the last N days reads N buckets, without resetting anything
+    on writes. Buckets older than 'retention' days are removed, and the hash
+    expires if the model is not counted for that long.
+
+    Example:
+
+    ```
+    class User(redis.Model):
+        name = redis.Key(primary=True)
+        commits = redis.Counter(retention=366)
 
-class Key:
+    user.commits.incr(3)
+    user.commits.last(7)
+    ```
+
+    If 'windows' is given, the counter also keeps a sorted set ranking the
+    models for each window of days. The ranking for a window is rebuilt from
+    the daily rankings once a day and kept up to date by incr(), so top()
+    and rank() run in logarithmic time.
+    """
+    def __init__(self, retention=366, prefix='', windows=()):
+        self.retention = retention
+        self.prefix = prefix
+        self.windows = windows
+
+    @property
+    def rank_prefix(self):
+        """Prefix of the ranking keys of the counter, empty if rankings are not kept"""
+        return self.prefix + '__rank__:' if self.windows else ''
+
+    def __get__(self, model, cls):
+        if model is None:
+            return self
+
+        return BoundCounter(self, model)
+
+    def key(self, model):
+        """Return the key of the counter hash for the model"""
+        return self.prefix + model.id
+
+    def day(self, now=None):
+        """Return the bucket name for the date"""
+        return (now if now else datetime.now()).strftime('%Y%m%d')
+
+    def days(self, days, now=None):
+        """Return the bucket names for the last 'days' days"""
+        now = now if now else datetime.now()
+        return [self.day(now - timedelta(days=i)) for i in range(days)]
+
+    def args(self, amount, now=None):
+        """Return the arguments of COUNTER_LUA to add 'amount' to the bucket for the date"""
+        now = now if now else datetime.now()
+        return [self.day(now), amount, self.day(now - timedelta(days=self.retention - 1)),
+                (self.retention + 1) * 86400] + self.ranking_args()
+
+    def ranking_args(self):
+        """Return the ranking prefix and the windows as passed to the scripts"""
+        return [self.rank_prefix, ','.join('%d' % window for window in self.windows)]
+
+    def __ranking__(self, days, query, param, now=None):
+        """Run ranking_script for the window, rebuilding it if needed"""
+        if days not in self.windows:
+            raise AttributeError("No ranking has been defined for the last %d days" % days)
+
+        window = self.rank_prefix + 'last:%d' % days
+        args = [self.day(now), query, param]
+
+        session = current_session()
+        if session:
+            # Rankings can be changed by any buffered write
+            session.flush()
+
+        result = ranking_script(keys=[window, window + ':day'], args=args)
+        if result[0] == 0:
+            # The window is out of date, rebuild it from the days
+            args += [self.rank_prefix + 'day:' + day for day in self.days(days, now)]
+            result = ranking_script(keys=[window, window + ':day'], args=args)
+
+        return result[1:]
+
+    def top(self, days, n=10, now=None):
+        """Return a list of (id, count) with the 'n' models with the highest
+        count for the last 'days' days"""
+        values = self.__ranking__(days, 'top', n, now)[0]
+        return [(values[i].decode('utf-8'), int(float(values[i + 1])))
+                for i in range(0, len(values), 2)]
+
+    def deleteall(self, members):
+        """Delete the counter hashes of the models in the members set and the
+        rankings of the counter
+
+        The daily rankings deleted are those of the buckets found in the
+        counter hashes, which are kept for the same retention period
+        """
+        days = set()
+        batch = []
+        for id in redis.sscan_iter(members, count=SCAN_COUNT):
+            batch.append(self.prefix + id.decode('utf-8'))
+            if len(batch) >= SCAN_COUNT:
+                days.update(self.__delete__(batch))
+                batch = []
+
+        if len(batch) > 0:
+            days.update(self.__delete__(batch))
+
+        if self.rank_prefix:
+            keys = [self.rank_prefix + 'day:' + day for day in days]
+            for window in self.windows:
+                keys += [self.rank_prefix + 'last:%d' % window, self.rank_prefix + 'last:%d:day' % window]
+            redis.delete(*keys)
+
+    def __delete__(self, keys):
+        """Delete the counter hashes, returning the days of their buckets"""
+        pipeline = redis.pipeline(transaction=False)
+        if self.rank_prefix:
+            for key in keys:
+                pipeline.hkeys(key)
+        pipeline.delete(*keys)
+
+        return set(day.decode('utf-8') for buckets in pipeline.execute()[:-1] for day in buckets)
+
+
+class BoundCounter(object):
+    """Counter for a model instance"""
+    def __init__(self, counter, model):
+        self.counter = counter
+        self.model = model
+
+    def incr(self, amount=1, now=None):
+        """Add amount to the bucket for the date (today by default)"""
+        return execute_script(counter_script,
+                              keys=[self.counter.key(self.model)],
+                              args=[self.model.id] + self.counter.args(amount, now))
+
+    def rank(self, days, now=None):
+        """Return the position (starting from 1) of the model in the ranking
+        for the last 'days' days, or None if the model has no count"""
+        rank, score = self.counter.__ranking__(days, 'rank', self.model.id, now)
+        return rank + 1 if rank is not None else None
+
+    def last(self, days, now=None):
+        """Return the count for the last 'days' days, including today"""
+        key = self.counter.key(self.model)
+
+        session = current_session()
+        if session:
+            session.sync(key)
+
+        return sum(int(value) for value in reader(key).hmget(key, self.counter.days(days, now)) if value)
+
+    def __getitem__(self, day):
+        """Return the count for the bucket of the date"""
+        key = self.counter.key(self.model)
+        value = reader(key).hget(key, self.counter.day(day))
+        return int(value) if value else 0
+
+
+class Key(object):
     """Key defines an the configuration of an attribute for a model
 
-    It provides a converter to parse the value from redis
+    It provides a converter to parse the value from redis, and an encoder
+    to format the value before storing it
+
+    The index can be True (or 'unique') for an index where each value belongs
+    to a single model, 'set' for values shared by many models, or 'sorted'
+    for numeric values that can be queried by range.
+
+    Keys are data descriptors, reading or writing the attribute in a model
+    reads or writes the field with the same name
     """
     def __init__(self, converter=String, primary=False, index=False, prefix=''):
         self.__converter__ = converter
         self.primary = primary
         self.index = index
         self.prefix = prefix
+        self.name = None
 
     def __call__(self, value):
         """Convert the string using the specified converter"""
         return self.__converter__(value)
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return instance.__getitem__(self.name)
+
+    def __set__(self, instance, value):
+        instance.__setitem__(self.name, value)
+
+    def __delete__(self, instance):
+        instance.__delitem__(self.name)
+
+    def encode(self, value):
+        """Format the value to store it in redis, strings and bytes are
+        taken as already formatted by all the keys"""
+        return value
+
+
+class Int(Key):
+    """Key for integer values"""
+    def __init__(self, **kwargs):
+        Key.__init__(self, converter=int, **kwargs)
+
+    def encode(self, value):
+        if isinstance(value, SERIALIZED):
+            return value
+
+        return '%d' % value
+
+
+class Float(Key):
+    """Key for float values"""
+    def __init__(self, **kwargs):
+        Key.__init__(self, converter=float, **kwargs)
+
+    def encode(self, value):
+        if isinstance(value, SERIALIZED):
+            return value
+
+        return repr(float(value))
+
+
+class Bool(Key):
+    """Key for boolean values, stored as 1 or 0"""
+    def __init__(self, **kwargs):
+        Key.__init__(self, converter=lambda value: value == b'1', **kwargs)
+
+    def encode(self, value):
+        if isinstance(value, SERIALIZED):
+            return value
+
+        return '1' if value else '0'
+
+
+class DateTime(Key):
+    """Key for datetime values, stored as a unix timestamp in local time
+
+    If format is given, values stored as strings with that format
+    (from older versions) are also parsed
+    """
+    def __init__(self, format=None, **kwargs):
+        Key.__init__(self, converter=self.parse, **kwargs)
+        self.format = format
+
+    def parse(self, value):
+        if self.format and FLOAT.match(value) is None:
+            return datetime.strptime(value.decode('utf-8'), self.format)
+
+        return datetime.fromtimestamp(float(value))
+
+    def encode(self, value):
+        if isinstance(value, SERIALIZED):
+            return value
+
+        if isinstance(value, datetime):
+            return repr(time.mktime(value.timetuple()) + value.microsecond / 1e6)
+
+        return repr(float(value))
+
+
+class JSON(Key):
+    """Key for values serialized as JSON, strings are stored as given so
+    they must be JSON documents"""
+    def __init__(self, **kwargs):
+        Key.__init__(self, converter=lambda value: json.loads(value.decode('utf-8')), **kwargs)
+
+    def encode(self, value):
+        if isinstance(value, SERIALIZED):
+            return value
+
+        return json.dumps(value, separators=(',', ':'))
+
 
 class Index(collections.MutableMapping):
     """Defines an index on redis with an optional relationship
 
     An index basically behaves as a dictionary, where all dictionary
     operations apply
+
+    The values of the index are also kept in a set, used for iterating
+    and counting the index without scanning the keyspace
     """
+    __type__ = 'unique'
+
     def __init__(self, prefix='', relationship=None):
         self.__prefix__ = prefix
         self.__relationship__ = relationship
+        self.__members__ = MEMBERS_PREFIX + prefix
 
     def __getitem__(self, key):
-        value = redis.get(self.__keytransform__(key))
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        value = reader(self.__prefix__).get(self.__keytransform__(key))
 
         if value and self.__relationship__:
-            # Create an object of the specified relationship
-            return self.__relationship__(value.decode())
+            # Create an object of the specified relationship, without
+            # writing its primary key
+            return self.__relationship__.__lazy__(self.__relationship__.__id__(value.decode('utf-8')))
 
         return value
 
+    def aget(self, key):
+        """Asyncio version of index[key] (python 3 only), models are returned loaded"""
+        from app import aio
+        return aio.get(self, key)
+
     def __setitem__(self, key, value):
         if isinstance(value, Model):
             # If the value is a model , use the id
             value = value.id
 
-        return redis.set(self.__keytransform__(key), value)
+        session = current_session()
+        if session:
+            return self.__write__(session.writer(self), key, value)
+
+        pipeline = redis.pipeline()
+        self.__write__(pipeline, key, value)
+        return pipeline.execute()[0]
 
     def __keytransform__(self, key):
         if not key.startswith(self.__prefix__):
@@ -61,59 +1046,312 @@ class Index(collections.MutableMapping):
 
         return key
 
+    def __valuetransform__(self, key):
+        """Return the key without the index prefix, as stored in the members set"""
+        if key.startswith(self.__prefix__):
+            return key[len(self.__prefix__):]
+
+        return key
+
+    def __write__(self, client, key, value):
+        """Queue the commands setting the key in the client or pipeline"""
+        client.set(self.__keytransform__(key), value)
+        client.sadd(self.__members__, self.__valuetransform__(key))
+
+    def __remove__(self, client, key):
+        """Queue the commands deleting the key in the client or pipeline"""
+        client.delete(self.__keytransform__(key))
+        client.srem(self.__members__, self.__valuetransform__(key))
+
     def __delitem__(self, key):
-        return redis.delete(self.__keytransform__(key))
+        session = current_session()
+        if session:
+            return self.__remove__(session.writer(self), key)
+
+        pipeline = redis.pipeline()
+        self.__remove__(pipeline, key)
+        return pipeline.execute()[0]
 
     def __iter__(self):
-        return iter(map(lambda s: s.decode('utf-8')[len(self.__prefix__):], redis.keys(self.__prefix__ + '*')))
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        # Iterate the members set incrementally
+        for value in reader(self.__prefix__).sscan_iter(self.__members__, count=SCAN_COUNT):
+            yield value.decode('utf-8')
 
     def __len__(self):
-        return len(redis.keys(self.__prefix__ + '*'))
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return reader(self.__prefix__).scard(self.__members__)
 
     def __contains__(self, key):
-        return redis.exists(self.__keytransform__(key))
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return reader(self.__prefix__).exists(self.__keytransform__(key))
 
     def rename(self, old, new):
-        return redis.rename(self.__keytransform__(old), self.__keytransform__(new))
+        session = current_session()
+        pipeline = session.writer(self) if session else redis.pipeline()
+
+        pipeline.rename(self.__keytransform__(old), self.__keytransform__(new))
+        pipeline.srem(self.__members__, self.__valuetransform__(old))
+        pipeline.sadd(self.__members__, self.__valuetransform__(new))
+
+        if not session:
+            return pipeline.execute()[0]
 
     def deleteall(self):
-        keys = redis.keys(self.__prefix__ + '*')
-        if len(keys) > 0:
-            return redis.delete(*keys)
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return delete_members(self.__members__, self.__keytransform__)
+
+    def rebuild(self):
+        """Rebuild the members set from the keys in the database
+
+        It walks the keyspace using SCAN, so it is only needed to
+        migrate indexes created before members sets were used
+        """
+        return rebuild_members(self.__members__, self.__prefix__, self.__valuetransform__)
+
+
+class SetIndex(Index):
+    """Defines an index for values shared by many models
+
+    Each value of the index is stored as a set with the ids of the models
+    having that value, so reading a value returns a list
+    """
+    __type__ = 'set'
+
+    def __getitem__(self, key):
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        ids = [id.decode('utf-8') for id in reader(self.__prefix__).smembers(self.__keytransform__(key))]
+        if self.__relationship__:
+            return [self.__relationship__.__lazy__(id) for id in ids]
+
+        return ids
+
+    def __write__(self, client, key, value):
+        """Queue the commands adding the value to the key in the client or pipeline"""
+        client.sadd(self.__keytransform__(key), value)
+        client.sadd(self.__members__, self.__valuetransform__(key))
+
+    def count(self, key):
+        """Return the number of models with the value"""
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return reader(self.__prefix__).scard(self.__keytransform__(key))
+
+    def rename(self, old, new):
+        """Move the ids with the value 'old' to the value 'new', merging them
+        with the ids that already have it. As with unique indexes, the
+        fields of the models are not changed"""
+        session = current_session()
+        client = session.writer(self) if session else None
+
+        count = rename_set_script(keys=[self.__keytransform__(old), self.__keytransform__(new), self.__members__],
+                                  args=[self.__valuetransform__(old), self.__valuetransform__(new)], client=client)
+        if not session:
+            return count
+
+
+class SortedIndex(object):
+    """Defines an index for numeric values, stored as a sorted set
+
+    It allows to find the models with values in a range in logarithmic time
+    """
+    __type__ = 'sorted'
+
+    def __init__(self, prefix='', relationship=None):
+        self.__prefix__ = prefix
+        self.__relationship__ = relationship
+        self.__members__ = ''
+
+    def __getitem__(self, value):
+        return self.range(value, value)
+
+    def __len__(self):
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return reader(self.__prefix__).zcard(self.__prefix__)
+
+    def __iter__(self):
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        for id, score in reader(self.__prefix__).zscan_iter(self.__prefix__, count=SCAN_COUNT):
+            yield id.decode('utf-8')
+
+    def range(self, min='-inf', max='+inf', start=None, num=None):
+        """Return the models with values between min and max (inclusive), ordered by value"""
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        ids = [id.decode('utf-8') for id in reader(self.__prefix__).zrangebyscore(self.__prefix__, min, max, start=start, num=num)]
+        if self.__relationship__:
+            return [self.__relationship__.__lazy__(id) for id in ids]
 
+        return ids
+
+    def aget(self, value):
+        """Asyncio version of index[value] (python 3 only), models are returned loaded"""
+        from app import aio
+        return aio.range(self, value, value)
+
+    def arange(self, min='-inf', max='+inf', start=None, num=None):
+        """Asyncio version of range() (python 3 only), models are returned loaded"""
+        from app import aio
+        return aio.range(self, min, max, start=start, num=num)
+
+    def count(self, min='-inf', max='+inf'):
+        """Return the number of models with values between min and max"""
+        session = current_session()
+        if session:
+            session.sync(self.__prefix__)
+
+        return reader(self.__prefix__).zcount(self.__prefix__, min, max)
+
+    def deleteall(self):
+        return redis.delete(self.__prefix__)
+
+    def rebuild(self):
+        """Sorted indexes are rebuilt from the values of the models by Model.rebuild()"""
         return 0
 
 
+# Index class for each value of Key.index
+INDEXES = {
+    True: Index,
+    'unique': Index,
+    'set': SetIndex,
+    'sorted': SortedIndex
+}
+
+
+def delete_members(members, keytransform=lambda key: key, count=SCAN_COUNT):
+    """Delete all the keys listed in the members set and the set itself
+
+    Keys are deleted in batches of 'count' elements while scanning the set
+    """
+    deleted = 0
+    batch = []
+    for member in redis.sscan_iter(members, count=count):
+        batch.append(keytransform(member.decode('utf-8')))
+        if len(batch) >= count:
+            deleted += redis.delete(*batch)
+            batch = []
+
+    if len(batch) > 0:
+        deleted += redis.delete(*batch)
+
+    redis.delete(members)
+    return deleted
+
+
+def rebuild_members(members, prefix, valuetransform=lambda key: key, count=SCAN_COUNT):
+    """Add the keys matching the prefix to the members set using SCAN"""
+    added = 0
+    batch = []
+    for key in redis.scan_iter(match=prefix + '*', count=count):
+        key = key.decode('utf-8')
+        if key.startswith(MEMBERS_PREFIX):
+            continue
+
+        batch.append(valuetransform(key))
+        if len(batch) >= count:
+            added += redis.sadd(members, *batch)
+            batch = []
+
+    if len(batch) > 0:
+        added += redis.sadd(members, *batch)
+
+    return added
+
+
 class ModelType(type):
     pass
 
 
 class ModelMeta(ModelType, ABCMeta):
     def __new__(mcl, name, bases, attrs):
+        # Model state is kept in slots, fields are only available through
+        # the declared keys or with item access
+        attrs.setdefault('__slots__', ())
         cls = super(ModelMeta, mcl).__new__(mcl, name, bases, attrs)
 
         # Get the model configuration
         cls.__keys__ = {}
+        cls.__decoders__ = {}
+        cls.__encoders__ = {}
         cls.__indexes__ = {}
+        cls.__counters__ = {}
         cls.__prefix__ = cls.__prefix__ if hasattr(cls, '__prefix__') else None
         cls.__primary__ = None
-        for name in cls.__dict__:
+
+        # Hash tag prepended to all the keys of the model, so they are
+        # stored in the same cluster slot
+        hashtag = cls.__hashtag__ if cls.__hashtag__ is not None else HASH_TAGS
+        tag = '{%s}' % camel_to_underscore(cls.__name__) if hashtag else ''
+        if '__prefix__' in attrs and cls.__prefix__ is not None:
+            cls.__prefix__ = tag + cls.__prefix__
+        cls.__tag__ = tag
+
+        for name in list(cls.__dict__):
             if isinstance(cls.__dict__[name], Key):
                 key = cls.__dict__[name]
+                key.name = name
                 cls.__keys__[name] = key
 
+                if name == 'id':
+                    # The attribute is reserved for the model id, the
+                    # field can only be accessed with model['id']
+                    delattr(cls, name)
+
+                # Converter tables used on reads and writes
+                cls.__decoders__[name] = key.__converter__
+                if type(key).encode is not Key.encode:
+                    cls.__encoders__[name] = key.encode
+
                 if key.primary:
                     if cls.__primary__ is not None:
                         raise AttributeError("Only one primary index can be defined")
 
                     # Use 'modelname:' as prefix by default
-                    cls.__prefix__ = key.prefix if key.prefix else camel_to_underscore(cls.__name__) + ':'
+                    cls.__prefix__ = tag + (key.prefix if key.prefix else camel_to_underscore(cls.__name__) + ':')
                     cls.__primary__ = name
 
                 elif key.index:
-                    index = Index(prefix=key.prefix if key.prefix else camel_to_underscore(cls.__name__) + '_' + name + ':', relationship=cls)
+                    if key.index not in INDEXES:
+                        raise AttributeError("Unknown index type '%s' for key '%s'" % (key.index, name))
+
+                    index = INDEXES[key.index](prefix=tag + (key.prefix if key.prefix else camel_to_underscore(cls.__name__) + '_' + name + ':'), relationship=cls)
                     cls.__indexes__[name] = index
 
+            elif isinstance(cls.__dict__[name], Counter):
+                counter = cls.__dict__[name]
+                counter.prefix = tag + (counter.prefix if counter.prefix else camel_to_underscore(cls.__name__) + '_' + name + ':')
+
+                cls.__counters__[name] = counter
+
+        # Set with the ids of the stored models
+        cls.__members__ = MEMBERS_PREFIX + cls.__prefix__ if cls.__prefix__ is not None else None
+
         return cls
 
 
@@ -123,17 +1361,32 @@ class Model(with_metaclass(ModelMeta, collections.MutableMapping)):
 
     Implementing classes must define either a __prefix__ attribute to identify the id
     of the model, or a key with primary=True defined, which will be used as id for the model
+
+    Models are lazy by default, every read is a query to redis. Calling load() (or
+    fetching the models with get_many()) stores a snapshot of the whole hash, which is
+    used for later reads until refresh() is called or the snapshot becomes older than
+    __ttl__ seconds (if defined). Writes through the model update the snapshot, but
+    changes performed by other processes are not seen until the snapshot is refreshed.
     """
 
+    # Seconds that a loaded snapshot is considered valid. None means that the
+    # snapshot is valid until refresh() is called
+    __ttl__ = None
+
+    # Whether to prepend a hash tag with the model name to all the keys of the
+    # model, keeping them in the same cluster slot. None follows the configuration
+    __hashtag__ = None
+
+    __slots__ = ('id', '__data__', '__stale__', '__loaded__')
+
     def __init__(self, id):
         if not hasattr(self, '__prefix__'):
             raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
 
-        value = id
-        if not id.startswith(self.__prefix__):
-            id = self.__prefix__ + id
-        else:
-            value = id[len(self.__prefix__):]
+        self.__data__ = None
+
+        id = self.__id__(id)
+        value = id[len(self.__prefix__):]
 
         self.id = id
 
@@ -142,114 +1395,173 @@ class Model(with_metaclass(ModelMeta, collections.MutableMapping)):
         if self.__primary__:
             self.__setitem__(self.__primary__, value)
 
-    def __getattribute__(self, name):
-        try:
-            attr = super(Model, self).__getattribute__(name)
-            if isinstance(attr, Key):
-                # If the attribute is a key. return the key value instead
-                # of the key object
-                return self.__getitem__(name)
-            return attr
-        except AttributeError:
-            return self.__getitem__(name)
-
     def __setattr__(self, name, value):
         """Set the attribute with the value given by 'value'
 
-        It works by calling self.__setitem__ with a couple of exceptions
-        if the attribute name is 'id', it can only be set if it has not been set
-        before.
+        Declared keys and properties are handled by their descriptors. The
+        attribute 'id' can only be set if it has not been set before
+        """
+        if name == 'id' and hasattr(self, 'id'):
+            # Cannot change id (TODO: use redis.rename()?)
+            raise AttributeError("The model id cannot be changed")
 
-        If a property setter has been defined for the inheriting class with the same
-        name as the key, then the method calls the property setter first.
+        super(Model, self).__setattr__(name, value)
 
-        Property setters must take care to set the actual value using self[name] to
-        avoid infinite loops
-        """
-        if name == 'id':
-            if name in self.__dict__:
-                # Cannot change id (TODO: use redis.rename()?)
-                raise AttributeError("The model id cannot be changed")
-            else:
-                self.__dict__[name] = value
-                return True
+    def __getitem__(self, key):
+        return self.__convert__(key, self.__raw__(key))
 
-        cls = self.__class__
+    def __raw__(self, key):
+        """Return the value of the key as stored in redis
 
-        # Check if there are property setter.
-        # This only works if the property setter has the same name as the property
-        if hasattr(cls, name) and \
-                isinstance(cls.__dict__[name], property):
-            try:
-                cls.__dict__[name].__set__(self, value)
-                return True
-            except AttributeError:
-                # No setter with the same name defined
-                pass
+        The value written in the active session has precedence, then the value
+        from the snapshot if it is valid, otherwise the value is read from redis
+        """
+        session = current_session()
+        try:
+            if session is None:
+                raise KeyError(key)
 
-        return self.__setitem__(name, value)
+            # Use the value written in the session if any
+            value = session.field(self.id, self.__keytransform__(key))
+            return None if value is DELETED else to_bytes(value)
+        except KeyError:
+            pass
 
-    def __getitem__(self, key):
-        value = redis.hget(self.id, self.__keytransform__(key))
+        data = self.__snapshot__()
+        if data is not None and self.__keytransform__(key) not in self.__stale__:
+            return data.get(self.__keytransform__(key))
+
+        return reader(self.id).hget(self.id, self.__keytransform__(key))
 
+    def __convert__(self, key, value):
+        """Convert a value read from redis using the configuration for the key"""
         # If the value is none
         if not value:
             return None
 
-        if key in self.__keys__:
+        decoder = self.__decoders__.get(key)
+        if decoder is not None:
             # Use the converter specified by the
             # key configuration
-            return self.__keys__[key](value)
+            return decoder(value)
 
-        # Try to parse numeric types
-        parsers = [int, float]
-        for parse in parsers:
-            try:
-                return parse(value)
-            except ValueError:
-                pass
+        # Parse numeric types
+        if INTEGER.match(value):
+            return int(value)
+
+        if FLOAT.match(value):
+            return float(value)
 
         return value.decode('utf-8')
 
+    @classmethod
+    def __encode__(cls, key, value):
+        """Format a value using the encoder of the key, if any"""
+        encoder = cls.__encoders__.get(key)
+        return encoder(value) if encoder is not None else value
+
     def __setitem__(self, key, value):
+        # The primary key is the suffix of the id, so it can be checked
+        # without querying the database
         if self.__primary__ and key == self.__primary__ and \
-                self.__contains__(key) and self.__getitem__(key) != value:
+                '%s' % value != self.id[len(self.__prefix__):]:
             raise AttributeError("The item '%s' of model %s has been set as primary, thus it cannot be changed" % (key, self.__class__.__name__))
 
-        if key in self.__indexes__:
-            oldvalue = self.__getitem__(key)
-            # If the value has already used as a key
-            if oldvalue and oldvalue != value and \
-                    oldvalue in self.__indexes__[key] and \
-                    self.__indexes__[key][oldvalue] == self:
-                # Use rename to update the index
-                self.__indexes__[key].rename(oldvalue, value)
-            else:
-                # Otherwise update the index
-                self.__indexes__[key][value] = self
+        value = self.__encode__(key, value)
+        self.__update__(key, value)
+
+        session = current_session()
+        if session:
+            return session.hset(self, self.__keytransform__(key), value)
 
-        return redis.hset(self.id, self.__keytransform__(key), value)
+        return self.__hset__(redis, self.__keytransform__(key), value)
 
     def __delitem__(self, key):
-        if key in self.__indexes__:
-            oldvalue = self.__getitem__(key)
-            # If the key is an index, delete the index
-            if oldvalue:
-                del self.__indexes__[key][oldvalue]
+        self.__update__(key, DELETED)
+
+        session = current_session()
+        if session:
+            return session.hdel(self, self.__keytransform__(key))
+
+        return self.__hdel__(redis, self.__keytransform__(key))
+
+    @classmethod
+    def __index_args__(cls, key):
+        """Return the script arguments for the indexes of the key"""
+        if key not in cls.__indexes__:
+            return []
+
+        index = cls.__indexes__[key]
+        return [index.__type__, index.__prefix__, index.__members__]
+
+    def __hset__(self, client, key, value):
+        """Set the field and update its indexes atomically using the client or pipeline"""
+        return hset_script(keys=[self.id, self.__members__],
+                           args=[key, value] + self.__index_args__(key),
+                           client=client)
+
+    def __hdel__(self, client, key):
+        """Delete the field and its index entries atomically using the client or pipeline"""
+        return hdel_script(keys=[self.id, self.__members__],
+                           args=[key] + self.__index_args__(key),
+                           client=client)
+
+    def __hincrby__(self, client, key, amount):
+        """Increment the field and update its indexes atomically using the client or pipeline"""
+        return hincrby_script(keys=[self.id, self.__members__],
+                              args=[key, amount] + self.__index_args__(key),
+                              client=client)
+
+    def __remove__(self, client):
+        """Delete the model, its index entries and counters atomically using the client or pipeline"""
+        args = [len(self.__indexes__)]
+        for key in self.__indexes__:
+            args += [key] + self.__index_args__(key)
+
+        counters = list(self.__counters__.values())
+        for counter in counters:
+            args += counter.ranking_args()
 
-        redis.hdel(self.id, self.__keytransform__(key))
+        return delete_script(keys=[self.id, self.__members__] + [counter.key(self) for counter in counters],
+                             args=args, client=client)
 
     def __iter__(self):
-        return iter(redis.hkeys(self.id))
+        session = current_session()
+        if session:
+            session.sync(self.id)
+
+        data = self.__snapshot__()
+        if data is not None:
+            stale = self.__stale__
+            return iter(list(data) + [key for key in stale if key not in data])
+
+        return iter(reader(self.id).hkeys(self.id))
 
     def __len__(self):
-        return redis.hlen(self.id)
+        session = current_session()
+        if session:
+            session.sync(self.id)
+
+        data = self.__snapshot__()
+        if data is not None:
+            stale = self.__stale__
+            return len(data) + len([key for key in stale if key not in data])
+
+        return reader(self.id).hlen(self.id)
 
     def __keytransform__(self, key):
         return key
 
     def __repr__(self):
-        return repr(redis.hgetall(self.id))
+        session = current_session()
+        if session:
+            session.sync(self.id)
+
+        data = self.__snapshot__()
+        if data is not None and not self.__stale__:
+            return repr(data)
+
+        return repr(reader(self.id).hgetall(self.id))
 
     def __eq__(self, other):
         if not isinstance(other, Model):
@@ -257,68 +1569,647 @@ class Model(with_metaclass(ModelMeta, collections.MutableMapping)):
 
         return self.id == other.id
 
+    def __hash__(self):
+        return hash(self.id)
+
     def __contains__(self, key):
-        return redis.hexists(self.id, self.__keytransform__(key))
+        session = current_session()
+        try:
+            if session is None:
+                raise KeyError(key)
+
+            return session.field(self.id, self.__keytransform__(key)) is not DELETED
+        except KeyError:
+            pass
+
+        data = self.__snapshot__()
+        if data is not None and self.__keytransform__(key) not in self.__stale__:
+            return self.__keytransform__(key) in data
+
+        return reader(self.id).hexists(self.id, self.__keytransform__(key))
+
+    def __snapshot__(self):
+        """Return the loaded data for the model if it is still valid"""
+        data = self.__data__
+        if data is None:
+            return None
+
+        if self.__ttl__ is not None and time.time() - self.__loaded__ > self.__ttl__:
+            # Discard the expired snapshot
+            self.__data__ = None
+            return None
+
+        return data
+
+    def __update__(self, key, value):
+        """Update the snapshot after writing the value of the key"""
+        data = self.__data__
+        if data is None:
+            return
+
+        key = self.__keytransform__(key)
+        self.__stale__.discard(key)
+        if value is DELETED:
+            data.pop(key, None)
+        else:
+            data[key] = to_bytes(value)
+
+    def __invalidate__(self):
+        """Discard the loaded snapshot"""
+        self.__data__ = None
+
+    def __hydrate__(self, data):
+        """Replace the snapshot with the data from a HGETALL reply"""
+        self.__data__ = {k.decode('utf-8'): v for k, v in data.items()}
+        self.__stale__ = set()
+        self.__loaded__ = time.time()
+        return self
+
+    def load(self):
+        """Load all the values of the model with a single query
+
+        Following reads are served from the loaded data. If a valid
+        snapshot is already loaded, no query is performed
+        """
+        if self.__snapshot__() is None:
+            self.refresh()
+
+        return self
+
+    def refresh(self):
+        """Read all the values of the model from redis, replacing the snapshot"""
+        session = current_session()
+        if session:
+            session.sync(self.id)
+
+        return self.__hydrate__(reader(self.id).hgetall(self.id))
 
     def incrby(self, key, amount=1):
         """Increment the provided key in the dictionary by the specified amount"""
-        redis.hincrby(self.id, self.__keytransform__(key), amount)
+        session = current_session()
+        if session:
+            if self.__data__ is not None:
+                # The new value is only known after the session is flushed
+                self.__stale__.add(self.__keytransform__(key))
+
+            return session.hincrby(self, self.__keytransform__(key), amount)
+
+        value = self.__hincrby__(redis, self.__keytransform__(key), amount)
+        self.__update__(key, value)
 
     def delete(self):
         """Delete the entity from the database"""
-        # Delete the indexes
-        for key in self.__indexes__:
-            oldvalue = self.__getitem__(key)
-            # If the key is an index, delete the index
-            if oldvalue:
-                del self.__indexes__[key][oldvalue]
+        if self.__data__ is not None:
+            self.__hydrate__({})
+
+        session = current_session()
+        if session:
+            return session.delete(self)
 
-        return redis.delete(self.id)
+        return self.__remove__(redis)
 
     @classmethod
     def exists(cls, id):
         if not hasattr(cls, '__prefix__'):
             raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
 
-        if not id.startswith(cls.__prefix__):
-            id = cls.__prefix__ + id
+        id = cls.__id__(id)
 
-        return redis.exists(id)
+        session = current_session()
+        if session:
+            session.sync(id)
+
+        return reader(id).exists(id)
 
     @classmethod
     def findBy(cls, key, value):
         if key == cls.__primary__ and cls.exists(value):
-            return cls(value)
+            return cls.__lazy__(cls.__id__(value))
 
         if key not in cls.__indexes__:
             raise AttributeError("No index has been defined for key '%s' in model %s" % (key, cls.__name__))
 
+        # Set and sorted indexes return a list of models
         return cls.__indexes__[key][value]
 
+    @classmethod
+    def where(cls, **conditions):
+        """Return a query for the models matching the conditions
+
+        See Query for the syntax of the conditions.
+        """
+        return Query(cls).where(**conditions)
+
+    @classmethod
+    def range(cls, key, min='-inf', max='+inf', start=None, num=None):
+        """Return the list of models with values for the key between min and max
+        (inclusive), ordered by value. The key must have a sorted index"""
+        if key not in cls.__indexes__ or cls.__indexes__[key].__type__ != 'sorted':
+            raise AttributeError("No sorted index has been defined for key '%s' in model %s" % (key, cls.__name__))
+
+        return cls.__indexes__[key].range(min, max, start=start, num=num)
+
+    @classmethod
+    def __id__(cls, id):
+        """Return the key of the model for the id, which can be given with or
+        without the prefix (with or without the hash tag)"""
+        if id.startswith(cls.__prefix__):
+            return id
+
+        if cls.__tag__ and id.startswith(cls.__prefix__[len(cls.__tag__):]):
+            return cls.__tag__ + id
+
+        return cls.__prefix__ + id
+
+    @classmethod
+    def __lazy__(cls, id):
+        """Return the model for the id without writing the primary key"""
+        model = cls.__new__(cls)
+        model.id = id
+        model.__data__ = None
+        return model
+
+    @classmethod
+    def get_many(cls, ids):
+        """Return a list with the loaded models for the given ids
+
+        The hashes are read with HGETALL in a single pipelined round trip,
+        and the models are returned with their snapshot loaded. The models
+        are created without writing the primary key. If a model does not
+        exist in the database, None is returned in its place.
+        """
+        if not hasattr(cls, '__prefix__'):
+            raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
+
+        ids = [cls.__id__(id) for id in ids]
+
+        session = current_session()
+        if session:
+            session.sync(*ids)
+
+        pipeline = reader(*ids).pipeline(transaction=False)
+        for id in ids:
+            pipeline.hgetall(id)
+
+        models = []
+        for id, data in zip(ids, pipeline.execute()):
+            if not data:
+                models.append(None)
+                continue
+
+            models.append(cls.__lazy__(id).__hydrate__(data))
+
+        return models
+
     @classmethod
     def all(cls, *args, **kwargs):
         """Return an iterator over the objects matching the model in the database
 
-        It performs the query by calling redis.keys() using the defined prefix.
+        It iterates the members set of the model incrementally using SSCAN.
         If extra arguments are given, they are passed to the contructor of the model.
+
+        If load=True is given, the models are fetched with get_many() in batches of
+        'batch' models (100 by default) and returned with their snapshot loaded.
+        Models that no longer exist are removed from the members set.
         """
         if not hasattr(cls, '__prefix__'):
             raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
 
-        keys = redis.keys(cls.__prefix__ + '*')
+        load = kwargs.pop('load', False)
+        batch = kwargs.pop('batch', 100)
+
+        session = current_session()
+        if session:
+            session.sync(cls.__prefix__)
+
+        keys = (key.decode() for key in reader(cls.__prefix__).sscan_iter(cls.__members__, count=SCAN_COUNT))
+        if not load:
+            for key in keys:
+                # The models exist, only build them with the constructor if
+                # it needs the extra arguments
+                yield cls(key, *args, **kwargs) if args or kwargs else cls.__lazy__(cls.__id__(key))
+            return
+
+        ids = []
         for key in keys:
-            yield cls(key.decode(), *args, **kwargs)
+            ids.append(key)
+            if len(ids) >= batch:
+                for model in cls.__load_batch__(ids):
+                    yield model
+                ids = []
+
+        for model in cls.__load_batch__(ids):
+            yield model
+
+    @classmethod
+    def __load_batch__(cls, ids):
+        """Load the models with get_many(), pruning missing ids from the members set"""
+        if len(ids) == 0:
+            return []
+
+        models = cls.get_many(ids)
+        missing = [id for id, model in zip(ids, models) if model is None]
+        if len(missing) > 0:
+            redis.srem(cls.__members__, *missing)
+
+        return [model for model in models if model is not None]
+
+    @classmethod
+    def count(cls):
+        """Return the number of models stored in the database"""
+        session = current_session()
+        if session:
+            session.sync(cls.__prefix__)
+
+        return reader(cls.__prefix__).scard(cls.__members__)
+
+    # Asyncio versions of the read operations, implemented in app.aio
+    # (python 3 only). The models returned have their snapshot loaded
+
+    def aload(self):
+        from app import aio
+        return aio.load(self)
+
+    def arefresh(self):
+        from app import aio
+        return aio.refresh(self)
+
+    @classmethod
+    def aexists(cls, id):
+        from app import aio
+        return aio.exists(cls, id)
+
+    @classmethod
+    def afindBy(cls, key, value):
+        from app import aio
+        return aio.find_by(cls, key, value)
+
+    @classmethod
+    def aget_many(cls, ids):
+        from app import aio
+        return aio.get_many(cls, ids)
+
+    @classmethod
+    def aall(cls, batch=100):
+        from app import aio
+        return aio.all(cls, batch=batch)
+
+    @classmethod
+    def acount(cls):
+        from app import aio
+        return aio.count(cls)
+
+    @classmethod
+    def arange(cls, key, min='-inf', max='+inf', start=None, num=None):
+        if key not in cls.__indexes__ or cls.__indexes__[key].__type__ != 'sorted':
+            raise AttributeError("No sorted index has been defined for key '%s' in model %s" % (key, cls.__name__))
+
+        return cls.__indexes__[key].arange(min, max, start=start, num=num)
 
     @classmethod
     def deleteall(cls):
+        """Delete all the models of the class, with their indexes, counters
+        and counter rankings"""
+        if not hasattr(cls, '__prefix__'):
+            raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
+
+        session = current_session()
+        if session:
+            session.sync(cls.__prefix__)
+
+        for key in cls.__indexes__:
+            cls.__indexes__[key].deleteall()
+
+        for counter in cls.__counters__.values():
+            counter.deleteall(cls.__members__)
+
+        return delete_members(cls.__members__)
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the members sets of the model and its indexes
+
+        It walks the keyspace using SCAN, so it is only needed to migrate
+        data stored before members sets were used
+        """
         if not hasattr(cls, '__prefix__'):
             raise AttributeError("Models must define the attribute: __prefix__ or define one of the model keys as primary")
 
-        keys = redis.keys(cls.__prefix__ + '*')
+        for key in cls.__indexes__:
+            cls.__indexes__[key].rebuild()
+
+        added = rebuild_members(cls.__members__, cls.__prefix__)
+
+        # Non unique indexes are rebuilt by writing the stored values again
+        keys = [key for key in cls.__indexes__ if cls.__indexes__[key].__type__ != 'unique']
         if len(keys) > 0:
-            for key in cls.__indexes__:
-                cls.__indexes__[key].deleteall()
+            pipeline = redis.pipeline(transaction=False)
+            for model in cls.all(load=True):
+                data = model.__snapshot__()
+                for key in keys:
+                    if key in data:
+                        model.__hset__(pipeline, key, data[key])
 
-            return redis.delete(*keys)
+                if len(pipeline) >= SCAN_COUNT:
+                    pipeline.execute()
 
-        return 0
+            pipeline.execute()
+
+        return added
+
+    @classmethod
+    def migrate(cls, batch=100):
+        """Move the keys stored without hash tag to the hash tagged layout
+
+        The ids are read from the members set of the old layout, and the hashes
+        and counters of the models are copied to the new keys in batches of
+        'batch' models. The indexes are written again for the new ids, the
+        daily rankings are copied and the old keys are deleted. It returns the
+        number of models moved
+        """
+        tag = cls.__tag__
+        if not tag:
+            return 0
+
+        moved = 0
+        ids = []
+        members = MEMBERS_PREFIX + cls.__prefix__[len(tag):]
+        for id in redis.sscan_iter(members, count=SCAN_COUNT):
+            ids.append(id.decode('utf-8'))
+            if len(ids) >= batch:
+                moved += cls.__migrate_batch__(ids)
+                ids = []
+
+        moved += cls.__migrate_batch__(ids)
+
+        # Delete the old indexes and rankings
+        for index in cls.__indexes__.values():
+            old = index.__prefix__[len(tag):]
+            if index.__type__ == 'sorted':
+                redis.delete(old)
+            else:
+                delete_members(MEMBERS_PREFIX + old, lambda value: old + value)
+
+        for counter in cls.__counters__.values():
+            if counter.rank_prefix:
+                cls.__migrate_rankings__(counter.rank_prefix[len(tag):])
+
+        redis.delete(members)
+        return moved
+
+    @classmethod
+    def __migrate_batch__(cls, ids):
+        """Copy the hashes and counters of the models with the old ids"""
+        if len(ids) == 0:
+            return 0
+
+        tag = cls.__tag__
+        counters = [counter.prefix[len(tag):] for counter in cls.__counters__.values()]
+
+        pipeline = redis.pipeline(transaction=False)
+        for id in ids:
+            pipeline.hgetall(id)
+            for prefix in counters:
+                pipeline.hgetall(prefix + id)
+                pipeline.ttl(prefix + id)
+
+        replies = iter(pipeline.execute())
+
+        moved = 0
+        pipeline = redis.pipeline(transaction=False)
+        for id in ids:
+            model = cls.__lazy__(tag + id)
+            data = next(replies)
+            if data:
+                pipeline.hset(model.id, mapping=data)
+                pipeline.sadd(cls.__members__, model.id)
+                for key in cls.__indexes__:
+                    if key.encode('utf-8') in data:
+                        model.__hset__(pipeline, key, data[key.encode('utf-8')])
+                moved += 1
+
+            for prefix in counters:
+                buckets, ttl = next(replies), next(replies)
+                if buckets:
+                    pipeline.hset(tag + prefix + model.id, mapping=buckets)
+                    if ttl > 0:
+                        pipeline.expire(tag + prefix + model.id, ttl)
+                pipeline.delete(prefix + id)
+
+            # Keys are deleted one by one, they can be in different slots
+            pipeline.delete(id)
+
+        pipeline.execute()
+        return moved
+
+    @classmethod
+    def __migrate_rankings__(cls, prefix):
+        """Copy the daily rankings with the old prefix, deleting the old rankings
+
+        Window rankings are only deleted, they are rebuilt when queried
+        """
+        tag = cls.__tag__
+        for key in redis.scan_iter(match=prefix + '*', count=SCAN_COUNT):
+            key = key.decode('utf-8')
+            if key.startswith(prefix + 'day:'):
+                scores = dict((tag + id.decode('utf-8'), score) for id, score in redis.zscan_iter(key))
+                ttl = redis.ttl(key)
+                if scores:
+                    redis.zadd(tag + key, scores)
+                    if ttl > 0:
+                        redis.expire(tag + key, ttl)
+
+            redis.delete(key)
+
+
+class Query(object):
+    """Query over the models of a class
+
+    Conditions are given as keyword arguments, with the name of a key
+    followed by an optional operator, separated by two underscores:
+    eq (the default), ne, gt, gte, lt, lte or in.
+
+    The query is planned to read the candidates from an index when one fits
+    a condition, in this order: primary key or unique index equality, set
+    index equality, sorted index equality or range. Otherwise, the members
+    of the model are scanned. The remaining conditions are checked reading
+    the values of the candidates with pipelined HMGET calls.
+
+    Example:
+
+    ```
+    query = User.where(gitlab_name='flalanne', commits_total__gt=10).limit(20)
+    query.plan  # "unique index 'gitlab_name', filter commits_total"
+    users = list(query)
+    ```
+    """
+    OPERATORS = {
+        'eq': lambda value, param: value == param,
+        'ne': lambda value, param: value != param,
+        'gt': lambda value, param: value is not None and value > param,
+        'gte': lambda value, param: value is not None and value >= param,
+        'lt': lambda value, param: value is not None and value < param,
+        'lte': lambda value, param: value is not None and value <= param,
+        'in': lambda value, param: value in param
+    }
+
+    def __init__(self, model):
+        self.model = model
+        self.conditions = []
+        self.max_results = None
+
+    def where(self, **conditions):
+        """Add conditions to the query"""
+        for name, param in sorted(conditions.items()):
+            key, operator = name.rsplit('__', 1) if '__' in name else (name, 'eq')
+            if operator not in self.OPERATORS:
+                raise AttributeError("Unknown operator '%s' in condition '%s'" % (operator, name))
+
+            self.conditions.append((key, operator, param))
+
+        return self
+
+    def limit(self, count):
+        """Return at most 'count' models"""
+        self.max_results = count
+        return self
+
+    @property
+    def plan(self):
+        """Description of the plan used to execute the query"""
+        driver, filters = self.__plan__()
+        description = driver[0]
+        if len(filters) > 0:
+            description += ', filter ' + ', '.join(sorted(set(key for key, operator, param in filters)))
+
+        return description
+
+    def __plan__(self):
+        """Choose the source of the candidates.
+
+        It returns a tuple (description, candidates function) and the list of
+        conditions to check on the candidates
+        """
+        model = self.model
+        indexes = model.__indexes__
+
+        def kind(key):
+            return indexes[key].__type__ if key in indexes else None
+
+        for priority in ['primary', 'unique', 'set', 'sorted_eq', 'sorted']:
+            for condition in self.conditions:
+                key, operator, param = condition
+                filters = [c for c in self.conditions if c is not condition]
+
+                if priority == 'primary' and key == model.__primary__ and operator == 'eq':
+                    return ("primary key '%s'" % key, lambda: self.__by_primary__(param)), filters
+
+                if priority == 'unique' and kind(key) == 'unique' and operator == 'eq':
+                    return ("unique index '%s'" % key, lambda: self.__by_unique__(key, param)), filters
+
+                if priority == 'set' and kind(key) == 'set' and operator == 'eq':
+                    return ("set index '%s'" % key, lambda: indexes[key][param]), filters
+
+                if priority == 'sorted_eq' and kind(key) == 'sorted' and operator == 'eq':
+                    value = model.__encode__(key, param)
+                    return ("sorted index '%s'" % key, lambda: indexes[key].range(value, value)), filters
+
+                if priority == 'sorted' and kind(key) == 'sorted' and operator in ['gt', 'gte', 'lt', 'lte']:
+                    # Use all the range conditions on the same key
+                    bounds = [c for c in self.conditions if c[0] == key and c[1] in ['gt', 'gte', 'lt', 'lte']]
+                    filters = [c for c in self.conditions if c not in bounds]
+                    return ("sorted index '%s' range" % key,
+                            lambda: self.__range__(key, bounds, filters)), filters
+
+        return ("scan '%s' members" % model.__name__, self.__scan__), self.conditions
+
+    def __by_primary__(self, value):
+        return [self.model.__lazy__(self.model.__id__(value))] if self.model.exists(value) else []
+
+    def __by_unique__(self, key, value):
+        model = self.model.__indexes__[key][value]
+        return [model] if model is not None else []
+
+    def __range__(self, key, bounds, filters):
+        """Read the candidates from the sorted index, limiting the range if
+        there are no more conditions"""
+        min, max = '-inf', '+inf'
+        for bound, operator, param in bounds:
+            param = self.model.__encode__(key, param)
+            if operator in ['gt', 'gte']:
+                min = ('(%s' if operator == 'gt' else '%s') % param
+            else:
+                max = ('(%s' if operator == 'lt' else '%s') % param
+
+        if len(filters) == 0 and self.max_results is not None:
+            return self.model.range(key, min, max, start=0, num=self.max_results)
+
+        return self.model.range(key, min, max)
+
+    def __scan__(self):
+        """Iterate all the models of the class"""
+        session = current_session()
+        if session:
+            session.sync(self.model.__prefix__)
+
+        for id in reader(self.model.__prefix__).sscan_iter(self.model.__members__, count=SCAN_COUNT):
+            yield self.model.__lazy__(id.decode('utf-8'))
+
+    def __iter__(self):
+        (description, candidates), filters = self.__plan__()
+        logger.debug('Query on %s using %s' % (self.model.__name__, self.plan))
+
+        keys = sorted(set(key for key, operator, param in filters))
+        found = 0
+        batch = []
+        for model in candidates():
+            batch.append(model)
+            if len(batch) < SCAN_COUNT:
+                continue
+
+            for match in self.__filter__(batch, keys, filters):
+                yield match
+                found += 1
+                if self.max_results is not None and found >= self.max_results:
+                    return
+            batch = []
+
+        for match in self.__filter__(batch, keys, filters):
+            yield match
+            found += 1
+            if self.max_results is not None and found >= self.max_results:
+                return
+
+    def __filter__(self, models, keys, filters):
+        """Return the models matching the filters, reading the values of all
+        the models in a single pipelined round trip"""
+        if len(filters) == 0 or len(models) == 0:
+            return models
+
+        session = current_session()
+        if session:
+            session.sync(*[model.id for model in models])
+
+        pipeline = reader(*[model.id for model in models]).pipeline(transaction=False)
+        for model in models:
+            pipeline.hmget(model.id, keys)
+
+        matches = []
+        for model, values in zip(models, pipeline.execute()):
+            values = dict((key, model.__convert__(key, value)) for key, value in zip(keys, values))
+            if all(self.OPERATORS[operator](values[key], param) for key, operator, param in filters):
+                matches.append(model)
+
+        return matches
+
+    def all(self):
+        """Return the list of matching models"""
+        return list(self)
+
+    def first(self):
+        """Return the first matching model or None, the limit of the query
+        is not changed"""
+        for model in copy.copy(self).limit(1):
+            return model
+
+        return None
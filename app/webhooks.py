@@ -3,34 +3,203 @@ from __future__ import unicode_literals
 
 from flask.views import MethodView
 from flask import request
+from six.moves.collections_abc import Mapping
+from types import GeneratorType
+from .jsonstream import JSONStream
 from .util import camel_to_underscore
 
-from werkzeug.exceptions import NotImplemented
+from werkzeug.exceptions import BadRequest, NotImplemented
 from logging import getLogger
 
-import six
+import hashlib
+import io
+
+# Bytes of the body shown when a payload is logged
+REPR_BYTES = 200
+
+try:
+    # Faster json decoder, used if it is installed
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+def checked(iterator):
+    """Iterate a json decoder, failing with a bad request if the json is
+    not valid"""
+    try:
+        for value in iterator:
+            yield value
+    except ValueError:
+        raise BadRequest('Failed to decode JSON object')
+
+
+class Payload(Mapping):
+    """Data posted to a hook, from the json body, the form and the query
+    string
+
+    The body is parsed once, the first time it is needed. Values are looked
+    up in the query string, the form and the body, in that order, without
+    merging them in a new dict.
+
+    Large bodies can be decoded while they are read instead, with stream().
+    The payload reads the request, so it can only be used while the request
+    is handled
+    """
+    def __init__(self, request):
+        self.request = request
+        self.__json = None
+        self.__parsed = False
+        self.__read = False
+
+    def body(self):
+        """Returns the body of the request, keeping it in memory"""
+        self.__read = True
+        return self.request.get_data()
+
+    @property
+    def json(self):
+        """Returns the parsed body, or None if the request is not json"""
+        if not self.__parsed:
+            if self.request.is_json:
+                try:
+                    self.__json = loads(self.body())
+                except ValueError:
+                    raise BadRequest('Failed to decode JSON object')
+
+            self.__parsed = True
+
+        return self.__json
+
+    def stream(self, streamed=()):
+        """Decode the members of the json body one at a time, with the
+        arrays in 'streamed' as iterators over their items (see
+        app.jsonstream)
+
+        The body is read from the request while it is decoded, unless it
+        was read before
+        """
+        if not self.request.is_json:
+            return
+
+        body = io.BytesIO(self.body()) if self.__read else self.request.stream
+        for key, value in checked(JSONStream(body).members(streamed)):
+            yield key, checked(value) if isinstance(value, GeneratorType) else value
+
+    def sources(self):
+        # Parse the body before the form, which may consume it
+        body = self.json if isinstance(self.json, dict) else None
+        return [d for d in (self.request.args, self.request.form, body) if d]
+
+    def __getitem__(self, key):
+        for d in self.sources():
+            if key in d:
+                return d[key]
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        sources = self.sources()
+        for n, d in enumerate(reversed(sources)):
+            for key in d:
+                if not any(key in other for other in sources[:len(sources) - n - 1]):
+                    yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def to_dict(self):
+        """Returns the data as a dict, the parsed body itself if the
+        request has no form or query string"""
+        sources = self.sources()
+        if len(sources) == 1 and isinstance(sources[0], dict):
+            return sources[0]
+
+        return dict(self)
+
+    def __repr__(self):
+        """Describe the payload without decoding it, the start of the body
+        is only shown if it has been read"""
+        text = '<Payload %s bytes' % self.request.content_length
+        if self.__read:
+            body = self.request.get_data()
+            text += ': %r%s' % (body[:REPR_BYTES], '...' if len(body) > REPR_BYTES else '')
+
+        return text + '>'
+
 
 class WebHook(MethodView):
-    def __init__(self, logger=None):
+    # Header identifying a delivery, the same for the retries of an event
+    delivery_header = None
+
+    def __init__(self, logger=None, queue=None, name=None, deliveries=None):
         self.logger = logger if logger else getLogger('webhooks')
 
+        # If a queue is given, events are pushed to the queue with the
+        # name of the hook, to be handled later by a worker
+        self.queue = queue
+        self.name = name
+
+        # If deliveries are given (see app.deliveries), events already
+        # received are skipped
+        self.deliveries = deliveries
+
     def event(self, request):
         """Returns the event name from the request information.
         """
         raise NotImplementedError('Subclasses must implement the event method.')
 
+    def delivery(self, request):
+        """Returns the key identifying the delivery of the request, from the
+        delivery header or a hash of the body.
+        """
+        key = request.headers.get(self.delivery_header) if self.delivery_header else None
+        if not key:
+            key = hashlib.sha1(self.payload.body()).hexdigest()
+
+        return '%s:%s' % (self.name, key)
+
     def post(self):
+        # Data of the request, parsed when needed
+        self.payload = Payload(request)
+
         event = self.event(request)
 
         if not hasattr(self, event):
             raise NotImplemented('No method implemented for event %s.' % event)
 
-        # Get a dict of POSTed data
-        data = {k: d[k] for d in [request.json, request.form, request.args] for k in six.iterkeys(d or {})}
+        if self.deliveries is None:
+            return self.dispatch(event)
 
-        self.logger.debug('Received %s event with the following data:\n %s' % (event, repr(data)))
+        # Skip the events received before, e.g. sent again by a server that
+        # timed out waiting for the first answer
+        key = self.delivery(request)
+        if not self.deliveries.claim(key):
+            self.logger.info('Skipped duplicate %s event (delivery %s)' % (event, key))
+            return '', 200
 
-        # Call the method with the json as parameter
+        try:
+            return self.dispatch(event)
+        except Exception:
+            # Let the event be handled when it is sent again
+            self.deliveries.release(key)
+            raise
+
+    def dispatch(self, event):
+        """Handle the event of the request, or push it to the queue"""
+        data = self.payload
+
+        # The data is only formatted if the message is logged
+        self.logger.debug('Received %s event with the following data:\n %s', event, data)
+
+        if self.queue is not None:
+            self.queue.push(self.name, event, data.to_dict())
+            return '', 202
+
+        return self.handle(event, data)
+
+    def handle(self, event, data):
+        """Call the method for the event with the data as parameter"""
         return getattr(self, event)(data)
 
 
@@ -45,6 +214,12 @@ class WebHooks:
         self.app = app
         self.handlers = {}
 
+        # Hook classes by name, queue of the events (see app.ingest) and
+        # deliveries received (see app.deliveries)
+        self.hooks = {}
+        self.queue = None
+        self.deliveries = None
+
     def add_handler(self, name, cls):
         """Set a webhook base class to handle requests for a specified type.
 
@@ -92,10 +267,12 @@ class WebHooks:
 
             # Save this instance in another class to use inside the method
             hook = self
+            name = camel_to_underscore(cls.__name__)
 
             def __init__(self, *args, **kwargs):
                 # Call Resource constructor
-                super(cls, self).__init__(logger=hook.app.logger)
+                super(cls, self).__init__(logger=hook.app.logger, queue=hook.queue, name=name,
+                                        deliveries=hook.deliveries)
 
                 # Initialize the instance
                 clsinit(self, *args, **kwargs)
@@ -103,7 +280,8 @@ class WebHooks:
             cls.__init__ = __init__
 
             # Add the resource to the app
-            self.app.add_url_rule(prefix, view_func=cls.as_view(camel_to_underscore(cls.__name__)))
+            self.app.add_url_rule(prefix, view_func=cls.as_view(name))
+            self.hooks[name] = cls
 
             return cls
 
@@ -6,15 +6,101 @@ class Config(object):
     DEBUG = False
     TESTING = False
 
+    import os
+
+    # Storage engine, 'redis' or 'memory' to keep the data in process
+    # (for single process deployments or running the tests without redis)
+    STORAGE = os.environ.get('STORAGE', 'redis')
+
     # Host for the redis server
     REDIS = 'redis'
 
+    # Unix socket of the redis server, used instead of REDIS if set
+    REDIS_SOCKET = None
+
+    # Size of the connection pool (None for no limit) and timeouts in seconds
+    REDIS_MAX_CONNECTIONS = None
+    REDIS_SOCKET_TIMEOUT = None
+    REDIS_CONNECT_TIMEOUT = None
+    REDIS_KEEPALIVE = True
+
+    # Log the number of redis commands, round trips and time spent on each
+    # request, also sent in the X-Redis-Trace header of the response
+    REDIS_TRACE = False
+
+    # Connect to a redis cluster, REDIS is the host of one of the nodes. The
+    # keys of each model are stored in the same slot using hash tags, so all
+    # the models of a class live in a single node: the scripts can update
+    # them atomically, but a class is not sharded across the cluster
+    REDIS_CLUSTER = False
+
+    # Host of a replica of the redis server, used for the reads of keys not
+    # written in the current session. With REDIS_CLUSTER, set it to True to
+    # read from the replicas of the cluster
+    REDIS_REPLICA = None
+
+    # Use hash tags without a cluster. Run 'python manage.py migrate' after
+    # enabling hash tags (or the cluster) to move the existing keys
+    REDIS_HASH_TAGS = False
+
+    # Queue the webhook events in a redis stream and answer 202, the events
+    # are handled by the workers started with 'python manage.py worker'
+    WEBHOOK_QUEUE = False
+    WEBHOOK_STREAM = 'webhooks'
+    WEBHOOK_GROUP = 'workers'
+
+    # Approximate number of events kept in the stream
+    WEBHOOK_STREAM_MAXLEN = 10000
+
+    # Worker threads started with the application, needed with the memory
+    # storage since the queue is not shared with other processes
+    WEBHOOK_WORKERS = 0
+
+    # Deliveries of an event before it is dropped, and seconds before an
+    # event that was not acknowledged is delivered again
+    WEBHOOK_RETRIES = 5
+    WEBHOOK_RETRY_TIMEOUT = 60
+
+    # Maximum size of the requests in bytes, larger requests are answered
+    # with 413
+    MAX_CONTENT_LENGTH = 32 * 1024 * 1024
+
+    # Count the commits of the gitlab pushes while the body is read, instead
+    # of loading the whole payload in memory
+    GITLAB_STREAM_PUSH = True
+
+    # Seconds a webhook delivery is remembered to skip it if it is sent
+    # again (0 to handle all the deliveries), and deliveries remembered in
+    # memory, used alone when redis is not available
+    WEBHOOK_DEDUP_TTL = 0
+    WEBHOOK_DEDUP_SIZE = 10000
+
+    # Slack messages are sent by SLACK_WORKERS threads, with at most
+    # SLACK_CHANNEL_RATE messages per second to each channel (in bursts of up
+    # to SLACK_CHANNEL_BURST). Up to SLACK_QUEUE_SIZE messages are kept in
+    # memory, the rest wait in redis. The rate is enforced by each process,
+    # with N processes (e.g. gunicorn workers) divide it by N
+    SLACK_API_URL = 'https://slack.com/api/'
+    SLACK_WORKERS = 4
+    SLACK_CHANNEL_RATE = 1.0
+    SLACK_CHANNEL_BURST = 3
+    SLACK_QUEUE_SIZE = 1000
+    SLACK_RETRIES = 3
+    SLACK_TIMEOUT = 10
+
+    # Seconds during which the messages of an event type sent to a channel
+    # are merged into a digest after the first one (0 to send them all), by
+    # event and optionally by channel, e.g. {'#general': {'tag_push': 300}}.
+    # Digests show up to DIGEST_ITEMS events
+    DIGEST_WINDOWS = {'issue': 0, 'tag_push': 0}
+    DIGEST_CHANNEL_WINDOWS = {}
+    DIGEST_ITEMS = 10
+
     # Do not push this to a public repo
     SLACK_DEFAULT_CHANNEL = '#general'
     SLACK_DEVELOPERS_CHANNEL = '#developers'
 
     # Define the application directory
-    import os
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
     # Log file (the directory must exist)
@@ -29,8 +115,12 @@ class ProductionConfig(Config):
     # Gitlab hook url
     GITLAB_HOOK = '/hooks/bWxNGVQij55cCZigeKDlXf9P6L14bKc4AhdPmPL5mEc='
 
+    # Gitlab sends the hooks again when they time out
+    WEBHOOK_DEDUP_TTL = 3600
+
 class DevelopmentConfig(Config):
     DEBUG = True
+    REDIS_TRACE = True
 
 class TestingConfig(Config):
     TESTING = True
@@ -6,5 +6,94 @@ from app import app
 
 manager = Manager(app)
 
+
+@manager.command
+def rebuild():
+    """Rebuild the members sets of the models from the existing keys"""
+    from app.models import Channel, User
+
+    for model in [Channel, User]:
+        print('%s: %d members added' % (model.__name__, model.rebuild()))
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=100, help='Models moved in each batch')
+def migrate(batch=100):
+    """Move the keys stored without hash tags to the hash tagged layout"""
+    from app.models import Channel, User
+
+    for model in [Channel, User]:
+        print('%s: %d models moved' % (model.__name__, model.migrate(batch=batch)))
+
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=4, help='Worker threads')
+def worker(workers=4):
+    """Handle the webhook events of the queue (WEBHOOK_QUEUE)"""
+    import time
+    from app import webhooks
+    from app.ingest import WorkerPool
+
+    if webhooks.queue is None:
+        print('WEBHOOK_QUEUE is not enabled')
+        return
+
+    pool = WorkerPool(app, webhooks, webhooks.queue, workers=workers,
+                      retries=app.config.get('WEBHOOK_RETRIES'),
+                      timeout=app.config.get('WEBHOOK_RETRY_TIMEOUT'))
+    pool.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+@manager.option('-n', '--events', dest='events', type=int, default=1000, help='Number of events posted')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=4, help='Threads posting events')
+@manager.option('-s', '--server', dest='server', action='store_true', default=False,
+                help='Post the events to a local WSGI server instead of the test client')
+@manager.option('-o', '--output', dest='output', default='bench.json', help='File for the JSON results')
+def bench(events=1000, concurrency=4, server=False, output='bench.json'):
+    """Measure the latency and throughput of the gitlab hooks"""
+    import json
+    from app.bench import run
+
+    results = run(events=events, concurrency=concurrency, server=server)
+    for event, stats in sorted(results['events'].items()) + [('Total', results['total'])]:
+        print('%s: %d events, %d errors, p50 %.1fms, p95 %.1fms, p99 %.1fms, %.1f redis commands per event' %
+              (event, stats['count'], stats['errors'], stats['p50'], stats['p95'], stats['p99'], stats['commands']))
+    print('Throughput: %.1f events/s' % results['total']['throughput'])
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+@manager.option('-s', '--sizes', dest='sizes', default='1000,10000,100000', help='Numbers of models stored')
+@manager.option('-n', '--ops', dest='ops', type=int, default=1000, help='Operations measured by benchmark')
+@manager.option('-r', '--revisions', dest='revisions', default=None,
+                help='Compare two git revisions (or one with the working tree), e.g. master,HEAD')
+@manager.option('-o', '--output', dest='output', default='microbench.json', help='File for the JSON results')
+def microbench(sizes='1000,10000,100000', ops=1000, revisions=None, output='microbench.json'):
+    """Measure the latency, memory and round trips of the model operations"""
+    import json
+    from app.microbench import run, run_revision, compare
+
+    sizes = [int(size) for size in sizes.split(',')]
+    if not revisions:
+        results = run(sizes, ops)
+        for size in sorted(results, key=int):
+            for name, stats in sorted(results[size].items()):
+                print('%-8s %7s: mean %.1fus, p50 %.1fus, p99 %.1fus, %.2f round trips' %
+                      (name, size, stats['mean'], stats['p50'], stats['p99'], stats['round_trips']))
+    else:
+        revisions = revisions.split(',')
+        base = run_revision(revisions[0], sizes, ops)
+        results = run_revision(revisions[1], sizes, ops) if len(revisions) > 1 else run(sizes, ops)
+        print('\n'.join(compare(base, results)))
+        results = {'base': base, 'results': results, 'revisions': revisions}
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
 if __name__ == '__main__':
     manager.run()
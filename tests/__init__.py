@@ -1,6 +1,18 @@
 from __future__ import absolute_import
 
-from .webhooks import WebHooksTestCase, GitlabWebHooksTestCase
+import six
+
+from .webhooks import WebHooksTestCase, GitlabWebHooksTestCase, PayloadTestCase, DeliveriesTestCase
 from .gitlab import GitlabTestCase
 from .util import UtilTestCase
 from .redis import RedisModelTestCase
+from .models import UserModelTestCase
+from .memory import MemoryTestCase
+from .budget import BudgetTestCase
+from .bench import BenchTestCase
+from .ingest import IngestTestCase
+from .outbound import OutboundTestCase
+from .jsonstream import JSONStreamTestCase
+
+if six.PY3:
+    from .aio import AsyncModelTestCase
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from .base import BaseTestCase
+from .redis import FourthEntity, ThirdEntity
+from app import aio
+
+import asyncio
+
+
+class AsyncModelTestCase(BaseTestCase):
+    def setUp(self):
+        super(AsyncModelTestCase, self).setUp()
+
+        for name, team, score in [('one', 'red', 1), ('two', 'red', 2), ('three', 'blue', 3)]:
+            entity = FourthEntity(name)
+            entity.team = team
+            entity.score = score
+
+        third = ThirdEntity('one')
+        third.name = 'First'
+
+    def tearDown(self):
+        FourthEntity.deleteall()
+        ThirdEntity.deleteall()
+
+    def test_async_operations(self):
+        async def run():
+            # Lookups run concurrently and return loaded models
+            one, red, third = await asyncio.gather(FourthEntity.afindBy('name', 'one'),
+                                                   FourthEntity.afindBy('team', 'red'),
+                                                   ThirdEntity.afindBy('name', 'First'))
+            assert one.__snapshot__() is not None
+            assert one.score == 1
+            assert sorted(entity.name for entity in red) == ['one', 'two']
+            assert third.id == 'third:one'
+            assert await FourthEntity.afindBy('name', 'other') is None
+
+            assert [entity.name for entity in await FourthEntity.arange('score', 2, '+inf')] == ['two', 'three']
+            assert await FourthEntity.aexists('three')
+            assert await FourthEntity.acount() == 3
+
+            # Models are iterated loaded
+            names = []
+            async for entity in FourthEntity.aall(batch=2):
+                assert entity.__snapshot__() is not None
+                names.append(entity.name)
+            assert sorted(names) == ['one', 'three', 'two']
+
+            # Loading an existing model reads the changes of other clients
+            entity = FourthEntity('one')
+            await entity.aload()
+            FourthEntity('one').score = 10
+            assert entity.score == 1
+            await entity.arefresh()
+            assert entity.score == 10
+
+        asyncio.run(run())
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from .base import BaseTestCase
+from app import app, slack, sender
+from app.bench import run, percentile, Stats, CORPUS
+from app import microbench
+from app.models import User
+
+
+class BenchTestCase(BaseTestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        assert percentile(values, 50) == 50.0
+        assert percentile(values, 99) == 99.0
+        assert percentile([1.0], 95) == 1.0
+        assert percentile([], 50) == 0.0
+
+    def test_errors(self):
+        stats = Stats()
+        stats.request('Push Hook', 0.1, 200)
+        stats.request('Push Hook', 5.0, 500)
+        results = stats.results(1.0)
+
+        # Failed requests are reported, but not measured
+        assert results['events']['Push Hook']['count'] == 1
+        assert results['events']['Push Hook']['errors'] == 1
+        assert results['events']['Push Hook']['p99'] == 100.0
+        assert results['total']['throughput'] == 1.0
+
+    def test_run(self):
+        chat = slack.chat
+        results = run(events=20, concurrency=2)
+
+        assert results['total']['count'] == 20
+        assert len(results['events']) == len(CORPUS)
+        assert results['total']['errors'] == 0
+        for event, stats in results['events'].items():
+            assert stats['count'] == 4, event
+            assert all(status.startswith('2') for status in stats['statuses']), (event, stats['statuses'])
+        assert results['events']['Push Hook']['commands'] > 0
+        assert results['total']['slack_calls'] > 0
+
+        # The configuration, slack and the users are restored
+        assert app.config.get('TESTING')
+        assert slack.chat is chat
+        assert 'post_message' not in vars(sender)
+        assert not User.exists('gitbot-bench-0')
+
+    def test_model_benchmarks(self):
+        results = microbench.run(sizes=(10, 20), ops=5)
+
+        assert sorted(results) == ['10', '20']
+        assert sorted(results['20']) == sorted(name for name, build, op, undo in microbench.BENCHMARKS)
+        assert results['20']['get']['ops'] == 5
+        assert results['20']['get']['round_trips'] == 1
+        assert results['20']['rename']['round_trips'] == 1
+
+        # The models and the renamed index values are removed
+        assert microbench.BenchEntity.count() == 0
+        assert len(microbench.BenchEntity.__indexes__['email']) == 0
+
+        lines = microbench.compare(results, results)
+        assert len(lines) == 2 * len(microbench.BENCHMARKS)
+        assert '+0.0%' in lines[0]
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from flask import json
+from .base import BaseTestCase
+from .gitlab import TAG_PUSH, ISSUE, NAMESPACE_ISSUE, PUSH
+from app import app, redis
+from app.bench import SlackRecorder
+from app.models import User
+
+
+class Budget(object):
+    """Upper bounds for the redis round trips, commands and slack calls made
+    inside the block
+
+    A pipeline counts as a single round trip with all its commands. When a
+    bound is exceeded, the block fails with the commands and operations
+    that were sent.
+
+    Example:
+
+    ```
+    with Budget(round_trips=2, commands=5, slack=1):
+        self.app.post('/hooks/gitlab', ...)
+    ```
+    """
+    def __init__(self, round_trips, commands, slack=0):
+        self.round_trips = round_trips
+        self.commands = commands
+        self.slack = slack
+
+        self.trace = None
+        self.recorder = SlackRecorder()
+        self.calls = self.recorder.calls
+
+    def __enter__(self):
+        self.recorder.start()
+        self.trace = redis.tracing().start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.stop()
+        self.recorder.stop()
+
+        if exc_type is None:
+            self.check()
+
+        return False
+
+    def check(self):
+        exceeded = ['%s %s (limit %d)' % (used, name, limit)
+                    for name, used, limit in [('round trips', self.trace.round_trips, self.round_trips),
+                                              ('commands', self.trace.commands, self.commands),
+                                              ('slack calls', len(self.calls), self.slack)]
+                    if used > limit]
+
+        if len(exceeded) > 0:
+            raise AssertionError('Budget exceeded: %s\ncommands: %s\noperations: %s\nslack: %s' %
+                                 (', '.join(exceeded), self.trace.breakdown(), self.trace.details(),
+                                  ', '.join(self.calls)))
+
+
+class BudgetTestCase(BaseTestCase):
+    """Redis and slack usage of the gitlab hooks for each event type
+
+    Bounds are the current usage, raise them only when a handler needs the
+    extra work
+    """
+    def setUp(self):
+        super(BudgetTestCase, self).setUp()
+
+        # Send the slack messages as in production
+        self.testing = app.config.get('TESTING')
+        app.config['TESTING'] = False
+
+    def tearDown(self):
+        app.config['TESTING'] = self.testing
+
+    def post(self, event, data):
+        rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                           data=json.dumps(data), content_type='application/json',
+                           headers={'X-Gitlab-Event': event})
+
+        assert rv.status_code == 200
+
+    def test_tag_push_budget(self):
+        with Budget(round_trips=4, commands=5, slack=1):
+            self.post('Tag Push Hook', TAG_PUSH)
+
+    def test_issue_budget(self):
+        with Budget(round_trips=4, commands=4, slack=1):
+            self.post('Issue Hook', ISSUE)
+
+    def test_namespace_issue_budget(self):
+        with Budget(round_trips=7, commands=9, slack=1):
+            self.post('Issue Hook', NAMESPACE_ISSUE)
+
+    def test_push_budget(self):
+        user = User('gitbot-test')
+        user.email = 'gitbot-test@niclabs.cl'
+
+        try:
+            with Budget(round_trips=4, commands=5):
+                self.post('Push Hook', PUSH)
+        finally:
+            user.delete()
+
+    def test_budget_exceeded(self):
+        message = None
+        try:
+            with Budget(round_trips=1, commands=1):
+                User.findBy('email', 'gitbot-test@niclabs.cl')
+                User.exists('gitbot-test')
+        except AssertionError as e:
+            message = str(e)
+
+        assert message is not None
+        assert 'Budget exceeded: 2 round trips (limit 1), 2 commands (limit 1)' in message
+        assert 'EXISTS: 1' in message
+        assert 'User.findBy' in message
@@ -3,79 +3,145 @@ from __future__ import unicode_literals
 
 from flask import json
 from .base import BaseTestCase
+from app import app, redis
+from app.models import User
+
+
+class TaggedUser(User):
+    """User stored with hash tags, as with REDIS_HASH_TAGS or REDIS_CLUSTER"""
+    __hashtag__ = True
+    name = redis.Key(primary=True, prefix='@')
+
+
+TAG_PUSH = {
+    u'ref': u'refs/tags/0.0.1',
+    u'user_id': 3,
+    u'object_kind': u'tag_push',
+    u'repository': {
+        u'git_ssh_url': u'git@git.niclabs.cl:super-project/test-project.git',
+        u'name': u'test-project',
+        u'url': u'git@git.niclabs.cl:super-project/test-project.git',
+        u'git_http_url': u'http://git.niclabs.cl/super-project/test-project.git',
+        u'visibility_level': 0,
+        u'homepage': u'http://git.niclabs.cl/super-project/test-project',
+        u'description': u'My test project'
+    },
+    u'commits': [
+        {
+            u'url': u'http://git.niclabs.cl/super-project/test-project/commit/e3426f9362ce904e2f20a8c6f91a3d3d9181eccc', u'timestamp': u'2015-09-02T15:10:47-03:00',
+            u'message': u'Create readme\n',
+            u'id': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
+            u'author': {
+                u'name': u'Felipe Lalanne',
+                u'email': u'flalanne@niclabs.cl'
+            }
+        }
+    ],
+    u'after': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
+    u'checkout_sha': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
+    u'total_commits_count': 1,
+    u'message': "This is a message",
+    u'project_id': 83,
+    u'user_name': u'Felipe Lalanne',
+    u'user_email': u'flalanne@niclabs.cl',
+    u'before': u'0000000000000000000000000000000000000000'
+}
+
+ISSUE = {
+    "object_kind": "issue",
+    "user": {
+        "name": "Administrator",
+        "username": "root",
+        "avatar_url": "http://www.gravatar.com/avatar/e64c7d89f26bd1972efa854d13d7dd61?s=40\u0026d=identicon"
+    },
+    "object_attributes": {
+        "id": 301,
+        "title": "New API: create/update/delete file",
+        "assignee_id": 51,
+        "author_id": 51,
+        "project_id": 14,
+        "created_at": "2013-12-03T17:15:43Z",
+        "updated_at": "2013-12-03T17:15:43Z",
+        "position": 0,
+        "branch_name": None,
+        "description": "Create new API for manipulations with repository",
+        "milestone_id": None,
+        "state": "opened",
+        "iid": 23,
+        "url": "http://example.com/diaspora/issues/23",
+        "action": "siopen"
+    }
+}
+
+NAMESPACE_ISSUE = {
+    "object_attributes": {
+        "action": "close",
+        "assignee_id": 3,
+        "author_id": 3,
+        "branch_name": None,
+        "created_at": "2015-08-29 21:59:03 UTC",
+        "description": "This is an issue",
+        "id": 54,
+        "iid": 1,
+        "milestone_id": None,
+        "position": 0,
+        "project_id": 83,
+        "state": "closed",
+        "title": "Created issue",
+        "updated_at": "2015-08-29 22:30:31 UTC",
+        "url": "http://git.niclabs.cl/flalanne/test-project/issues/1"
+    },
+    "object_kind": "issue",
+    "user": {
+        "avatar_url": "http://git.niclabs.cl/uploads/user/avatar/3/me.jpg",
+        "name": "Felipe Lalanne",
+        "username": "flalanne"
+    }
+}
+
+COMMIT = {
+    u'id': u'b6568db1bc1dcd7f8b4d5a946b0b91f9dacd7327',
+    u'message': u'Update Catalan translation to e38cb41.',
+    u'timestamp': u'2011-12-12T14:27:31+02:00',
+    u'url': u'http://example.com/mike/diaspora/commit/b6568db1bc1dcd7f8b4d5a946b0b91f9dacd7327',
+    u'author': {
+        u'name': u'Gitbot Test',
+        u'email': u'gitbot-test@niclabs.cl'
+    }
+}
+
+PUSH = {
+    u'object_kind': u'push',
+    u'before': u'95790bf891e76fee5e1747ab589903a6a1f80f22',
+    u'after': u'da1560886d4f094c3e6c9ef40349f7d38b5d27d7',
+    u'ref': u'refs/heads/master',
+    u'user_id': 4,
+    u'user_name': u'Gitbot Test',
+    u'user_email': u'gitbot-test@niclabs.cl',
+    u'project_id': 15,
+    u'repository': {
+        u'name': u'Diaspora',
+        u'url': u'git@example.com:mike/diasporadiaspora.git',
+        u'description': u'',
+        u'homepage': u'http://example.com/mike/diaspora'
+    },
+    u'commits': [COMMIT, COMMIT, COMMIT],
+    u'total_commits_count': 3
+}
 
 
 class GitlabTestCase(BaseTestCase):
     def test_tag_push_hook(self):
-        data = {
-            u'ref': u'refs/tags/0.0.1',
-            u'user_id': 3,
-            u'object_kind': u'tag_push',
-            u'repository': {
-                u'git_ssh_url': u'git@git.niclabs.cl:super-project/test-project.git',
-                u'name': u'test-project',
-                u'url': u'git@git.niclabs.cl:super-project/test-project.git',
-                u'git_http_url': u'http://git.niclabs.cl/super-project/test-project.git',
-                u'visibility_level': 0,
-                u'homepage': u'http://git.niclabs.cl/super-project/test-project',
-                u'description': u'My test project'
-            },
-            u'commits': [
-                {
-                    u'url': u'http://git.niclabs.cl/super-project/test-project/commit/e3426f9362ce904e2f20a8c6f91a3d3d9181eccc', u'timestamp': u'2015-09-02T15:10:47-03:00',
-                    u'message': u'Create readme\n',
-                    u'id': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
-                    u'author': {
-                        u'name': u'Felipe Lalanne',
-                        u'email': u'flalanne@niclabs.cl'
-                    }
-                }
-            ],
-            u'after': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
-            u'checkout_sha': u'e3426f9362ce904e2f20a8c6f91a3d3d9181eccc',
-            u'total_commits_count': 1,
-            u'message': "This is a message",
-            u'project_id': 83,
-            u'user_name': u'Felipe Lalanne',
-            u'user_email': u'flalanne@niclabs.cl',
-            u'before': u'0000000000000000000000000000000000000000'
-        }
         rv = self.app.post('/hooks/gitlab', follow_redirects=True,
-                           data=json.dumps(data), content_type='application/json',
+                           data=json.dumps(TAG_PUSH), content_type='application/json',
                            headers={'X-Gitlab-Event': 'Tag Push Hook'})
 
         assert rv.status_code == 200
         assert rv.data.decode('utf-8') == """Version 0.0.1 of <http://git.niclabs.cl/super-project/test-project|super-project/test-project> has been published by <@flalanne>. Let's celebrate team *super-project*!! :balloon::confetti_ball::tada:"""
 
     def test_issues_hook_without_namespace(self):
-        data = {
-            "object_kind": "issue",
-            "user": {
-                "name": "Administrator",
-                "username": "root",
-                "avatar_url": "http://www.gravatar.com/avatar/e64c7d89f26bd1972efa854d13d7dd61?s=40\u0026d=identicon"
-            },
-            "object_attributes": {
-                "id": 301,
-                "title": "New API: create/update/delete file",
-                "assignee_id": 51,
-                "author_id": 51,
-                "project_id": 14,
-                "created_at": "2013-12-03T17:15:43Z",
-                "updated_at": "2013-12-03T17:15:43Z",
-                "position": 0,
-                "branch_name": None,
-                "description": "Create new API for manipulations with repository",
-                "milestone_id": None,
-                "state": "opened",
-                "iid": 23,
-                "url": "http://example.com/diaspora/issues/23",
-                "action": "siopen"
-            }
-        }
-
         rv = self.app.post('/hooks/gitlab', follow_redirects=True,
-                           data=json.dumps(data), content_type='application/json',
+                           data=json.dumps(ISSUE), content_type='application/json',
                            headers={'X-Gitlab-Event': 'Issue Hook'})
 
         assert rv.status_code == 200
@@ -84,37 +150,63 @@ class GitlabTestCase(BaseTestCase):
 > Create new API for manipulations with repository"""
 
     def test_issues_hook_with_namespace(self):
-        data = {
-            "object_attributes": {
-                "action": "close",
-                "assignee_id": 3,
-                "author_id": 3,
-                "branch_name": None,
-                "created_at": "2015-08-29 21:59:03 UTC",
-                "description": "This is an issue",
-                "id": 54,
-                "iid": 1,
-                "milestone_id": None,
-                "position": 0,
-                "project_id": 83,
-                "state": "closed",
-                "title": "Created issue",
-                "updated_at": "2015-08-29 22:30:31 UTC",
-                "url": "http://git.niclabs.cl/flalanne/test-project/issues/1"
-            },
-            "object_kind": "issue",
-            "user": {
-                "avatar_url": "http://git.niclabs.cl/uploads/user/avatar/3/me.jpg",
-                "name": "Felipe Lalanne",
-                "username": "flalanne"
-            }
-        }
-
         rv = self.app.post('/hooks/gitlab', follow_redirects=True,
-                           data=json.dumps(data), content_type='application/json',
+                           data=json.dumps(NAMESPACE_ISSUE), content_type='application/json',
                            headers={'X-Gitlab-Event': 'Issue Hook'})
 
         assert rv.status_code == 200
         assert rv.data.decode('utf-8') == """<@flalanne> closed <http://git.niclabs.cl/flalanne/test-project/issues/1|issue #1> in <http://git.niclabs.cl/flalanne/test-project|flalanne/test-project>: *Created issue*
 
 > This is an issue"""
+
+    def test_render_slack_user_with_hash_tags(self):
+        user = TaggedUser('gitbot-test')
+
+        try:
+            assert user.id == '{tagged_user}@gitbot-test'
+            assert app.jinja_env.filters['render_slack_user'](user) == '<@gitbot-test>'
+        finally:
+            user.delete()
+
+    def test_push_hook(self):
+        user = User('gitbot-test')
+        user.email = 'gitbot-test@niclabs.cl'
+
+        try:
+            rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                               data=json.dumps(PUSH), content_type='application/json',
+                               headers={'X-Gitlab-Event': 'Push Hook'})
+
+            assert rv.status_code == 200
+            assert user.commits_total == 3
+        finally:
+            user.delete()
+
+    def test_large_push_hook(self):
+        user = User('gitbot-test')
+        user.email = 'gitbot-test@niclabs.cl'
+
+        other = dict(COMMIT, author={'name': 'Other', 'email': 'other@niclabs.cl'})
+        data = dict(PUSH, commits=[COMMIT, other] * 2000, total_commits_count=4000)
+
+        try:
+            rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                               data=json.dumps(data), content_type='application/json',
+                               headers={'X-Gitlab-Event': 'Push Hook'})
+
+            assert rv.status_code == 200
+            assert user.commits_total == 2000
+        finally:
+            user.delete()
+
+    def test_push_hook_too_large(self):
+        limit = app.config.get('MAX_CONTENT_LENGTH')
+        app.config['MAX_CONTENT_LENGTH'] = 1024
+        try:
+            rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                               data=json.dumps(dict(PUSH, commits=[COMMIT] * 100)), content_type='application/json',
+                               headers={'X-Gitlab-Event': 'Push Hook'})
+
+            assert rv.status_code == 413
+        finally:
+            app.config['MAX_CONTENT_LENGTH'] = limit
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from flask import json
+from .base import BaseTestCase
+from .gitlab import PUSH
+from app import app, webhooks, r
+from app.ingest import EventQueue, WorkerPool
+from app.models import User
+
+import time
+
+hook = "/tests/3BvXf1pQa5hNmr0Kd7yTzW2eLc9UuGiSjOo4VxAbC8E"
+
+# Deliveries of the failing event before it succeeds
+failures = {'count': 0}
+
+
+@webhooks.hook(hook)
+class FailingHook:
+    def event(self, request):
+        return 'some_event'
+
+    def some_event(self, data):
+        if failures['count'] > 0:
+            failures['count'] -= 1
+            raise RuntimeError('Failed delivery')
+
+        return 'delivered'
+
+
+class IngestTestCase(BaseTestCase):
+    def setUp(self):
+        super(IngestTestCase, self).setUp()
+        self.queue = EventQueue(r, 'test:webhooks', 'test')
+        self.queue.create_group()
+        self.pool = WorkerPool(app, webhooks, self.queue, workers=2, retries=2, timeout=0.01)
+        webhooks.queue = self.queue
+
+    def tearDown(self):
+        webhooks.queue = None
+        r.delete('test:webhooks')
+
+    def pending(self):
+        return r.xpending_range('test:webhooks', 'test', '-', '+', 10)
+
+    def test_queued_event(self):
+        user = User('gitbot-test')
+        user.email = 'gitbot-test@niclabs.cl'
+
+        try:
+            rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                               data=json.dumps(PUSH), content_type='application/json',
+                               headers={'X-Gitlab-Event': 'Push Hook'})
+
+            # The event is handled by a worker
+            assert rv.status_code == 202
+            assert len(self.queue) == 1
+            assert 'commits_total' not in user
+
+            assert self.pool.poll('consumer') == 1
+            assert user.commits_total == 3
+            assert self.pending() == []
+            assert self.pool.poll('consumer') == 0
+        finally:
+            user.delete()
+
+    def test_invalid_event(self):
+        rv = self.app.post('/hooks/gitlab', follow_redirects=True,
+                           data=json.dumps(PUSH), content_type='application/json',
+                           headers={'X-Gitlab-Event': 'Unknown Hook'})
+
+        assert rv.status_code == 501
+        assert len(self.queue) == 0
+
+    def test_retries(self):
+        # The event fails on the first delivery and it is delivered again
+        failures['count'] = 1
+        rv = self.app.post(hook, data=json.dumps({'value': 1}), content_type='application/json')
+        assert rv.status_code == 202
+
+        assert self.pool.poll('one') == 1
+        assert [entry['times_delivered'] for entry in self.pending()] == [1]
+
+        # Failed events are claimed once the retry timeout expires
+        time.sleep(0.02)
+        assert self.pool.poll('two') == 1
+        assert self.pending() == []
+        assert failures['count'] == 0
+
+        # Events are dropped after failing the last delivery
+        failures['count'] = 2
+        self.queue.push('failing_hook', 'some_event', {'value': 2})
+
+        assert self.pool.poll('one') == 1
+        time.sleep(0.02)
+        assert self.pool.poll('two') == 1
+        assert self.pending() == []
+        assert failures['count'] == 0
+
+    def test_workers(self):
+        for value in range(5):
+            self.queue.push('failing_hook', 'some_event', {'value': value})
+
+        self.pool.block = 10
+        self.pool.start()
+        try:
+            for attempt in range(100):
+                if len(self.pending()) == 0 and self.pool.poll('main') == 0:
+                    break
+        finally:
+            self.pool.stop()
+
+        assert self.pending() == []
+        assert r.xlen('test:webhooks') == 5
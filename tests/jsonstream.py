@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from app.jsonstream import JSONStream
+
+import io
+import json
+import unittest
+
+DOCUMENT = {
+    'object_kind': 'push',
+    'total_commits_count': 1234567890,
+    'ratio': 0.125,
+    'empty': [],
+    'repository': {'name': 'Diaspora', 'tags': ['a', 'b']},
+    'commits': [{'id': n, 'message': 'Cañón ☃ commit %d' % n} for n in range(50)],
+    'after': None,
+    'deleted': False
+}
+
+
+class JSONStreamTestCase(unittest.TestCase):
+    def stream(self, document, chunk=7):
+        return JSONStream(io.BytesIO(json.dumps(document, ensure_ascii=False).encode('utf-8')), chunk=chunk)
+
+    def test_members(self):
+        # Small chunks split the numbers and the multibyte characters
+        members = {}
+        commits = []
+        for key, value in self.stream(DOCUMENT).members(streamed=('commits', 'empty')):
+            if key in ('commits', 'empty'):
+                commits += list(value)
+            else:
+                members[key] = value
+
+        assert commits == DOCUMENT['commits']
+        assert members == dict((key, value) for key, value in DOCUMENT.items() if key not in ('commits', 'empty'))
+
+    def test_skip_items(self):
+        members = []
+        for key, value in self.stream(DOCUMENT).members(streamed=('commits',)):
+            members.append(key)
+            if key == 'commits':
+                assert next(value) == DOCUMENT['commits'][0]
+
+        assert sorted(members) == sorted(DOCUMENT)
+
+    def test_empty_object(self):
+        assert list(self.stream({}).members()) == []
+
+    def test_invalid_document(self):
+        for document in [b'', b'[]', b'{"commits": [1, 2', b'{"one": 1 "two": 2}']:
+            try:
+                list(JSONStream(io.BytesIO(document), chunk=4).members(streamed=('commits',)))
+                assert False, document
+            except ValueError:
+                pass
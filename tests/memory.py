@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from redis.exceptions import ResponseError
+from .base import BaseTestCase
+from app import memory
+from app.memory import Memory
+
+
+class MemoryTestCase(BaseTestCase):
+    def setUp(self):
+        super(MemoryTestCase, self).setUp()
+        self.engine = Memory()
+
+    def test_key_operations(self):
+        engine = self.engine
+
+        assert engine.set('one', 'value')
+        assert engine.get('one') == b'value'
+        assert engine.exists('one', 'two') == 1
+
+        assert engine.rename('one', 'two')
+        assert engine.get('one') is None
+        assert engine.get('two') == b'value'
+
+        engine.hset('hash:one', 'field', 1)
+        engine.sadd('set:one', 'a', 'b')
+        assert sorted(engine.scan_iter(match='*:one')) == [b'hash:one', b'set:one']
+
+        engine.sadd('set:two', 'b', 'c')
+        assert engine.sunionstore('set:two', ['set:two', 'set:one']) == 3
+        assert engine.smembers('set:two') == set([b'a', b'b', b'c'])
+
+        # Expired keys are removed
+        assert engine.expire('two', 0)
+        assert engine.exists('two') == 0
+
+        assert engine.set('three', 'value', ex=60, nx=True)
+        assert engine.set('three', 'other', nx=True) is None
+        assert engine.get('three') == b'value'
+        assert 0 < engine.ttl('three') <= 60
+        assert engine.set('four', 'value', xx=True) is None
+        assert engine.set('four', 'value', px=0)
+        assert engine.exists('four') == 0
+
+        assert engine.delete('hash:one', 'set:one', 'other') == 2
+
+        try:
+            engine.sadd('hash', 'value')
+            engine.hget('hash', 'field')
+            assert False
+        except ResponseError:
+            assert True
+
+    def test_hash_operations(self):
+        engine = self.engine
+
+        assert engine.hset('hash', 'one', 1) == 1
+        assert engine.hset('hash', 'one', 'first') == 0
+        assert engine.hincrby('hash', 'two', 2) == 2
+        assert engine.hincrby('hash', 'two', -3) == -1
+
+        assert engine.hgetall('hash') == {b'one': b'first', b'two': b'-1'}
+        assert engine.hmget('hash', ['one', 'other']) == [b'first', None]
+        assert engine.hlen('hash') == 2
+        assert engine.hexists('hash', 'two')
+
+        # Empty hashes are deleted
+        assert engine.hdel('hash', 'one', 'two') == 2
+        assert engine.exists('hash') == 0
+
+    def test_sorted_set_operations(self):
+        engine = self.engine
+
+        assert engine.zadd('zset', {'a': 1, 'b': 2, 'c': 3}) == 3
+        assert engine.zincrby('zset', 2, 'a') == 3.0
+        assert engine.zrangebyscore('zset', '(2', '+inf') == [b'a', b'c']
+        assert engine.zrangebyscore('zset', '-inf', '+inf', start=1, num=1) == [b'a']
+        assert engine.zcount('zset', 2, 3) == 3
+        assert engine.zrevrange('zset', 0, 0, withscores=True) == [(b'c', 3.0)]
+        assert engine.zrevrank('zset', 'b') == 2
+        assert engine.zscore('zset', 'other') is None
+
+        engine.zadd('other', {'b': 1})
+        assert engine.zunionstore('union', ['zset', 'other']) == 3
+        assert engine.zscore('union', 'b') == 3.0
+
+    def test_pipeline_and_scripts(self):
+        engine = self.engine
+
+        pipeline = engine.pipeline()
+        pipeline.hset('hash', 'field', 'value').sadd('set', 'hash')
+        pipeline.hincrby('hash', 'count', 2)
+        assert len(pipeline) == 3
+        assert engine.exists('hash') == 0
+        assert pipeline.execute() == [1, 1, 2]
+
+        script = engine.register_script("""
+        local value = redis.call('HINCRBY', KEYS[1], 'count', ARGV[1])
+        redis.call('ZADD', KEYS[2], value, KEYS[1])
+        return {value, redis.call('HGET', KEYS[1], 'field'), redis.call('GET', 'none')}
+        """)
+        assert script(keys=['hash', 'zset'], args=[3]) == [5, b'value', None]
+        assert engine.zscore('zset', 'hash') == 5.0
+
+        script(keys=['hash', 'zset'], args=[1], client=pipeline)
+        assert pipeline.execute() == [[6, b'value', None]]
+
+        error = engine.register_script("return redis.call('HGET', KEYS[1], 'field')")
+        try:
+            error(keys=['set'])
+            assert False
+        except ResponseError:
+            assert True
+
+    def test_stream_operations(self):
+        engine = self.engine
+
+        assert engine.xgroup_create('stream', 'group', id='0', mkstream=True)
+        first = engine.xadd('stream', {'field': 'one'})
+        second = engine.xadd('stream', {'field': 'two'}, maxlen=10)
+        assert engine.xlen('stream') == 2
+
+        try:
+            engine.xgroup_create('stream', 'group')
+            assert False
+        except ResponseError as e:
+            assert str(e).startswith('BUSYGROUP')
+
+        # Entries are delivered once to the consumers of the group
+        assert engine.xreadgroup('group', 'a', {'stream': '>'}, count=1) == [[b'stream', [(first, {b'field': b'one'})]]]
+        assert engine.xreadgroup('group', 'b', {'stream': '>'}, block=10) == [[b'stream', [(second, {b'field': b'two'})]]]
+        assert engine.xreadgroup('group', 'b', {'stream': '>'}, block=10) == []
+
+        pending = engine.xpending_range('stream', 'group', '-', '+', 10)
+        assert [(entry['message_id'], entry['consumer'], entry['times_delivered']) for entry in pending] == \
+            [(first, b'a', 1), (second, b'b', 1)]
+        assert engine.xpending_range('stream', 'group', '-', '+', 10, idle=60000) == []
+
+        # Pending entries can be claimed by other consumers
+        assert engine.xclaim('stream', 'group', 'b', 0, [first]) == [(first, {b'field': b'one'})]
+        assert engine.xpending_range('stream', 'group', '-', '+', 10, consumername='b')[0]['times_delivered'] == 2
+        assert engine.xack('stream', 'group', first, second) == 2
+        assert engine.xpending_range('stream', 'group', '-', '+', 10) == []
+
+        # Streams are trimmed to maxlen
+        engine.xadd('stream', {'field': 'three'}, maxlen=1, approximate=False)
+        assert engine.xlen('stream') == 1
+
+    def test_lua_runtime(self):
+        class Lua54Runtime(object):
+            """Runtime without the functions of lua 5.1"""
+            def __init__(self, **kwargs):
+                pass
+
+            def eval(self, code):
+                return {b'_VERSION': b'Lua 5.4'}.get(code)
+
+        # The scripts need the functions of lua 5.1 (e.g. unpack)
+        runtime = memory.LuaRuntime
+        memory.LuaRuntime = Lua54Runtime
+        try:
+            Memory()
+            assert False
+        except RuntimeError as e:
+            assert 'Lua 5.4' in str(e)
+        finally:
+            memory.LuaRuntime = runtime
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+from .base import BaseTestCase
+from app import redis, r
+from app.models import User
+
+
+class UserModelTestCase(BaseTestCase):
+    def setUp(self):
+        super(UserModelTestCase, self).setUp()
+
+        self.user = User('gitbot-test')
+        self.other = User('gitbot-other-test')
+
+    def tearDown(self):
+        self.user.delete()
+        self.other.delete()
+
+    def test_update_commits(self):
+        today = datetime.now()
+
+        self.user.update_commits(2, now=today - timedelta(days=40))
+        self.user.update_commits(3, now=today - timedelta(days=10))
+        self.user.update_commits(1, now=today - timedelta(days=3))
+        self.user.update_commits(4)
+        self.user.update_commits(1)
+
+        assert self.user.commits_in_last_day == 5
+        assert self.user.commits_in_last_week == 6
+        assert self.user.commits_in_last_month == 9
+        assert self.user.commits_in_last_year == 11
+        assert self.user.commits.last(4) == 6
+        assert self.user.commits_total == 11
+        assert self.user.days == 4
+        assert abs((self.user.commits_updated - today).total_seconds()) < 60
+
+        # Counts decrease without new commits
+        assert self.user.commits.last(1, now=today + timedelta(days=1)) == 0
+        assert self.user.commits.last(30, now=today + timedelta(days=25)) == 6
+
+        # Buckets older than the retention period are removed
+        self.user.update_commits(1, now=today + timedelta(days=360))
+        assert self.user.commits.last(366, now=today + timedelta(days=360)) == 7
+        assert r.hlen(User.commits.key(self.user)) == 3
+
+    def test_update_no_commits(self):
+        # Pushes without commits do not count as active days
+        self.user.update_commits(0)
+        assert self.user.commits_total == 0
+        assert 'days' not in self.user
+
+        self.user.update_commits(2)
+        self.user.update_commits(0)
+        assert self.user.commits_total == 2
+        assert self.user.days == 1
+
+    def test_update_many_commits(self):
+        with redis.session():
+            User.update_many_commits({self.user: 4, 'gitbot-other-test': 1})
+
+            # Reading the counters flushes the session
+            assert self.user.commits_total == 4
+
+        assert self.other.commits_total == 1
+
+    def test_commit_rankings(self):
+        today = datetime.now()
+
+        User.update_many_commits({self.user: 2, self.other: 5}, now=today - timedelta(days=3))
+        assert User.top('commits_in_last_week', n=2) == [(self.other, 5), (self.user, 2)]
+
+        # Rankings are kept up to date after being built
+        User.update_many_commits({self.user: 4})
+        assert User.top('commits_in_last_week', n=1) == [(self.user, 6)]
+        assert self.user.rank('commits_in_last_week') == 1
+        assert self.other.rank('commits_in_last_week') == 2
+
+        assert User.top('commits_in_last_day') == [(self.user, 4)]
+        assert self.other.rank('commits_in_last_day') is None
+
+        # Old commits leave the window
+        assert User.top('commits_in_last_week', now=today + timedelta(days=5)) == [(self.user, 4)]
+
+    def test_inactive_users(self):
+        today = datetime.now()
+
+        self.user.update_commits(1, now=today - timedelta(days=40))
+        self.other.update_commits(1, now=today - timedelta(days=2))
+
+        assert self.user in User.inactive(days=30)
+        assert self.other not in User.inactive(days=30)
+        assert self.user in User.range('commits_total', 1, 1)
@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from flask import json
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import parse_qsl
+from .base import BaseTestCase
+from app import app, r
+from app.outbound import SlackSender, Coalescer
+
+import threading
+import time
+
+
+class FakeSlack(object):
+    """Slack API on a local port, answering the requests with the scripted
+    responses and then with ok"""
+    def __init__(self):
+        self.messages = []
+        self.responses = []
+        self.connections = set()
+        slack = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                fields = dict(parse_qsl(self.rfile.read(int(self.headers.get('Content-Length'))).decode('utf-8')))
+                status, headers, body = slack.responses.pop(0) if slack.responses else (200, {}, {'ok': True})
+                if status == 200:
+                    slack.messages.append((self.path, fields, self.headers.get('Authorization'), time.time()))
+                slack.connections.add(self.client_address)
+
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def texts(self, channel):
+        return [fields['text'] for path, fields, authorization, sent in self.messages if fields['channel'] == channel]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OutboundTestCase(BaseTestCase):
+    def setUp(self):
+        super(OutboundTestCase, self).setUp()
+        self.slack = FakeSlack()
+        self.senders = []
+
+    def tearDown(self):
+        for sender in self.senders:
+            sender.stop()
+        self.slack.close()
+        r.delete('test:slack')
+
+    def sender(self, **options):
+        options = dict(dict(key='test:slack', workers=2, rate=100.0, burst=10, backoff=0.01), **options)
+        sender = SlackSender('token', r, url=self.slack.url, **options)
+        self.senders.append(sender)
+        return sender
+
+    def test_send(self):
+        sender = self.sender()
+        for text in ['one', 'two', 'three']:
+            sender.post_message('#first', text)
+        for text in ['four', 'five']:
+            sender.post_message('#second', text, as_user=True)
+
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['one', 'two', 'three']
+        assert self.slack.texts('#second') == ['four', 'five']
+
+        path, fields, authorization, sent = self.slack.messages[-1]
+        assert path == '/api/chat.postMessage'
+        assert authorization == 'Bearer token'
+
+        # Connections are kept alive
+        assert len(self.slack.connections) <= 2
+
+    def test_channel_rate(self):
+        sender = self.sender(rate=10.0, burst=1)
+        for text in ['one', 'two', 'three']:
+            sender.post_message('#first', text)
+
+        assert sender.flush(5)
+        times = [sent for path, fields, authorization, sent in self.slack.messages]
+        assert times[2] - times[0] >= 0.15
+
+    def test_retry_after(self):
+        self.slack.responses.append((429, {'Retry-After': '0.3'}, {'ok': False, 'error': 'ratelimited'}))
+        sender = self.sender()
+
+        start = time.time()
+        sender.post_message('#first', 'one')
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['one']
+        assert self.slack.messages[0][3] - start >= 0.3
+
+    def test_rate_limit_retries(self):
+        # Messages refused with 429 are dropped when the attempts are exhausted
+        self.slack.responses += [(429, {'Retry-After': '0.01'}, {'ok': False, 'error': 'ratelimited'})] * 3
+        sender = self.sender(retries=2)
+        sender.post_message('#first', 'one')
+        sender.post_message('#first', 'two')
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['two']
+
+    def test_retries(self):
+        self.slack.responses += [(500, {}, {}), (503, {}, {})]
+        sender = self.sender(retries=2)
+        sender.post_message('#first', 'one')
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['one']
+
+        # Messages are dropped when the attempts are exhausted
+        self.slack.responses += [(500, {}, {}), (500, {}, {}), (500, {}, {})]
+        sender.post_message('#first', 'two')
+        sender.post_message('#first', 'three')
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['one', 'three']
+
+    def test_spill(self):
+        sender = self.sender(workers=0, size=2)
+        for n in range(5):
+            sender.post_message('#first', 'message %d' % n)
+
+        # The messages that do not fit in memory wait in redis
+        assert sender.size == 2
+        assert r.llen('test:slack') == 3
+
+        sender.workers = 2
+        sender.start()
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['message %d' % n for n in range(5)]
+        assert r.llen('test:slack') == 0
+
+    def test_stop(self):
+        sender = self.sender(workers=0)
+        sender.post_message('#first', 'one')
+        sender.post_message('#second', 'two')
+        sender.stop()
+        assert r.llen('test:slack') == 2
+
+        # The messages are sent by the next sender
+        sender = self.sender()
+        sender.start()
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['one']
+        assert self.slack.texts('#second') == ['two']
+
+    def test_digest(self):
+        sender = self.sender()
+        digests = Coalescer(app, sender, windows={'issue': 1.0}, channels={'#second': {'issue': 0}}, items=2)
+        for n in range(4):
+            digests.post_message('#first', 'issue', 'Issue %d\nDescription' % n)
+            digests.post_message('#second', 'issue', 'Issue %d' % n)
+        digests.post_message('#first', 'tag_push', 'Tag')
+
+        # The first message opens the window, the rest are sent when it closes
+        assert sender.flush(5)
+        assert self.slack.texts('#first') == ['Issue 0\nDescription', 'Tag']
+        assert self.slack.texts('#second') == ['Issue %d' % n for n in range(4)]
+
+        time.sleep(1.2)
+        assert sender.flush(5)
+        texts = self.slack.texts('#first')
+        assert len(texts) == 3
+        assert texts[2] == '*3 issue events* in the last 1.0 seconds:\n\u2022 Issue 1\n\u2022 Issue 2\nand 1 more'
+
+        # A single message in the window is sent as is
+        digests.post_message('#first', 'issue', 'Issue 4')
+        digests.post_message('#first', 'issue', 'Issue 5')
+        time.sleep(1.2)
+        assert sender.flush(5)
+        assert self.slack.texts('#first')[3:] == ['Issue 4', 'Issue 5']
@@ -1,21 +1,113 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+from redis.commands.core import CoreCommands
+from redis.crc import key_slot
+from redis.exceptions import NoScriptError
 from .base import BaseTestCase
-from app import redis
+from app import redis, r
+from app.memory import Memory
+
+import hashlib
 
 
 class Entity(redis.Model):
     __prefix__ = 'entity:'
+    name = redis.Key()
+    data = redis.Key()
 
 
 class OtherEntity(redis.Model):
     primary = redis.Key(primary=True)
+    name = redis.Key()
+    data = redis.Key()
 
 
 class ThirdEntity(redis.Model):
     id = redis.Key(prefix='third:', primary=True)
     name = redis.Key(index=True)
+    data = redis.Key()
+
+
+class FourthEntity(redis.Model):
+    name = redis.Key(primary=True)
+    team = redis.Key(index='set')
+    score = redis.Key(converter=int, index='sorted')
+
+
+class TypedEntity(redis.Model):
+    name = redis.Key(primary=True)
+    count = redis.Int()
+    ratio = redis.Float()
+    active = redis.Bool()
+    updated = redis.DateTime(format='%Y-%m-%d')
+    data = redis.JSON()
+
+
+def tagged_entity(hashtag):
+    """Return a model class using hash tags or not, with the same name"""
+    return type(str('TaggedEntity'), (redis.Model,), {
+        '__hashtag__': hashtag,
+        'name': redis.Key(primary=True),
+        'email': redis.Key(index=True),
+        'team': redis.Key(index='set'),
+        'score': redis.Int(index='sorted'),
+        'visits': redis.Counter(retention=7, windows=[7])
+    })
+
+
+class FakeCluster(object):
+    """Client of a new cluster storing the data in 'client'
+
+    It only runs the scripts loaded with script_load(), and its pipelines,
+    like redis.cluster.ClusterPipeline, are not a redis.client.Pipeline and
+    do not load the scripts they buffer
+    """
+    def __init__(self, client):
+        self.client = client
+        self.scripts = set()
+
+    def script_load(self, script):
+        self.scripts.add(hashlib.sha1(script.encode('utf-8')).hexdigest())
+        return self.client.script_load(script)
+
+    def execute_command(self, *args, **options):
+        if args[0] == 'EVALSHA' and args[1] not in self.scripts:
+            raise NoScriptError('No matching script. Please use EVAL.')
+
+        return self.client.execute_command(*args, **options)
+
+    def pipeline(self, transaction=True):
+        return FakeClusterPipeline(self)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class FakeClusterPipeline(CoreCommands):
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.commands = []
+
+    def execute_command(self, *args, **options):
+        self.commands.append((args, options))
+        return self
+
+    def script_load_for_pipeline(self, *args, **kwargs):
+        raise NotImplementedError('Method is not supported in pipeline')
+
+    def __len__(self):
+        return len(self.commands)
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self):
+        try:
+            return [self.cluster.execute_command(*args, **options) for args, options in self.commands]
+        finally:
+            self.reset()
 
 
 class RedisModelTestCase(BaseTestCase):
@@ -23,6 +115,10 @@ class RedisModelTestCase(BaseTestCase):
         Entity.deleteall()
         OtherEntity.deleteall()
         ThirdEntity.deleteall()
+        FourthEntity.deleteall()
+        TypedEntity.deleteall()
+        for key in r.scan_iter(match='*tagged_entity*'):
+            r.delete(key)
 
     def test_model_operations(self):
         entity = Entity('one')
@@ -188,3 +284,447 @@ class RedisModelTestCase(BaseTestCase):
         del name_index['First']
         assert 'First' not in name_index
         del name_index['Second']
+
+    def test_session_operations(self):
+        with redis.session() as session:
+            one = ThirdEntity('one')
+            one['name'] = 'First'
+            one['data'] = 'Number one'
+            one.incrby('count', 2)
+
+            # Nested sessions share the outermost session
+            with redis.session() as nested:
+                assert nested is session
+
+                two = ThirdEntity('two')
+                two['name'] = 'Second'
+
+            # Nothing has been sent to redis yet
+            assert not r.exists('third:one')
+
+            # Buffered values are visible inside the session
+            assert one['name'] == 'First'
+            assert one['data'] == 'Number one'
+
+            # Reading an incremented value flushes the session
+            assert one['count'] == 2
+            assert r.exists('third:one')
+
+            one['name'] = 'First NEW'
+            del two['name']
+
+        assert ThirdEntity.findBy('name', 'First NEW') == one
+        assert ThirdEntity.findBy('name', 'First') is None
+        assert ThirdEntity.findBy('name', 'Second') is None
+        assert two['name'] is None
+
+    def test_session_bytes(self):
+        with redis.session():
+            entity = TypedEntity('one')
+            entity.count = b'3'
+            entity.data = b'{"a": 1}'
+
+            # Bytes are read as they will be stored
+            assert entity.count == 3
+            assert entity.data == {'a': 1}
+
+        assert entity.count == 3
+        assert r.hget(entity.id, 'count') == b'3'
+
+    def test_session_rollback(self):
+        try:
+            with redis.session():
+                one = ThirdEntity('one')
+                one['name'] = 'First'
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert not ThirdEntity.exists('one')
+        assert ThirdEntity.findBy('name', 'First') is None
+
+    def test_load_operations(self):
+        one = ThirdEntity('one')
+        one['name'] = 'First'
+        one['count'] = 1
+
+        two = ThirdEntity('two')
+        two['name'] = 'Second'
+
+        first, second, missing = ThirdEntity.get_many(['one', 'third:two', 'three'])
+        assert first == one
+        assert second == two
+        assert missing is None
+        assert dict(first.items()) == {'id': 'one', 'name': 'First', 'count': 1}
+
+        # Changes from other clients are not seen until refresh
+        one['count'] = 2
+        assert first['count'] == 1
+        assert first.refresh()['count'] == 2
+
+        # Writes through the model update the snapshot
+        first.incrby('count', 3)
+        del first['name']
+        assert first['count'] == 5
+        assert 'name' not in first
+        assert ThirdEntity('one').load()['count'] == 5
+
+        assert set(e.id for e in ThirdEntity.all(load=True, batch=1)) == set([one.id, two.id])
+
+    def test_load_bytes(self):
+        entity = TypedEntity('one').load()
+        entity.count = b'3'
+
+        # The snapshot keeps bytes as stored in redis
+        assert entity.__data__['count'] == b'3'
+        assert entity.count == 3
+
+    def test_members_operations(self):
+        one = ThirdEntity('one')
+        one['name'] = 'First'
+
+        two = ThirdEntity('two')
+        two['name'] = 'Second'
+
+        index = ThirdEntity.__indexes__['name']
+        assert ThirdEntity.count() == 2
+        assert len(index) == 2
+        assert set(index) == set(['First', 'Second'])
+
+        one['name'] = 'First NEW'
+        assert set(index) == set(['First NEW', 'Second'])
+
+        two.delete()
+        assert ThirdEntity.count() == 1
+        assert len(index) == 1
+        assert [e.id for e in ThirdEntity.all()] == [one.id]
+
+        # Members sets can be rebuilt from existing keys
+        r.delete(ThirdEntity.__members__, index.__members__)
+        assert ThirdEntity.count() == 0
+        ThirdEntity.rebuild()
+        assert ThirdEntity.count() == 1
+        assert set(index) == set(['First NEW'])
+
+    def test_deleteall(self):
+        TaggedEntity = tagged_entity(False)
+
+        for name in ['one', 'two']:
+            entity = TaggedEntity(name)
+            entity.email = name + '@example.com'
+            entity.team = 'red'
+            entity.score = 1
+            entity.visits.incr()
+            entity.visits.incr(now=datetime.now() - timedelta(days=3))
+        assert TaggedEntity.visits.top(7)[0][1] == 2
+
+        # The counters and their rankings are deleted with the models
+        TaggedEntity.deleteall()
+        assert list(r.scan_iter(match='*tagged_entity*')) == []
+
+    def test_index_ownership(self):
+        one = ThirdEntity('one')
+        one['name'] = 'Shared'
+
+        # The index entry now points to the second entity
+        two = ThirdEntity('two')
+        two['name'] = 'Shared'
+
+        # Changing or deleting the first entity does not remove
+        # the entry of the second one
+        one['name'] = 'First'
+        assert ThirdEntity.findBy('name', 'Shared') == two
+
+        del one['name']
+        one.delete()
+        assert ThirdEntity.findBy('name', 'First') is None
+        assert ThirdEntity.findBy('name', 'Shared') == two
+
+        two.delete()
+        assert ThirdEntity.findBy('name', 'Shared') is None
+        assert len(ThirdEntity.__indexes__['name']) == 0
+        assert ThirdEntity.count() == 0
+
+    def test_set_and_sorted_indexes(self):
+        one = FourthEntity('one')
+        one.team = 'red'
+        one.score = 10
+
+        two = FourthEntity('two')
+        two.team = 'red'
+        two.score = 5
+
+        three = FourthEntity('three')
+        three.team = 'blue'
+        three.incrby('score', 20)
+
+        assert set(FourthEntity.findBy('team', 'red')) == set([one, two])
+        assert FourthEntity.findBy('team', 'blue') == [three]
+        assert set(FourthEntity.__indexes__['team']) == set(['red', 'blue'])
+
+        assert FourthEntity.range('score', 5, 10) == [two, one]
+        assert FourthEntity.range('score', min=11) == [three]
+        assert FourthEntity.findBy('score', 10) == [one]
+
+        two.team = 'blue'
+        del one['score']
+        assert FourthEntity.findBy('team', 'red') == [one]
+        assert FourthEntity.range('score') == [two, three]
+
+        one.delete()
+        assert FourthEntity.findBy('team', 'red') == []
+        assert set(FourthEntity.__indexes__['team']) == set(['blue'])
+
+        # Renaming a value merges its ids with the ids of the new value
+        index = FourthEntity.__indexes__['team']
+        three.team = 'green'
+        assert index.rename('blue', 'green') == 2
+        assert set(FourthEntity.findBy('team', 'green')) == set([two, three])
+        assert FourthEntity.findBy('team', 'blue') == []
+        assert set(index) == set(['green'])
+
+        # Missing values are not added
+        with redis.session():
+            assert index.rename('blue', 'white') is None
+        assert set(index) == set(['green'])
+
+        try:
+            FourthEntity.range('team')
+            assert False
+        except AttributeError:
+            assert True
+
+    def test_query_operations(self):
+        for i, team in enumerate(['red', 'red', 'blue', 'blue', 'blue']):
+            entity = FourthEntity('entity%d' % i)
+            entity.team = team
+            entity.score = i * 10
+            entity['level'] = i % 2
+
+        query = FourthEntity.where(team='blue', score__gte=30)
+        assert query.plan == "set index 'team', filter score"
+        assert set(e.name for e in query) == set(['entity3', 'entity4'])
+
+        query = FourthEntity.where(score__gt=10, score__lte=30)
+        assert query.plan == "sorted index 'score' range"
+        assert [e.name for e in query] == ['entity2', 'entity3']
+        assert [e.name for e in query.limit(1)] == ['entity2']
+
+        query = FourthEntity.where(name='entity1', level=1)
+        assert query.plan == "primary key 'name', filter level"
+        assert query.first().name == 'entity1'
+
+        query = FourthEntity.where(level=0)
+        assert query.plan == "scan 'FourthEntity' members, filter level"
+        assert set(e.name for e in query) == set(['entity0', 'entity2', 'entity4'])
+
+        # The query can be reused after first()
+        assert query.first() is not None
+        assert len(query.all()) == 3
+        assert len(query.limit(2).all()) == 2
+
+        assert FourthEntity.where(level__in=[2, 3]).first() is None
+
+    def test_typed_keys(self):
+        now = datetime(2015, 9, 2, 15, 10, 30, 500)
+
+        entity = TypedEntity('one')
+        entity.count = 3
+        entity.ratio = 0.5
+        entity.active = False
+        entity.updated = now
+        entity.data = {'list': [1, 2], 'text': 'value'}
+
+        entity = TypedEntity('one')
+        assert entity.count == 3
+        assert entity.ratio == 0.5
+        assert entity.active is False
+        assert entity.updated == now
+        assert entity.data == {'list': [1, 2], 'text': 'value'}
+
+        # Values are stored in compact form
+        assert r.hget(entity.id, 'active') == b'0'
+        assert r.hget(entity.id, 'data') == b'{"list":[1,2],"text":"value"}'
+
+        # Strings and bytes are stored as already serialized
+        entity.active = '0'
+        assert entity.active is False
+        entity.active = b'1'
+        assert entity.active is True
+        entity.data = '{"text":"raw"}'
+        assert r.hget(entity.id, 'data') == b'{"text":"raw"}'
+        entity.data = b'[1,2]'
+        assert entity.data == [1, 2]
+        entity.count = b'7'
+        assert entity.count == 7
+
+        # Dates stored with the old format can still be read
+        entity['updated'] = '2015-09-02'
+        assert entity.updated == datetime(2015, 9, 2)
+
+        # Undeclared keys are parsed as numbers when possible
+        entity['other'] = '12'
+        entity['version'] = '1.5'
+        entity['label'] = '1.2.3'
+        assert entity['other'] == 12
+        assert entity['version'] == 1.5
+        assert entity['label'] == '1.2.3'
+
+        # Only declared keys are available as attributes
+        try:
+            entity.other
+            assert False
+        except AttributeError:
+            assert True
+
+        try:
+            entity.other = 13
+            assert False
+        except AttributeError:
+            assert entity['other'] == 12
+
+    def test_hash_tags(self):
+        TaggedEntity = tagged_entity(True)
+
+        entity = TaggedEntity('one')
+        entity.email = 'one@example.com'
+        entity.team = 'red'
+        entity.score = 1
+        entity.visits.incr()
+        assert TaggedEntity.visits.top(7) == [(entity.id, 1)]
+
+        # All the keys of the model are stored in the same slot
+        assert entity.id == '{tagged_entity}tagged_entity:one'
+        keys = list(r.scan_iter(match='*tagged_entity*'))
+        assert len(keys) > 5
+        assert set(key_slot(key) for key in keys) == set([key_slot(b'{tagged_entity}')])
+
+        # Ids can be given with or without the hash tag
+        assert TaggedEntity('tagged_entity:one').id == entity.id
+        assert TaggedEntity.findBy('email', 'one@example.com') == entity
+        assert TaggedEntity.where(name='tagged_entity:one').first().id == entity.id
+
+    def test_hash_tags_migration(self):
+        OldEntity, TaggedEntity = tagged_entity(False), tagged_entity(True)
+
+        for name, team, score in [('one', 'red', 1), ('two', 'red', 2), ('three', 'blue', 3)]:
+            entity = OldEntity(name)
+            entity.email = name + '@example.com'
+            entity.team = team
+            entity.score = score
+            entity.visits.incr(score)
+        assert OldEntity.visits.top(7)[0] == ('tagged_entity:three', 3)
+
+        assert TaggedEntity.migrate(batch=2) == 3
+
+        # The old keys are deleted
+        assert list(r.scan_iter(match='tagged_entity*')) == []
+        assert list(r.scan_iter(match='__members__:tagged_entity*')) == []
+
+        one = TaggedEntity.findBy('email', 'one@example.com')
+        assert one.id == '{tagged_entity}tagged_entity:one'
+        assert one.score == 1
+        assert one.visits.last(7) == 1
+        assert r.ttl(TaggedEntity.visits.key(one)) > 0
+
+        assert sorted(entity.name for entity in TaggedEntity.findBy('team', 'red')) == ['one', 'two']
+        assert [entity.name for entity in TaggedEntity.range('score', 2)] == ['two', 'three']
+        assert TaggedEntity.count() == 3
+        assert TaggedEntity.visits.top(7, n=1) == [('{tagged_entity}tagged_entity:three', 3)]
+
+    def test_replica_reads(self):
+        primary = ThirdEntity('one')
+        primary.name = 'First'
+
+        # Use an empty engine as replica, to check where reads go
+        replica = redis.replica
+        redis.replica = Memory()
+        try:
+            assert not ThirdEntity.exists('one')
+            assert ThirdEntity.findBy('name', 'First') is None
+            assert ThirdEntity('one').name is None
+            assert ThirdEntity.count() == 0
+
+            with redis.session():
+                # Reads of keys not written in the session go to the replica
+                assert not ThirdEntity.exists('one')
+                assert ThirdEntity.findBy('name', 'First') is None
+
+                # Reads of the keys written go to the primary, also after
+                # the session is flushed
+                entity = ThirdEntity('two')
+                entity.name = 'Second'
+                assert ThirdEntity.exists('two')
+                assert ThirdEntity.findBy('name', 'Second') == entity
+                assert ThirdEntity.count() == 2
+
+                entity.incrby('count')
+                assert entity['count'] == 1
+                assert entity.name == 'Second'
+                assert ThirdEntity.findBy('name', 'First') == primary
+
+            # The keys written are forgotten when the session ends
+            assert not ThirdEntity.exists('two')
+        finally:
+            redis.replica = replica
+
+    def test_tracing(self):
+        entity = FourthEntity('one')
+        entity.team = 'red'
+
+        with redis.tracing() as trace:
+            assert FourthEntity.findBy('team', 'red') == [entity]
+
+            # The writes of a session are sent in a single round trip
+            with redis.tracing() as inner:
+                with redis.session():
+                    other = FourthEntity('two')
+                    other.team = 'blue'
+                    other.score = 2
+
+        assert redis.current_trace() is None
+        assert inner.round_trips == 1
+        assert inner.commands == 4
+        assert trace.round_trips == 2
+        assert trace.operations['FourthEntity.findBy'][:2] == [1, 1]
+        assert sum(inner.calls.values()) == 4
+        assert trace.calls == dict(inner.calls, SMEMBERS=1)
+
+    def test_reads_without_writes(self):
+        entity = ThirdEntity('one')
+        entity.name = 'First'
+        other = FourthEntity('two')
+
+        # Models returned by lookups are not written again
+        with redis.tracing() as trace:
+            assert ThirdEntity.findBy('name', 'First') == entity
+            assert ThirdEntity.findBy('id', 'one') == entity
+            assert ThirdEntity.where(name='First').first() == entity
+            assert [e.id for e in FourthEntity.all()] == [other.id]
+
+        assert set(trace.calls) <= set(['GET', 'EXISTS', 'SSCAN', 'HGET', 'HGETALL', 'SMEMBERS']), trace.breakdown()
+
+    def test_cluster_session(self):
+        TaggedEntity = tagged_entity(True)
+        client, cluster = redis.redis, redis.CLUSTER
+
+        # The scripts buffered in the session are loaded in the cluster
+        redis.redis, redis.CLUSTER = FakeCluster(r), True
+        try:
+            with redis.session():
+                entity = TaggedEntity('one')
+                entity.email = 'one@example.com'
+                entity.team = 'red'
+                entity.score = 1
+                entity.visits.incr()
+                entity.incrby('score', 2)
+
+            entity.email = 'other@example.com'
+        finally:
+            redis.redis, redis.CLUSTER = client, cluster
+
+        assert TaggedEntity.findBy('email', 'other@example.com') == entity
+        assert TaggedEntity.findBy('email', 'one@example.com') is None
+        assert TaggedEntity.findBy('team', 'red') == [entity]
+        assert entity.score == 3
+        assert entity.visits.last(7) == 1
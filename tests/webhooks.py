@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-from flask import json
+from flask import json, request
 from .base import BaseTestCase
-from app import webhooks
+from app import app, webhooks, r
+from app.deliveries import Deliveries
+from app.webhooks import Payload
 
+from redis.exceptions import ConnectionError
 from werkzeug.exceptions import NotImplemented
 
 hook1 = "/tests/gwzXzRrXZyk8fesADQAVe6WwI/NDiOMUGEoVmUi48ro"
@@ -28,7 +31,7 @@ class Hook3:
         return 'some_event'
 
     def some_event(self, data):
-        return json.dumps(data)
+        return json.dumps(dict(data))
 
 
 @webhooks.hook(hook4, handler='gitlab')
@@ -45,6 +48,31 @@ class Hook4:
     def snippet_comment(self, data):
         return 'snippet_comment'
 
+# Events handled by Hook5, and failures before it succeeds
+handled = []
+failures = {'count': 0}
+
+@webhooks.hook(hook5)
+class Hook5:
+    def event(self, request):
+        return 'some_event'
+
+    def some_event(self, data):
+        if failures['count'] > 0:
+            failures['count'] -= 1
+            raise RuntimeError('Failed delivery')
+
+        handled.append(dict(data))
+        return 'handled'
+
+
+class UnavailableRedis(object):
+    def set(self, *args, **kwargs):
+        raise ConnectionError('Connection refused')
+
+    def delete(self, *args):
+        raise ConnectionError('Connection refused')
+
 class WebHooksTestCase(BaseTestCase):
     def test_event_method_not_implemented(self):
         try:
@@ -96,3 +124,99 @@ class GitlabWebHooksTestCase(BaseTestCase):
         rv = self.app.post(hook4, follow_redirects=True, content_type='application/json', data=json.dumps(dict(snippet={'id': '123'})), headers={'X-Gitlab-Event': 'Note Hook'})
         assert rv.status_code == 200
         assert rv.data.decode('utf-8') == 'snippet_comment'
+
+
+class PayloadTestCase(BaseTestCase):
+    def test_json_payload(self):
+        data = json.dumps(dict(object_kind='push', commits=[{'id': '1'}]))
+        with app.test_request_context('/', method='POST', data=data, content_type='application/json'):
+            payload = Payload(request)
+            assert payload['object_kind'] == 'push'
+            assert payload.get('ref') is None
+            assert len(payload) == 2
+
+            # The body is parsed once, and returned without copies
+            assert payload.json is payload.json
+            assert payload.to_dict() is payload.json
+
+    def test_merged_payload(self):
+        data = json.dumps(dict(one=1, two=2))
+        with app.test_request_context('/?two=query&three=3', method='POST', data=data,
+                                      content_type='application/json'):
+            payload = Payload(request)
+            assert payload['two'] == 'query'
+            assert sorted(payload) == ['one', 'three', 'two']
+            assert payload.to_dict() == dict(one=1, two='query', three='3')
+
+    def test_invalid_payload(self):
+        rv = self.app.post(hook3, follow_redirects=True, data='{', content_type='application/json')
+        assert rv.status_code == 400
+
+    def test_payload_repr(self):
+        # Payloads are described without decoding or reading the body
+        with app.test_request_context('/', method='POST', data='{' * 500, content_type='application/json'):
+            payload = Payload(request)
+            assert repr(payload) == '<Payload 500 bytes>'
+
+            payload.body()
+            assert repr(payload).startswith("<Payload 500 bytes: b'{{{")
+            assert repr(payload).endswith("{'...>")
+
+
+class DeliveriesTestCase(BaseTestCase):
+    def setUp(self):
+        super(DeliveriesTestCase, self).setUp()
+        webhooks.deliveries = Deliveries(r, prefix='test:delivery:', ttl=60)
+        del handled[:]
+
+    def tearDown(self):
+        webhooks.deliveries = None
+        for key in r.keys('test:delivery:*'):
+            r.delete(key)
+
+    def post(self, hook, data, **headers):
+        return self.app.post(hook, follow_redirects=True, content_type='application/json',
+                             data=json.dumps(data), headers=headers)
+
+    def test_duplicate_body(self):
+        assert self.post(hook5, dict(one=1)).data.decode('utf-8') == 'handled'
+
+        # The same body is skipped, even by another process
+        webhooks.deliveries = Deliveries(r, prefix='test:delivery:', ttl=60)
+        rv = self.post(hook5, dict(one=1))
+        assert rv.status_code == 200
+        assert rv.data.decode('utf-8') == ''
+
+        assert self.post(hook5, dict(one=2)).data.decode('utf-8') == 'handled'
+        assert handled == [dict(one=1), dict(one=2)]
+
+    def test_delivery_header(self):
+        headers = {'X-Gitlab-Event': 'Note Hook', 'Idempotency-Key': 'delivery-1'}
+        assert self.post(hook4, dict(issue={'id': '1'}), **headers).data.decode('utf-8') == 'issue_comment'
+        assert self.post(hook4, dict(issue={'id': '1', 'retry': True}), **headers).data.decode('utf-8') == ''
+
+        headers['Idempotency-Key'] = 'delivery-2'
+        assert self.post(hook4, dict(issue={'id': '1'}), **headers).data.decode('utf-8') == 'issue_comment'
+
+    def test_failed_delivery(self):
+        failures['count'] = 1
+        try:
+            self.post(hook5, dict(one=1))
+            assert False
+        except RuntimeError:
+            pass
+
+        # The failed event is handled when it is sent again
+        assert self.post(hook5, dict(one=1)).data.decode('utf-8') == 'handled'
+        assert handled == [dict(one=1)]
+
+    def test_unavailable_redis(self):
+        deliveries = Deliveries(UnavailableRedis(), ttl=60, size=2)
+        assert deliveries.claim('one')
+        assert not deliveries.claim('one')
+        assert deliveries.claim('two')
+        assert deliveries.claim('three')
+
+        # The least recently claimed keys are forgotten
+        assert len(deliveries.recent) == 2
+        assert deliveries.claim('one')